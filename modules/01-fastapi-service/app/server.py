@@ -1,7 +1,9 @@
 import os
 import json
+import sys
 import time
-from typing import Dict, Generator, Optional
+from pathlib import Path
+from typing import Dict, Generator, Literal, Optional
 
 from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.responses import PlainTextResponse, StreamingResponse
@@ -14,6 +16,10 @@ except Exception:  # pragma: no cover - 允许无 prometheus 依赖运行
     generate_latest = None  # type: ignore
     CONTENT_TYPE_LATEST = "text/plain; version=0.0.4"  # type: ignore
 
+# 复用模块 4 的增量标签解析器（纯标准库）
+sys.path.append(str(Path(__file__).resolve().parents[2] / "04-prompt-engineering" / "eval"))
+from label_stream import LabelStream  # noqa: E402
+
 
 app = FastAPI(title="Module 01 - FastAPI SSE Demo")
 
@@ -51,8 +57,12 @@ def _sse(data: dict) -> str:
     return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
+def _demo_tokens(prompt: str) -> list[str]:
+    return list(prompt) + ["，", "世", "界", "！"]
+
+
 def token_stream(prompt: str = "你好") -> Generator[bytes, None, None]:
-    tokens = list(prompt) + ["，", "世", "界", "！"]
+    tokens = _demo_tokens(prompt)
     for i, tok in enumerate(tokens):
         payload = {"id": i, "content": tok, "done": False}
         if CHAT_TOKENS:
@@ -62,6 +72,31 @@ def token_stream(prompt: str = "你好") -> Generator[bytes, None, None]:
     yield _sse({"id": len(tokens), "content": "", "done": True}).encode("utf-8")
 
 
+def label_stream(prompt: str, labels: list[str], mode: str) -> Generator[bytes, None, None]:
+    """同 token_stream，但边推送边解析标签；标签一经确定即发送结果并停止生成。"""
+    extractor = LabelStream(labels, json_mode={"json": True, "text": False, "auto": None}[mode])
+    tokens = _demo_tokens(prompt)
+    result = None
+    i = -1
+    for i, tok in enumerate(tokens):
+        if CHAT_TOKENS:
+            CHAT_TOKENS.inc()
+        yield _sse({"id": i, "content": tok, "done": False}).encode("utf-8")
+        result = extractor.feed(tok)
+        if result is not None:
+            break  # 真实模型在此处停止解码，剩余 token 不再生成
+        time.sleep(0.1)
+    result = result or extractor.close()
+    yield _sse({
+        "id": i + 1,
+        "content": "",
+        "done": True,
+        "label": result.label,
+        "status": result.status,
+        "early": result.early,
+    }).encode("utf-8")
+
+
 @app.get("/", response_class=PlainTextResponse)
 def root() -> str:
     return "OK"
@@ -79,6 +114,8 @@ def health(x_api_key: Optional[str] = Header(default=None), request: Request = N
 @app.get("/chat")
 def chat(
     prompt: str = "你好，SSE",
+    extract: Optional[Literal["json", "text", "auto"]] = None,
+    labels: str = "积极,中性,消极",
     x_api_key: Optional[str] = Header(default=None),
     request: Request = None,  # type: ignore
 ):
@@ -88,7 +125,10 @@ def chat(
     def _gen():
         start = time.time()
         try:
-            yield from token_stream(prompt)
+            if extract:
+                yield from label_stream(prompt, [x.strip() for x in labels.split(",") if x.strip()], extract)
+            else:
+                yield from token_stream(prompt)
         finally:
             if REQ_TOTAL:
                 REQ_TOTAL.inc()
@@ -1,4 +1,5 @@
 import importlib.util
+import json
 from pathlib import Path
 from fastapi.testclient import TestClient
 
@@ -29,3 +30,19 @@ def test_chat_streaming_done():
             if data.startswith("data:"):
                 chunks.append(data)
         assert any('"done": true' in x for x in chunks)
+
+
+def test_chat_extract_stops_early():
+    prompt = '{"label": "积极", "reason": "天气很好"}'
+    with client.stream("GET", "/chat", params={"prompt": prompt, "extract": "json"}) as r:  # type: ignore
+        events = [json.loads(line[5:]) for line in r.iter_lines() if line.startswith("data:")]
+    done = events[-1]
+    assert done["done"] and done["label"] == "积极" and done["status"] == "ok" and done["early"]
+    # 标签字符串闭合后即停止，不再推送 reason 与后续 token
+    assert "".join(e["content"] for e in events) == '{"label": "积极"'
+
+
+def test_chat_extract_failure_status():
+    with client.stream("GET", "/chat", params={"prompt": '{"label": 3}', "extract": "json"}) as r:  # type: ignore
+        events = [json.loads(line[5:]) for line in r.iter_lines() if line.startswith("data:")]
+    assert events[-1]["status"] == "wrong_type"
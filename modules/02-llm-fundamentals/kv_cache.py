@@ -0,0 +1,345 @@
+"""Reference KV-cache decoder (NumPy): RoPE + incremental attention.
+
+A tiny random-weight decoder-only Transformer used to show what the KV cache
+buys during autoregressive decoding:
+
+- Without cache every new token re-runs attention over the whole prefix,
+  per-token cost grows with context length (O(T^2) for the whole sequence).
+- With cache the K/V of past tokens are kept in a preallocated buffer, each
+  step only projects the new token and attends over the cached keys.
+
+``KVCache`` is a ring buffer of shape [L, H, capacity, D]. Without a window it
+grows by doubling; with ``window`` set it stops growing at ``window`` slots and
+overwrites the oldest entry (sliding-window attention). Keys are stored after
+RoPE rotation at their absolute position, so slot order does not matter.
+
+Benchmark (per-token latency vs context length, cache vs no cache):
+```
+python modules/02-llm-fundamentals/kv_cache.py --contexts 64,256,1024
+```
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+BASE = Path(__file__).resolve().parent
+sys.path.append(str(BASE))
+
+from sampling import sample_top_p  # noqa: E402
+
+
+def rope(x: np.ndarray, positions: np.ndarray, base: float = 10000.0) -> np.ndarray:
+    """Rotate (even, odd) feature pairs of x by position-dependent angles.
+
+    Args:
+        x: shape [T, H, D], D even.
+        positions: shape [T], absolute token positions.
+    """
+    d = x.shape[-1]
+    inv_freq = base ** (-np.arange(0, d, 2, dtype=np.float64) / d)
+    ang = positions[:, None].astype(np.float64) * inv_freq[None, :]  # [T, D/2]
+    cos = np.cos(ang).astype(x.dtype)[:, None, :]
+    sin = np.sin(ang).astype(x.dtype)[:, None, :]
+    x1 = x[..., 0::2]
+    x2 = x[..., 1::2]
+    out = np.empty_like(x)
+    out[..., 0::2] = x1 * cos - x2 * sin
+    out[..., 1::2] = x1 * sin + x2 * cos
+    return out
+
+
+class KVCache:
+    """Preallocated, growable ring buffer holding K/V for every layer."""
+
+    def __init__(
+        self,
+        n_layers: int,
+        n_heads: int,
+        head_dim: int,
+        capacity: int = 128,
+        window: int | None = None,
+        dtype=np.float32,
+    ):
+        if capacity < 1:
+            raise ValueError("capacity must be >= 1")
+        if window is not None:
+            if window < 1:
+                raise ValueError("window must be >= 1")
+            capacity = min(capacity, window)
+        self.window = window
+        self.k = np.zeros((n_layers, n_heads, capacity, head_dim), dtype=dtype)
+        self.v = np.zeros_like(self.k)
+        self.length = 0  # tokens seen so far == absolute position of the next token
+
+    @property
+    def capacity(self) -> int:
+        return self.k.shape[2]
+
+    @property
+    def size(self) -> int:
+        """Number of valid slots."""
+        return min(self.length, self.capacity)
+
+    def reserve(self, n_new: int) -> None:
+        """Grow (by doubling) so that n_new more tokens fit without wrapping.
+
+        With a window the buffer never grows past ``window``; older slots are
+        overwritten instead.
+        """
+        target = self.length + n_new
+        if self.window is not None:
+            target = min(target, self.window)
+        if target <= self.capacity:
+            return
+        new_cap = self.capacity
+        while new_cap < target:
+            new_cap *= 2
+        if self.window is not None:
+            new_cap = min(new_cap, self.window)
+        # before the first wrap slots are in order [0, length), a plain copy keeps them
+        k = np.zeros(self.k.shape[:2] + (new_cap,) + self.k.shape[3:], dtype=self.k.dtype)
+        v = np.zeros_like(k)
+        k[:, :, : self.size] = self.k[:, :, : self.size]
+        v[:, :, : self.size] = self.v[:, :, : self.size]
+        self.k, self.v = k, v
+
+    def store(self, layer: int, k: np.ndarray, v: np.ndarray) -> None:
+        """Write K/V of the new tokens (shape [T, H, D]) for one layer.
+
+        Call ``advance`` once after all layers stored the same tokens.
+        """
+        t = k.shape[0]
+        cap = self.capacity
+        if t > cap:  # only the last `cap` tokens survive in a windowed cache
+            k, v = k[-cap:], v[-cap:]
+            start = self.length + t - cap
+            t = cap
+        else:
+            start = self.length
+        slots = (start + np.arange(t)) % cap
+        self.k[layer][:, slots] = k.transpose(1, 0, 2)
+        self.v[layer][:, slots] = v.transpose(1, 0, 2)
+
+    def view(self, layer: int, pending: int = 0) -> tuple[np.ndarray, np.ndarray]:
+        """Valid cached K/V for one layer, each [H, n, D].
+
+        ``pending`` counts tokens already stored but not yet ``advance``-d.
+        """
+        n = min(self.length + pending, self.capacity)
+        return self.k[layer, :, :n], self.v[layer, :, :n]
+
+    def advance(self, n: int) -> None:
+        self.length += n
+
+
+def _rms_norm(x: np.ndarray, eps: float = 1e-6) -> np.ndarray:
+    return x / np.sqrt(np.mean(x * x, axis=-1, keepdims=True) + eps)
+
+
+def _gelu(x: np.ndarray) -> np.ndarray:
+    return 0.5 * x * (1.0 + np.tanh(0.7978845608 * (x + 0.044715 * x ** 3)))
+
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    x = x - np.max(x, axis=-1, keepdims=True)
+    e = np.exp(x)
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+class TinyDecoder:
+    """Random-weight pre-norm decoder: RMSNorm → MHA(RoPE) → RMSNorm → FFN(GELU)."""
+
+    def __init__(
+        self,
+        vocab_size: int = 256,
+        d_model: int = 64,
+        n_heads: int = 4,
+        n_layers: int = 2,
+        d_ff: int | None = None,
+        window: int | None = None,
+        seed: int = 0,
+        dtype=np.float32,
+    ):
+        if d_model % n_heads != 0 or (d_model // n_heads) % 2 != 0:
+            raise ValueError("d_model must split into n_heads even-sized heads")
+        rng = np.random.default_rng(seed)
+        d_ff = d_ff or 4 * d_model
+
+        def w(*shape):
+            return (rng.normal(size=shape) / np.sqrt(shape[0])).astype(dtype)
+
+        self.vocab_size = vocab_size
+        self.n_heads = n_heads
+        self.n_layers = n_layers
+        self.head_dim = d_model // n_heads
+        self.window = window
+        self.dtype = dtype
+        self.embed = (rng.normal(size=(vocab_size, d_model))).astype(dtype)
+        self.layers = [
+            {
+                "wqkv": w(d_model, 3 * d_model),
+                "wo": w(d_model, d_model),
+                "w1": w(d_model, d_ff),
+                "w2": w(d_ff, d_model),
+            }
+            for _ in range(n_layers)
+        ]
+        self.lm_head = w(d_model, vocab_size)
+
+    def new_cache(self, capacity: int = 128) -> KVCache:
+        return KVCache(
+            self.n_layers, self.n_heads, self.head_dim,
+            capacity=capacity, window=self.window, dtype=self.dtype,
+        )
+
+    def forward(self, ids: np.ndarray, cache: KVCache | None = None) -> np.ndarray:
+        """Logits [T, V] for tokens ``ids`` (shape [T]).
+
+        With ``cache`` the tokens continue the cached sequence (incremental
+        decoding); without it they are treated as the whole sequence and
+        attention is recomputed over all of them.
+        """
+        ids = np.asarray(ids)
+        T = ids.shape[0]
+        H, D = self.n_heads, self.head_dim
+        start = cache.length if cache is not None else 0
+        pos = start + np.arange(T)
+        if cache is not None:
+            cache.reserve(T)
+
+        x = self.embed[ids]
+        for li, layer in enumerate(self.layers):
+            h = _rms_norm(x)
+            qkv = (h @ layer["wqkv"]).reshape(T, 3, H, D)
+            q = rope(qkv[:, 0], pos)
+            k = rope(qkv[:, 1], pos)
+            v = qkv[:, 2]
+
+            if cache is not None and T == 1:
+                # decode step: new key joins the cache, attend over every valid slot
+                cache.store(li, k, v)
+                keys, vals = cache.view(li, pending=T)
+                mask = None
+            else:
+                # prefill / no-cache: causal (and sliding-window) mask over the block itself
+                if cache is not None:
+                    if cache.length > 0:
+                        raise ValueError("multi-token forward on a non-empty cache is not supported")
+                    cache.store(li, k, v)
+                keys, vals = k.transpose(1, 0, 2), v.transpose(1, 0, 2)
+                diff = pos[:, None] - pos[None, :]
+                mask = diff >= 0
+                if self.window is not None:
+                    mask &= diff < self.window
+
+            scores = q.transpose(1, 0, 2) @ keys.transpose(0, 2, 1) / D ** 0.5  # [H, T, S]
+            if mask is not None:
+                scores = np.where(mask[None], scores, -np.inf)
+            attn = _softmax(scores) @ vals  # [H, T, D]
+            x = x + attn.transpose(1, 0, 2).reshape(T, H * D) @ layer["wo"]
+            x = x + _gelu(_rms_norm(x) @ layer["w1"]) @ layer["w2"]
+
+        if cache is not None:
+            cache.advance(T)
+        return _rms_norm(x) @ self.lm_head
+
+    def generate(
+        self,
+        prompt_ids: List[int],
+        max_new_tokens: int = 16,
+        *,
+        temperature: float = 1.0,
+        top_p: float = 0.9,
+        rng: np.random.Generator | None = None,
+        use_cache: bool = True,
+    ) -> List[int]:
+        """Autoregressive generation with Temperature + Top-p (``sample_top_p``)."""
+        if rng is None:
+            rng = np.random.default_rng()
+        ids = list(prompt_ids)
+        if use_cache:
+            cache = self.new_cache(capacity=len(ids) + max_new_tokens)
+            logits = self.forward(np.asarray(ids), cache)
+        else:
+            logits = self.forward(np.asarray(ids))
+        out: List[int] = []
+        for step in range(max_new_tokens):
+            tok = sample_top_p(logits[-1], temperature=temperature, top_p=top_p, rng=rng)
+            out.append(tok)
+            if step == max_new_tokens - 1:
+                break
+            ids.append(tok)
+            if use_cache:
+                logits = self.forward(np.asarray([tok]), cache)
+            else:
+                logits = self.forward(np.asarray(ids))
+        return out
+
+
+def benchmark(
+    model: TinyDecoder,
+    contexts: List[int],
+    *,
+    steps: int = 8,
+    seed: int = 0,
+) -> List[dict]:
+    """Mean per-token decode latency at each context length, cache vs recompute."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for ctx in contexts:
+        ids = rng.integers(0, model.vocab_size, size=ctx)
+        new = rng.integers(0, model.vocab_size, size=steps)
+
+        cache = model.new_cache(capacity=ctx + steps)
+        model.forward(ids, cache)
+        t0 = time.perf_counter()
+        for tok in new:
+            model.forward(np.asarray([tok]), cache)
+        cached = (time.perf_counter() - t0) / steps
+
+        seq = list(ids)
+        t0 = time.perf_counter()
+        for tok in new:
+            seq.append(int(tok))
+            model.forward(np.asarray(seq))
+        no_cache = (time.perf_counter() - t0) / steps
+
+        rows.append({
+            "context": ctx,
+            "cached_ms_per_token": round(cached * 1e3, 3),
+            "no_cache_ms_per_token": round(no_cache * 1e3, 3),
+            "speedup": round(no_cache / cached, 1),
+        })
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description="KV cache decode benchmark (NumPy)")
+    ap.add_argument("--contexts", default="64,128,256,512,1024")
+    ap.add_argument("--steps", type=int, default=8)
+    ap.add_argument("--d-model", type=int, default=128)
+    ap.add_argument("--n-heads", type=int, default=4)
+    ap.add_argument("--n-layers", type=int, default=2)
+    ap.add_argument("--vocab-size", type=int, default=1024)
+    args = ap.parse_args()
+
+    model = TinyDecoder(
+        vocab_size=args.vocab_size,
+        d_model=args.d_model,
+        n_heads=args.n_heads,
+        n_layers=args.n_layers,
+    )
+    contexts = [int(x) for x in args.contexts.split(",") if x.strip()]
+    for row in benchmark(model, contexts, steps=args.steps):
+        print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,21 @@
 If you already have token-level negative log-likelihoods (NLL),
 PPL = exp(mean(NLL)). For demonstration, we also provide a simple
 cross-entropy over logits and target indices using NumPy.
+
+For long sequences / large vocabularies the full [T, V] log-softmax does not
+fit in memory, so NLL is accumulated over row chunks instead: per chunk we
+only need the row logsumexp and the logit of the target token. Inputs can be
+plain arrays, ``np.memmap`` files or an iterator of (logits, targets) chunks.
 """
 from __future__ import annotations
 
+from typing import Iterable, Tuple
+
 import numpy as np
 
+# rows per chunk; peak extra memory is about chunk_size * V * 8 bytes
+DEFAULT_CHUNK_ROWS = 128
+
 
 def log_softmax(x: np.ndarray) -> np.ndarray:
     x = x - np.max(x, axis=-1, keepdims=True)
@@ -20,27 +30,118 @@ def ppl_from_nll(nlls: np.ndarray) -> float:
     return float(np.exp(np.mean(nlls)))
 
 
-def sequence_nll(logits: np.ndarray, targets: np.ndarray) -> float:
-    """Compute mean negative log-likelihood for a sequence.
+def nll_sum(
+    logits: np.ndarray,
+    targets: np.ndarray,
+    *,
+    chunk_size: int = DEFAULT_CHUNK_ROWS,
+) -> Tuple[float, int]:
+    """Sum of token NLL over a sequence, computed chunk by chunk.
 
     Args:
-        logits: shape [T, V]
+        logits: shape [T, V]; any row-sliceable array (e.g. np.memmap).
         targets: shape [T], token indices in [0, V)
+        chunk_size: number of rows materialized (as float64) at a time.
+
+    Returns:
+        (sum of NLL, number of tokens)
     """
     if logits.ndim != 2:
         raise ValueError("logits must be [T,V]")
     if targets.ndim != 1 or targets.shape[0] != logits.shape[0]:
         raise ValueError("targets must be [T] and match logits T")
-    ls = log_softmax(logits)
-    row_idx = np.arange(targets.shape[0])
-    selected = ls[row_idx, targets]
-    nll = -np.mean(selected)
-    return float(nll)
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be >= 1")
+
+    total = 0.0
+    T = logits.shape[0]
+    for start in range(0, T, chunk_size):
+        end = min(start + chunk_size, T)
+        # always a private float64 copy, so the in-place ops below never touch the caller's data
+        x = np.array(logits[start:end], dtype=np.float64)
+        t = np.asarray(targets[start:end])
+        rows = np.arange(end - start)
+        picked = x[rows, t]
+        m = np.max(x, axis=-1)
+        x -= m[:, None]
+        np.exp(x, out=x)
+        lse = m + np.log(np.sum(x, axis=-1))
+        total += float(np.sum(lse - picked))
+    return total, T
+
+
+class NLLAccumulator:
+    """Token-weighted NLL accumulator across chunks and sequences.
+
+    Feed it (logits, targets) chunks of one long sequence, or whole sequences
+    one after another; ``nll`` / ``ppl`` are always weighted by token count.
+    """
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_ROWS):
+        self.chunk_size = chunk_size
+        self.total_nll = 0.0
+        self.n_tokens = 0
+
+    def update(self, logits: np.ndarray, targets: np.ndarray) -> None:
+        s, n = nll_sum(logits, targets, chunk_size=self.chunk_size)
+        self.total_nll += s
+        self.n_tokens += n
+
+    def extend(self, chunks: Iterable[Tuple[np.ndarray, np.ndarray]]) -> None:
+        for logits, targets in chunks:
+            self.update(logits, targets)
+
+    @property
+    def nll(self) -> float:
+        if self.n_tokens == 0:
+            raise ValueError("no tokens accumulated")
+        return self.total_nll / self.n_tokens
+
+    def ppl(self) -> float:
+        return float(np.exp(self.nll))
+
+
+def sequence_nll(
+    logits: np.ndarray,
+    targets: np.ndarray,
+    *,
+    chunk_size: int = DEFAULT_CHUNK_ROWS,
+) -> float:
+    """Compute mean negative log-likelihood for a sequence.
+
+    Args:
+        logits: shape [T, V]
+        targets: shape [T], token indices in [0, V)
+        chunk_size: rows processed at a time (bounds peak memory).
+    """
+    s, n = nll_sum(logits, targets, chunk_size=chunk_size)
+    return s / n if n else float("nan")
 
 
 def ppl_from_logits(logits: np.ndarray, targets: np.ndarray) -> float:
     return float(np.exp(sequence_nll(logits, targets)))
 
 
-__all__ = ["ppl_from_nll", "sequence_nll", "ppl_from_logits"]
+def corpus_ppl(
+    sequences: Iterable[Tuple[np.ndarray, np.ndarray]],
+    *,
+    chunk_size: int = DEFAULT_CHUNK_ROWS,
+) -> float:
+    """Token-weighted PPL over many (logits, targets) sequences.
+
+    Longer sequences weigh more, i.e. exp(sum NLL / sum tokens), not the mean
+    of per-sequence PPL.
+    """
+    acc = NLLAccumulator(chunk_size=chunk_size)
+    acc.extend(sequences)
+    return acc.ppl()
+
 
+__all__ = [
+    "ppl_from_nll",
+    "nll_sum",
+    "NLLAccumulator",
+    "sequence_nll",
+    "ppl_from_logits",
+    "corpus_ppl",
+]
@@ -0,0 +1,43 @@
+import importlib.util
+from pathlib import Path
+import numpy as np
+
+BASE = Path(__file__).resolve().parents[1]
+spec = importlib.util.spec_from_file_location("kv_cache", str(BASE / "kv_cache.py"))
+kv = importlib.util.module_from_spec(spec)  # type: ignore
+assert spec and spec.loader
+spec.loader.exec_module(kv)  # type: ignore
+
+
+def _incremental_logits(model, ids, prefill, capacity):
+    cache = model.new_cache(capacity=capacity)
+    outs = [model.forward(ids[:prefill], cache)]
+    for tok in ids[prefill:]:
+        outs.append(model.forward(np.asarray([tok]), cache))
+    return np.concatenate(outs), cache
+
+
+def test_cached_decode_matches_full_recompute():
+    model = kv.TinyDecoder(vocab_size=50, d_model=32, n_heads=2, n_layers=2, seed=1)
+    ids = np.random.default_rng(0).integers(0, 50, size=20)
+    full = model.forward(ids)
+    # tiny initial capacity forces the cache to grow several times
+    inc, cache = _incremental_logits(model, ids, prefill=3, capacity=2)
+    assert np.allclose(full, inc, atol=1e-4)
+    assert cache.length == 20 and cache.capacity >= 20
+
+
+def test_sliding_window_ring_buffer_wraps():
+    model = kv.TinyDecoder(vocab_size=50, d_model=32, n_heads=2, n_layers=2, window=5, seed=1)
+    ids = np.random.default_rng(0).integers(0, 50, size=20)
+    full = model.forward(ids)
+    inc, cache = _incremental_logits(model, ids, prefill=8, capacity=2)
+    assert np.allclose(full, inc, atol=1e-4)
+    assert cache.capacity == 5 and cache.size == 5
+
+
+def test_generate_with_and_without_cache_agree():
+    model = kv.TinyDecoder(vocab_size=50, d_model=32, n_heads=2, n_layers=2, seed=2)
+    a = model.generate([1, 2, 3], 8, temperature=0.8, top_p=0.9, rng=np.random.default_rng(3))
+    b = model.generate([1, 2, 3], 8, temperature=0.8, top_p=0.9, rng=np.random.default_rng(3), use_cache=False)
+    assert a == b and len(a) == 8
@@ -1,6 +1,7 @@
 import importlib.util
 from pathlib import Path
 import numpy as np
+import pytest
 
 BASE = Path(__file__).resolve().parents[1]
 
@@ -22,6 +23,30 @@ def test_sample_top_p_returns_index():
     assert 0 <= idx < logits.shape[0]
 
 
+def test_sample_top_p_batch_matches_scalar():
+    rng = np.random.default_rng(42)
+    logits = rng.normal(size=(16, 200)) * 4.0
+    temperature = rng.uniform(0.5, 1.5, size=16)
+    top_p = rng.uniform(0.1, 1.0, size=16)
+    top_p[0] = 1.0
+    # small candidate budget forces some rows through the full-sort fallback
+    batch = sampling.sample_top_p_batch(
+        logits, temperature, top_p, rng=np.random.default_rng(0), candidates=8
+    )
+    g = np.random.default_rng(0)
+    scalar = [sampling.sample_top_p(logits[i], temperature[i], top_p[i], rng=g) for i in range(16)]
+    assert batch.shape == (16,)
+    assert batch.tolist() == scalar
+
+
+def test_sample_top_p_batch_rejects_bad_params():
+    logits = np.zeros((2, 4))
+    with pytest.raises(ValueError):
+        sampling.sample_top_p_batch(logits, temperature=[1.0, 0.0])
+    with pytest.raises(ValueError):
+        sampling.sample_top_p_batch(logits, top_p=[0.5, 1.5])
+
+
 def test_ppl_from_nll():
     nlls = np.array([1.0, 2.0, 3.0])
     v = ppl.ppl_from_nll(nlls)
@@ -34,3 +59,32 @@ def test_ppl_from_logits_matches_sequence_nll():
     nll = ppl.sequence_nll(logits, targets)
     v = ppl.ppl_from_logits(logits, targets)
     assert np.isclose(v, np.exp(nll))
+
+
+def test_sequence_nll_chunked_matches_full_log_softmax():
+    rng = np.random.default_rng(0)
+    logits = rng.normal(size=(37, 11)) * 3.0
+    targets = rng.integers(0, 11, size=37)
+    full = -np.mean(ppl.log_softmax(logits)[np.arange(37), targets])
+    for chunk_size in (1, 5, 64):
+        assert np.isclose(ppl.sequence_nll(logits, targets, chunk_size=chunk_size), full)
+
+
+def test_nll_accumulator_memmap_and_token_weighting(tmp_path):
+    rng = np.random.default_rng(1)
+    a_logits = rng.normal(size=(20, 7)).astype(np.float32)
+    a_targets = rng.integers(0, 7, size=20)
+    mm = np.lib.format.open_memmap(tmp_path / "a.npy", mode="w+", dtype=np.float32, shape=(20, 7))
+    mm[:] = a_logits
+    mm.flush()
+    b_logits = rng.normal(size=(3, 7))
+    b_targets = rng.integers(0, 7, size=3)
+
+    acc = ppl.NLLAccumulator(chunk_size=4)
+    acc.update(np.load(tmp_path / "a.npy", mmap_mode="r"), a_targets)
+    acc.update(b_logits, b_targets)
+    assert acc.n_tokens == 23
+
+    expected = (ppl.sequence_nll(a_logits, a_targets) * 20 + ppl.sequence_nll(b_logits, b_targets) * 3) / 23
+    assert np.isclose(acc.nll, expected)
+    assert np.isclose(ppl.corpus_ppl([(a_logits, a_targets), (b_logits, b_targets)]), np.exp(expected))
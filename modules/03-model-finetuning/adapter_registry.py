@@ -0,0 +1,164 @@
+"""多 adapter 推理：一份基座权重常驻内存，LoRA adapter 按需加载、LRU 淘汰。
+
+- `AdapterRegistry`：登记 adapter ID → 目录（只记路径，不加载）；`activate(id)` 时才把该
+  adapter 挂到共享基座上（PEFT 多 adapter），已加载数超过 `max_loaded` 时卸载最久未用的一个。
+  50 个 adapter 只占一份基座权重 + 至多 `max_loaded` 份 LoRA 权重；
+- `group_by_adapter` / `route`：请求按 adapter ID 分组（组按首次出现的顺序），同组请求在一次
+  `activate` 下批量处理，结果按原顺序返回，避免 adapter 来回切换；
+- 在线服务中多个线程共用同一个 registry 时，`route` 持有 registry 的锁，保证切换 adapter 与
+  前向计算不交错。
+
+库用法：
+```
+registry = AdapterRegistry("TinyLlama/TinyLlama-1.1B-Chat-v1.0", max_loaded=4)
+registry.register("legal", "outputs/lora-legal")
+registry.register("medical", "outputs/lora-medical")
+outputs = route(registry, requests, lambda model, batch: generate(model, batch), key=lambda r: r["adapter"])
+```
+命令行见 `evaluate_model.py --adapter ID=PATH`。
+"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, TypeVar
+
+import torch
+from transformers import AutoModelForCausalLM
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def parse_adapter_specs(specs: Sequence[str]) -> Dict[str, str]:
+    """`ID=PATH`、adapter 目录（ID 取目录名）或 {ID: PATH} 的 JSON 文件，可混用。"""
+    out: Dict[str, str] = {}
+    for spec in specs:
+        if "=" in spec:
+            adapter_id, path = spec.split("=", 1)
+            out[adapter_id] = path
+        elif spec.endswith(".json"):
+            out.update(json.loads(Path(spec).read_text(encoding="utf-8")))
+        else:
+            out[Path(spec).name] = spec
+    return out
+
+
+def adapter_fingerprint(path: str | Path) -> dict:
+    """adapter 版本指纹：目录下文件名 + 大小 + mtime（与 evaluate_model.model_fingerprint 同口径）。"""
+    path = Path(path)
+    return {
+        "adapter": str(path),
+        "files": sorted(
+            (f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in path.iterdir() if f.is_file()
+        ),
+    }
+
+
+class AdapterRegistry:
+    """共享基座 + 懒加载 LoRA adapter，LRU 淘汰。"""
+
+    def __init__(
+        self,
+        base_model: str,
+        adapters: Dict[str, str] | None = None,
+        device: torch.device | str = "cpu",
+        max_loaded: int = 4,
+    ):
+        if max_loaded < 1:
+            raise ValueError("max_loaded must be >= 1")
+        self.base_model = base_model
+        self.device = torch.device(device)
+        self.max_loaded = max_loaded
+        self.paths: Dict[str, str] = dict(adapters or {})
+        self.loaded: "OrderedDict[str, None]" = OrderedDict()  # 按最近使用排序，末尾最新
+        self.active: str | None = None
+        self.lock = threading.RLock()
+        self.stats = {"hits": 0, "loads": 0, "evictions": 0, "load_seconds": 0.0}
+        self.base = AutoModelForCausalLM.from_pretrained(base_model)
+        self.base.to(self.device)
+        self.base.eval()
+        self.model = None  # 首个 adapter 加载后为 PeftModel
+
+    def register(self, adapter_id: str, path: str) -> None:
+        with self.lock:
+            if adapter_id in self.loaded and self.paths.get(adapter_id) != path:
+                self._unload(adapter_id)  # 同一 ID 换了目录，下次使用时重新加载
+            self.paths[adapter_id] = path
+
+    def _unload(self, adapter_id: str) -> None:
+        self.model.delete_adapter(adapter_id)
+        del self.loaded[adapter_id]
+        if self.active == adapter_id:
+            self.active = None
+        self.stats["evictions"] += 1
+
+    def _load(self, adapter_id: str) -> None:
+        from peft import PeftModel
+
+        path = self.paths[adapter_id]
+        t0 = time.perf_counter()
+        if self.model is None:
+            self.model = PeftModel.from_pretrained(self.base, path, adapter_name=adapter_id)
+        else:
+            self.model.load_adapter(path, adapter_name=adapter_id)
+        self.model.to(self.device)
+        self.model.eval()
+        self.stats["load_seconds"] += time.perf_counter() - t0
+        self.stats["loads"] += 1
+        self.loaded[adapter_id] = None
+
+    def activate(self, adapter_id: str):
+        """把 adapter 设为当前 adapter 并返回模型；未加载则加载，超出容量时卸载最久未用的。"""
+        with self.lock:
+            if adapter_id not in self.paths:
+                raise KeyError(f"unknown adapter: {adapter_id}")
+            if adapter_id in self.loaded:
+                self.stats["hits"] += 1
+                self.loaded.move_to_end(adapter_id)
+            else:
+                self._load(adapter_id)
+            if self.active != adapter_id:
+                self.model.set_adapter(adapter_id)
+                self.active = adapter_id
+            # 先切换再淘汰，被卸载的永远不是当前 adapter
+            while len(self.loaded) > self.max_loaded:
+                self._unload(next(iter(self.loaded)))
+            return self.model
+
+    def summary(self) -> dict:
+        return {
+            "registered": len(self.paths),
+            "loaded": list(self.loaded),
+            "max_loaded": self.max_loaded,
+            **self.stats,
+            "load_seconds": round(self.stats["load_seconds"], 3),
+        }
+
+
+def group_by_adapter(adapter_ids: Sequence[str]) -> Dict[str, List[int]]:
+    """adapter ID → 请求下标列表；组按首次出现的顺序排列。"""
+    groups: Dict[str, List[int]] = {}
+    for i, adapter_id in enumerate(adapter_ids):
+        groups.setdefault(adapter_id, []).append(i)
+    return groups
+
+
+def route(
+    registry: AdapterRegistry,
+    requests: Sequence[T],
+    fn: Callable[[object, List[T]], List[R]],
+    key: Callable[[T], str],
+) -> List[R]:
+    """按 key(request) 分组，每组激活一次 adapter 后调用 fn(model, batch)，结果按原顺序返回。"""
+    results: List[R] = [None] * len(requests)  # type: ignore[list-item]
+    for adapter_id, idx in group_by_adapter([key(r) for r in requests]).items():
+        with registry.lock:
+            model = registry.activate(adapter_id)
+            outputs = fn(model, [requests[i] for i in idx])
+        for i, out in zip(idx, outputs):
+            results[i] = out
+    return results
@@ -1,9 +1,23 @@
 """评测 LoRA/QLoRA 微调模型的最小可复现脚本。
 
 功能：
-1. 计算给定评测集的 Token-level Perplexity；
-2. 进行贪心生成并计算简单的 Exact Match（忽略首尾空白）；
-3. 导出逐条预测结果 JSON，便于手动复盘与误差分析。
+1. 计算给定评测集的 Token-level Perplexity（默认截断，`--batch-size` > 1 时按长度分桶批量前向；
+   `--ppl-mode sliding` 为带步长的滑动窗口，长样本不截断，窗口间复用上下文、只对新 token 计分，
+   并报告 tokens/sec）；
+2. 进行贪心生成并计算简单的 Exact Match（忽略首尾空白）；`--batch-size` > 1 时按长度排序、
+   左侧 padding 批量生成，逐行遇 EOS 或 `--stop` 字符串即停止并移出批次；
+3. 导出逐条预测报告（JSONL，每条预测完成即追加写出），便于手动复盘与误差分析；
+4. `--cache-file` 逐条结果缓存（key = hash(模型版本, 分词器, prompt/target, 生成与 PPL 配置)），
+   每条完成即追加写入，重跑或中断后续跑只评测新增/未完成的记录；
+5. `--num-workers` 多进程分片评测：每个进程加载一次模型并用 `torch.set_num_threads` 控制线程数，
+   结果汇总为同一份 token 加权 PPL / Exact Match 与同序报告。
+6. `--model-path` 为 `export_merged.py` 的导出目录时按其 export_config.json 加载（合并/量化模型）；
+   `--benchmark DIR ...` 在独立进程中逐个加载 `--model-path` 与给定模型，对比加载耗时、
+   常驻内存、贪心生成 tokens/sec 与前若干条样本的 PPL（如 adapter 目录 vs 合并导出目录）；
+7. `--adapter ID=PATH`（可重复）多 adapter 评测：`--model-path` 为基座，只加载一份基座权重，
+   adapter 经 `adapter_registry.AdapterRegistry` 懒加载、LRU 淘汰（`--max-loaded-adapters`）；
+   记录带 `adapter` 字段时只在该 adapter 上评测，否则在所有 adapter 上各评测一次；
+   同一 adapter 的记录分组批量评测，逐 adapter 汇总。
 
 示例运行：
 ```bash
@@ -12,18 +26,44 @@ python evaluate_model.py \
   --eval-file data/eval_sample.jsonl \
   --max-new-tokens 128 \
   --report-file outputs/eval_report.json
+
+# 长样本：滑动窗口 PPL（窗口 512，步长 256）
+python evaluate_model.py --model-path outputs/lora-tinyllama \
+  --eval-file data/eval_sample.jsonl --ppl-mode sliding --max-length 512 --stride 256
+
+# 50 个 adapter 共用一份基座：逐 adapter 汇总 PPL / Exact Match
+python evaluate_model.py --model-path TinyLlama/TinyLlama-1.1B-Chat-v1.0 --eval-file data/eval_sample.jsonl \
+  --adapter legal=outputs/lora-legal --adapter medical=outputs/lora-medical --max-loaded-adapters 4
+
+# 对比 adapter 与合并导出模型的加载与推理速度
+python evaluate_model.py --model-path outputs/lora-tinyllama --eval-file data/eval_sample.jsonl \
+  --benchmark outputs/merged-tinyllama outputs/merged-int8 --benchmark-samples 16 --max-new-tokens 32
 ```
 """
 
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
+import multiprocessing as mp
+import os
+import queue
+import resource
+import sys
+import time
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Iterable, List, Sequence, Tuple
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import torch.nn.functional as F
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+BASE = Path(__file__).resolve().parent
+sys.path.append(str(BASE))
+
+from adapter_registry import AdapterRegistry, adapter_fingerprint, group_by_adapter, parse_adapter_specs  # noqa: E402
+from export_merged import adapter_base, load_exported, read_export_config  # noqa: E402
 
 
 def read_jsonl(path: str | Path) -> List[dict]:
@@ -64,52 +104,313 @@ def format_prompt(record: dict) -> Tuple[str, str]:
     return prompt, output
 
 
+def sample_nll(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    prompt: str,
+    target: str,
+    device: torch.device,
+) -> Tuple[float, int]:
+    """单条样本的 NLL 之和与 target token 数（截断到 model_max_length）。"""
+
+    if not target:
+        return 0.0, 0
+    ((ids, prompt_len),) = encode_for_ppl(tokenizer, [(prompt, target)])
+    input_ids = torch.tensor([ids], dtype=torch.long, device=device)
+    attention_mask = torch.ones_like(input_ids)
+
+    labels = input_ids.clone()
+    labels[:, :prompt_len] = -100
+
+    target_tokens = (labels != -100).sum().item()
+    if target_tokens == 0:
+        return 0.0, 0
+
+    with torch.no_grad():
+        outputs = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            labels=labels,
+        )
+    return outputs.loss.item() * target_tokens, target_tokens
+
+
 def perplexity(
     model: AutoModelForCausalLM,
     tokenizer: AutoTokenizer,
     samples: Iterable[Tuple[str, str]],
     device: torch.device,
+    *,
+    batch_size: int = 1,
 ) -> float:
-    """计算平均 perplexity。"""
+    """计算平均 perplexity；batch_size > 1 时按长度分桶批量前向，结果与逐条一致。"""
 
-    total_log_likelihood = 0.0
-    total_tokens = 0
+    per_sample = score_nll(model, tokenizer, list(samples), device, batch_size=batch_size)
+    total_log_likelihood = sum(nll for nll, _ in per_sample)
+    total_tokens = sum(n for _, n in per_sample)
+    if total_tokens == 0:
+        raise ValueError("Evaluation set must contain at least one target token")
 
-    for prompt, target in samples:
-        if not target:
-            continue
-        prompt_ids = tokenizer(prompt, add_special_tokens=False).input_ids
-        batch = tokenizer(
-            prompt + target,
-            return_tensors="pt",
-            truncation=True,
-            max_length=tokenizer.model_max_length,
+    avg_loss = total_log_likelihood / total_tokens
+    return float(torch.exp(torch.tensor(avg_loss)))
+
+
+def encode_for_ppl(
+    tokenizer: AutoTokenizer,
+    samples: Iterable[Tuple[str, str]],
+) -> List[Tuple[List[int], int]]:
+    """一次性批量分词，返回 [(input_ids, prompt_len)]，跳过空 target。
+
+    prompt + target 截断到 model_max_length；prompt_len 为 prompt 部分（不含 special
+    tokens）的 token 数。快速分词器只对 prompt + target 分词一次，由 offset mapping
+    数出起点落在 prompt 内的 token；慢速分词器没有 offset，仍单独再对 prompt 分词。
+    """
+
+    pairs = [(prompt, target) for prompt, target in samples if target]
+    if not pairs:
+        return []
+    texts = [p + t for p, t in pairs]
+    if not getattr(tokenizer, "is_fast", False):
+        prompt_ids = tokenizer([p for p, _ in pairs], add_special_tokens=False).input_ids
+        full_ids = tokenizer(texts, truncation=True, max_length=tokenizer.model_max_length).input_ids
+        return [(ids, len(p_ids)) for ids, p_ids in zip(full_ids, prompt_ids)]
+
+    enc = tokenizer(
+        texts,
+        truncation=True,
+        max_length=tokenizer.model_max_length,
+        return_offsets_mapping=True,
+        return_special_tokens_mask=True,
+    )
+    encoded = []
+    for (prompt, _), ids, offsets, special in zip(
+        pairs, enc["input_ids"], enc["offset_mapping"], enc["special_tokens_mask"]
+    ):
+        prompt_chars = len(prompt)
+        prompt_len = sum(
+            1 for (start, _), is_special in zip(offsets, special) if not is_special and start < prompt_chars
         )
-        input_ids = batch["input_ids"].to(device)
-        attention_mask = batch["attention_mask"].to(device)
+        encoded.append((ids, prompt_len))
+    return encoded
 
-        labels = input_ids.clone()
-        labels[:, : len(prompt_ids)] = -100
+
+def batched_nll(
+    model: AutoModelForCausalLM,
+    encoded: List[Tuple[List[int], int]],
+    device: torch.device,
+    *,
+    pad_token_id: int,
+    batch_size: int = 8,
+) -> List[Tuple[float, int]]:
+    """按长度分桶批量前向，返回与 encoded 同序的逐条 (NLL 之和, target token 数)。
+
+    样本按长度排序后每 batch_size 条一桶，桶内右侧 padding 到最长，padding 与
+    prompt 位置的 label 均为 -100。逐条结果按 `perplexity` 的口径折算
+    （样本平均 loss × target token 数），因此汇总后与逐条前向一致。
+    """
+
+    results: List[Tuple[float, int]] = [(0.0, 0)] * len(encoded)
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i][0]))
+    for start in range(0, len(order), batch_size):
+        bucket = order[start : start + batch_size]
+        width = max(len(encoded[i][0]) for i in bucket)
+        input_ids = torch.full((len(bucket), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(bucket), width), dtype=torch.long)
+        labels = torch.full((len(bucket), width), -100, dtype=torch.long)
+        for row, i in enumerate(bucket):
+            ids, prompt_len = encoded[i]
+            n = len(ids)
+            input_ids[row, :n] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :n] = 1
+            if prompt_len < n:
+                labels[row, prompt_len:n] = input_ids[row, prompt_len:n]
 
         with torch.no_grad():
-            outputs = model(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                labels=labels,
-            )
+            logits = model(
+                input_ids=input_ids.to(device),
+                attention_mask=attention_mask.to(device),
+            ).logits
 
-        target_tokens = (labels != -100).sum().item()
-        if target_tokens == 0:
-            continue
+        shift_labels = labels[:, 1:].to(device)
+        token_nll = F.cross_entropy(
+            logits[:, :-1].float().transpose(1, 2),
+            shift_labels,
+            ignore_index=-100,
+            reduction="none",
+        )
+        nll_sum = token_nll.sum(dim=1).cpu()
+        scored = (shift_labels != -100).sum(dim=1).cpu()
+        target_tokens = (labels != -100).sum(dim=1)
+        for row, i in enumerate(bucket):
+            n_scored = int(scored[row])
+            n_target = int(target_tokens[row])
+            if n_scored == 0 or n_target == 0:
+                continue
+            results[i] = (float(nll_sum[row]) / n_scored * n_target, n_target)
+    return results
 
-        total_log_likelihood += outputs.loss.item() * target_tokens
-        total_tokens += target_tokens
 
-    if total_tokens == 0:
-        raise ValueError("Evaluation set must contain at least one target token")
+def sliding_window_nll(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    prompt: str,
+    target: str,
+    device: torch.device,
+    *,
+    max_length: int,
+    stride: int,
+) -> Tuple[float, int]:
+    """单条样本的滑动窗口 NLL，返回 (NLL 之和, 计分 token 数)。
 
-    avg_loss = total_log_likelihood / total_tokens
-    return float(torch.exp(torch.tensor(avg_loss)))
+    窗口长度 max_length，每次右移 stride：窗口前部与上一窗口重叠的部分只作上下文
+    （label=-100），只对新进入窗口的 target token 计分，因此每个 token 恰好计分一次，
+    且除第一个窗口外都至少带 max_length - stride 的上文。
+    """
+
+    prompt_ids = tokenizer(prompt, add_special_tokens=False).input_ids
+    input_ids = tokenizer(prompt + target, return_tensors="pt").input_ids[0]
+    labels = input_ids.clone()
+    labels[: len(prompt_ids)] = -100
+    seq_len = input_ids.shape[0]
+
+    nll_sum = 0.0
+    n_tokens = 0
+    prev_end = 0
+    for begin in range(0, seq_len, stride):
+        end = min(begin + max_length, seq_len)
+        window_labels = labels[begin:end].clone()
+        # 与上一窗口重叠的位置只当上下文
+        window_labels[: prev_end - begin] = -100
+        # 模型内部会右移 labels，窗口首位不会被预测
+        scored = int((window_labels[1:] != -100).sum())
+        prev_end = end
+        if scored > 0:
+            with torch.no_grad():
+                outputs = model(
+                    input_ids=input_ids[begin:end].unsqueeze(0).to(device),
+                    labels=window_labels.unsqueeze(0).to(device),
+                )
+            nll_sum += outputs.loss.item() * scored
+            n_tokens += scored
+        if end == seq_len:
+            break
+    return nll_sum, n_tokens
+
+
+def _truncate_at_stop(text: str, stop_strings: Sequence[str]) -> Tuple[str, bool]:
+    cut = min((text.find(stop) for stop in stop_strings if stop in text), default=-1)
+    if cut < 0:
+        return text, False
+    return text[:cut], True
+
+
+def _select_cache_rows(past_key_values, keep: torch.Tensor):
+    """只保留仍在生成的行；兼容 Cache 对象与旧版 tuple 格式。"""
+
+    if hasattr(past_key_values, "batch_select_indices"):
+        past_key_values.batch_select_indices(keep)
+        return past_key_values
+    return tuple(tuple(t[keep] for t in layer) for layer in past_key_values)
+
+
+def batched_greedy_generate(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    prompts: Sequence[str],
+    device: torch.device,
+    *,
+    max_new_tokens: int = 128,
+    batch_size: int = 8,
+    stop_strings: Sequence[str] = (),
+) -> List[str]:
+    """批量贪心生成，返回与 prompts 同序的文本。
+
+    - prompt 按 token 长度排序后分批，批内左侧 padding，position_ids 由 attention_mask 推出；
+    - 每行生成 EOS 或解码文本中出现任一 stop 字符串即结束，结果截断到 stop 之前；
+      stop 判断只解码末尾若干 token（见下），每步开销与已生成长度无关；
+    - 已结束的行立即从 input/attention_mask/KV cache 中移除，后续步只计算未结束的行。
+    """
+
+    eos_ids = set()
+    gen_eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+    for eos in (gen_eos, tokenizer.eos_token_id):
+        if isinstance(eos, int):
+            eos_ids.add(eos)
+        elif eos is not None:
+            eos_ids.update(eos)
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id or 0
+
+    # 上一步文本不含 stop，新出现的 stop 必以本步 token 结尾。非 special token 至少 1 字节、
+    # 每字符至多 4 字节，末尾 4 * 最长 stop 个 token 足以覆盖；再多留 2 个 token，
+    # 避免窗口开头的半个字符或被去掉的前导空格影响判断
+    tail = 4 * max((len(stop) for stop in stop_strings), default=0) + 2
+    special_ids = set(tokenizer.all_special_ids)
+
+    encoded = tokenizer(list(prompts)).input_ids
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+    results: List[str] = [""] * len(encoded)
+
+    for start in range(0, len(order), batch_size):
+        bucket = order[start : start + batch_size]
+        width = max(len(encoded[i]) for i in bucket)
+        input_ids = torch.full((len(bucket), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(bucket), width), dtype=torch.long)
+        for row, i in enumerate(bucket):
+            ids = encoded[i]
+            input_ids[row, width - len(ids) :] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, width - len(ids) :] = 1
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        active = list(bucket)  # 当前批中每行对应的原始下标
+        generated: dict = {i: [] for i in bucket}
+        visible: dict = {i: [] for i in bucket}  # 解码时不会跳过的 token，用于 stop 判断
+        past_key_values = None
+        for step in range(max_new_tokens):
+            with torch.no_grad():
+                outputs = model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+            past_key_values = outputs.past_key_values
+            next_tokens = outputs.logits[:, -1].argmax(dim=-1)
+
+            keep = []
+            for row, (i, tok) in enumerate(zip(active, next_tokens.tolist())):
+                if tok in eos_ids:
+                    continue
+                generated[i].append(tok)
+                if stop_strings and tok not in special_ids:
+                    visible[i].append(tok)
+                    text = tokenizer.decode(visible[i][-tail:], skip_special_tokens=True)
+                    if _truncate_at_stop(text, stop_strings)[1]:
+                        continue
+                keep.append(row)
+            if not keep or step == max_new_tokens - 1:
+                break
+            if len(keep) < len(active):
+                keep_idx = torch.tensor(keep, device=device)
+                past_key_values = _select_cache_rows(past_key_values, keep_idx)
+                attention_mask = attention_mask[keep_idx]
+                position_ids = position_ids[keep_idx]
+                next_tokens = next_tokens[keep_idx]
+                active = [active[row] for row in keep]
+            input_ids = next_tokens.unsqueeze(-1)
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1
+            )
+            position_ids = position_ids[:, -1:] + 1
+
+        for i in bucket:
+            text = tokenizer.decode(generated[i], skip_special_tokens=True)
+            results[i] = _truncate_at_stop(text, stop_strings)[0].strip()
+    return results
 
 
 def generate_and_score(
@@ -119,7 +420,20 @@ def generate_and_score(
     device: torch.device,
     *,
     max_new_tokens: int = 128,
+    batch_size: int = 1,
+    stop_strings: Sequence[str] = (),
 ) -> List[str]:
+    if batch_size > 1 or stop_strings:
+        return batched_greedy_generate(
+            model,
+            tokenizer,
+            list(prompts),
+            device,
+            max_new_tokens=max_new_tokens,
+            batch_size=batch_size,
+            stop_strings=stop_strings,
+        )
+
     generations: List[str] = []
     for prompt in prompts:
         inputs = tokenizer(prompt, return_tensors="pt").to(device)
@@ -136,6 +450,423 @@ def generate_and_score(
     return generations
 
 
+def model_fingerprint(model_path: str, config, tokenizer: AutoTokenizer) -> dict:
+    """模型/分词器版本指纹：Hub 模型用 commit hash，本地目录用文件名+大小+mtime。"""
+
+    fp = {
+        "model": model_path,
+        "revision": getattr(config, "_commit_hash", None),
+        "tokenizer": type(tokenizer).__name__,
+        "tokenizer_name": tokenizer.name_or_path,
+        "vocab_size": len(tokenizer),
+        "model_max_length": tokenizer.model_max_length,
+    }
+    path = Path(model_path)
+    if path.is_dir():
+        fp["files"] = sorted(
+            (f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in path.iterdir() if f.is_file()
+        )
+    return fp
+
+
+def record_key(fingerprint: dict, prompt: str, target: str, config: dict) -> str:
+    payload = json.dumps(
+        {"fp": fingerprint, "prompt": prompt, "target": target, "config": config},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """逐条评测结果缓存：JSONL 追加写，每条完成即落盘，中断后重跑自动跳过。
+
+    每行为 {"key", "nll", "ppl_tokens", "prediction"}；path 为 None 时仅在内存中缓存。
+    """
+
+    def __init__(self, path: str | Path | None = None):
+        self.path = Path(path) if path else None
+        self.entries: dict = {}
+        self.report: ReportWriter | None = None  # 设置后每条新结果同时写出报告行
+        self._needs_newline = False
+        if self.path and self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                text = f.read()
+            for line in text.splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:  # 中断时可能只写了半行
+                    continue
+                self.entries[obj["key"]] = obj
+            self._needs_newline = bool(text) and not text.endswith("\n")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __getitem__(self, key: str) -> dict:
+        return self.entries[key]
+
+    def add(self, key: str, result: dict) -> None:
+        entry = {"key": key, **result}
+        self.entries[key] = entry
+        if self.report is not None:
+            self.report.write(key, entry)
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            if self._needs_newline:
+                f.write("\n")
+                self._needs_newline = False
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class ReportWriter:
+    """逐条预测报告：JSONL 追加写，某个 key 的结果一出来就写出对应的记录行。
+
+    rows 为 (key, 报告行基础字段, 参考答案)；同 key 的重复记录各写一行。报告行按完成顺序写出，
+    `record_index` 为记录在评测集中的行号。打开时清空旧报告，已在缓存中的记录由
+    `write_cached` 先行写出。
+    """
+
+    def __init__(self, path: str | Path, rows: Iterable[Tuple[str, dict, str]]):
+        self.path = Path(path)
+        self.pending: dict = {}
+        for key, payload, gold in rows:
+            self.pending.setdefault(key, []).append((payload, gold))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text("", encoding="utf-8")
+
+    def write(self, key: str, result: dict) -> None:
+        rows = self.pending.pop(key, None)
+        if not rows:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            for payload, gold in rows:
+                row = dict(payload)
+                row["prediction"] = result["prediction"]
+                row["correct"] = result["prediction"].strip() == gold.strip()
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def write_cached(self, cache: ResultCache) -> None:
+        for key in [k for k in self.pending if k in cache]:
+            self.write(key, cache[key])
+
+
+def score_nll(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    samples: Sequence[Tuple[str, str]],
+    device: torch.device,
+    *,
+    ppl_mode: str = "truncate",
+    batch_size: int = 1,
+    max_length: int | None = None,
+    stride: int | None = None,
+) -> List[Tuple[float, int]]:
+    """逐条 (NLL 之和, 计分 token 数)，与 samples 同序；空 target 记为 (0.0, 0)。"""
+
+    if ppl_mode == "sliding":
+        # stride 需小于 max_length，否则窗口首个 token 没有上文、无法被计分
+        stride = stride or max(max_length // 2, 1)
+        if not 0 < stride < max_length:
+            raise ValueError("stride must be in (0, max_length)")
+        return [
+            sliding_window_nll(
+                model, tokenizer, prompt, target, device, max_length=max_length, stride=stride
+            )
+            if target
+            else (0.0, 0)
+            for prompt, target in samples
+        ]
+    if batch_size > 1:
+        pad_token_id = tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = tokenizer.eos_token_id or 0
+        kept = [i for i, (_, target) in enumerate(samples) if target]
+        encoded = encode_for_ppl(tokenizer, [samples[i] for i in kept])
+        results: List[Tuple[float, int]] = [(0.0, 0)] * len(samples)
+        for i, res in zip(
+            kept, batched_nll(model, encoded, device, pad_token_id=pad_token_id, batch_size=batch_size)
+        ):
+            results[i] = res
+        return results
+    return [sample_nll(model, tokenizer, prompt, target, device) for prompt, target in samples]
+
+
+def evaluate_pending(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    prompts_targets: Sequence[Tuple[str, str]],
+    keys: Sequence[str],
+    cache: ResultCache,
+    device: torch.device,
+    args: argparse.Namespace,
+) -> dict:
+    """评测 cache 中尚无结果的记录，每个小批完成即写入 cache。
+
+    返回本次新评测的统计：条数、计分 token 数、PPL 计算耗时。重复记录（同 key）只评测一次。
+    """
+
+    todo: List[int] = []
+    seen = set()
+    for i, key in enumerate(keys):
+        if key in cache or key in seen:
+            continue
+        seen.add(key)
+        todo.append(i)
+    # 按长度排序后分块，块内批量计算时 padding 更少
+    todo.sort(key=lambda i: len(prompts_targets[i][0]) + len(prompts_targets[i][1]))
+
+    chunk_size = max(args.batch_size, 1) * 4
+    ppl_seconds = 0.0
+    ppl_tokens = 0
+    for start in range(0, len(todo), chunk_size):
+        chunk = todo[start : start + chunk_size]
+        samples = [prompts_targets[i] for i in chunk]
+        t0 = time.perf_counter()
+        nlls = score_nll(
+            model,
+            tokenizer,
+            samples,
+            device,
+            ppl_mode=args.ppl_mode,
+            batch_size=args.batch_size,
+            max_length=args.max_length,
+            stride=args.stride,
+        )
+        ppl_seconds += time.perf_counter() - t0
+        predictions = generate_and_score(
+            model,
+            tokenizer,
+            [p for p, _ in samples],
+            device=device,
+            max_new_tokens=args.max_new_tokens,
+            batch_size=args.batch_size,
+            stop_strings=args.stop,
+        )
+        for i, (nll, n), prediction in zip(chunk, nlls, predictions):
+            cache.add(keys[i], {"nll": nll, "ppl_tokens": n, "prediction": prediction})
+            ppl_tokens += n
+    return {"samples": len(todo), "ppl_tokens": ppl_tokens, "ppl_seconds": ppl_seconds}
+
+
+class _QueueCache(ResultCache):
+    """工作进程内使用：结果不落盘，逐条发回主进程，由主进程统一写 cache。"""
+
+    def __init__(self, result_queue):
+        super().__init__(None)
+        self.result_queue = result_queue
+
+    def add(self, key: str, result: dict) -> None:
+        super().add(key, result)
+        self.result_queue.put(("result", key, result))
+
+
+def _shard_worker(
+    rank: int,
+    args: argparse.Namespace,
+    prompts_targets: List[Tuple[str, str]],
+    keys: List[str],
+    result_queue,
+) -> None:
+    torch.set_num_threads(args.threads_per_worker)
+    device = resolve_device(args.device)
+    tokenizer, model = load_model(args.model_path, device)
+    stats = evaluate_pending(
+        model, tokenizer, prompts_targets, keys, _QueueCache(result_queue), device, args
+    )
+    result_queue.put(("done", rank, stats))
+
+
+def evaluate_sharded(
+    prompts_targets: Sequence[Tuple[str, str]],
+    keys: Sequence[str],
+    cache: ResultCache,
+    args: argparse.Namespace,
+) -> dict:
+    """把未评测的记录分片到 args.num_workers 个进程，结果回传后由主进程写入 cache。
+
+    分片前按长度排序再轮询分配，各进程负载接近；返回的统计与 `evaluate_pending` 同结构，
+    ppl_seconds 取各进程最大值（近似墙钟时间）。
+    """
+
+    todo: List[int] = []
+    seen = set()
+    for i, key in enumerate(keys):
+        if key in cache or key in seen:
+            continue
+        seen.add(key)
+        todo.append(i)
+    todo.sort(key=lambda i: len(prompts_targets[i][0]) + len(prompts_targets[i][1]))
+    shards = [todo[rank :: args.num_workers] for rank in range(args.num_workers)]
+    shards = [shard for shard in shards if shard]
+    if not shards:
+        return {"samples": 0, "ppl_tokens": 0, "ppl_seconds": 0.0}
+
+    ctx = mp.get_context("spawn")
+    result_queue = ctx.Queue()
+    procs = [
+        ctx.Process(
+            target=_shard_worker,
+            args=(
+                rank,
+                args,
+                [prompts_targets[i] for i in shard],
+                [keys[i] for i in shard],
+                result_queue,
+            ),
+        )
+        for rank, shard in enumerate(shards)
+    ]
+    for proc in procs:
+        proc.start()
+
+    merged = {"samples": 0, "ppl_tokens": 0, "ppl_seconds": 0.0}
+    pending = len(procs)
+    try:
+        while pending:
+            try:
+                msg = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                failed = [p for p in procs if p.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError(f"evaluation worker exited with code {failed[0].exitcode}")
+                continue
+            if msg[0] == "result":
+                cache.add(msg[1], msg[2])
+            else:
+                stats = msg[2]
+                merged["samples"] += stats["samples"]
+                merged["ppl_tokens"] += stats["ppl_tokens"]
+                merged["ppl_seconds"] = max(merged["ppl_seconds"], stats["ppl_seconds"])
+                pending -= 1
+    finally:
+        for proc in procs:
+            if pending:
+                proc.terminate()
+            proc.join()
+    return merged
+
+
+def resolve_device(name: str | None) -> torch.device:
+    if name:
+        return torch.device(name)
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
+        return torch.device("mps")
+    return torch.device("cpu")
+
+
+def load_tokenizer(model_path: str) -> AutoTokenizer:
+    path = Path(model_path)
+    if (path / "adapter_config.json").exists() and not (path / "tokenizer_config.json").exists():
+        model_path = adapter_base(path)  # 只含 adapter 的目录沿用基座分词器
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def load_model(model_path: str, device: torch.device) -> Tuple[AutoTokenizer, AutoModelForCausalLM]:
+    tokenizer = load_tokenizer(model_path)
+    if read_export_config(model_path) is not None:
+        return tokenizer, load_exported(model_path, device)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+    model.to(device)
+    model.eval()
+    return tokenizer, model
+
+
+def _rss_mb() -> float:
+    """当前常驻内存；/proc 不可用时退回进程峰值 RSS。"""
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except (OSError, ValueError, AttributeError):
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _benchmark_worker(
+    model_path: str,
+    args: argparse.Namespace,
+    prompts_targets: List[Tuple[str, str]],
+    result_queue,
+) -> None:
+    if args.threads_per_worker:
+        torch.set_num_threads(args.threads_per_worker)
+    device = resolve_device(args.device)
+    rss_before = _rss_mb()
+    t0 = time.perf_counter()
+    tokenizer, model = load_model(model_path, device)
+    load_seconds = time.perf_counter() - t0
+    rss_loaded = _rss_mb()
+
+    def generate(prompt: str) -> int:
+        inputs = tokenizer(prompt, return_tensors="pt").to(device)
+        with torch.no_grad():
+            output = model.generate(
+                **inputs,
+                max_new_tokens=args.max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+        return output.shape[-1] - inputs["input_ids"].shape[-1]
+
+    if prompts_targets:
+        generate(prompts_targets[0][0])  # 预热一次（首次调用的分配与调度开销不计入吞吐）
+    new_tokens = 0
+    t0 = time.perf_counter()
+    for prompt, _ in prompts_targets:
+        new_tokens += generate(prompt)
+    gen_seconds = time.perf_counter() - t0
+
+    result_queue.put({
+        "model": model_path,
+        "export": read_export_config(model_path),
+        "load_seconds": round(load_seconds, 3),
+        "rss_mb_loaded": rss_loaded,
+        "rss_mb_model": round(rss_loaded - rss_before, 1),
+        "rss_mb_after_generate": _rss_mb(),
+        "generated_tokens": new_tokens,
+        "gen_tokens_per_sec": round(new_tokens / gen_seconds, 1) if gen_seconds > 0 else None,
+        "perplexity": perplexity(model, tokenizer, prompts_targets, device, batch_size=args.batch_size),
+    })
+
+
+def benchmark_models(
+    model_paths: Sequence[str],
+    prompts_targets: Sequence[Tuple[str, str]],
+    args: argparse.Namespace,
+) -> List[dict]:
+    """逐个在全新 spawn 进程中加载并测速，加载耗时与常驻内存互不干扰（顺序执行，不抢 CPU）。"""
+    if not prompts_targets:
+        raise ValueError("benchmark needs at least one sample (check --benchmark-samples and --eval-file)")
+
+    ctx = mp.get_context("spawn")
+    results = []
+    for path in model_paths:
+        result_queue = ctx.Queue()
+        proc = ctx.Process(target=_benchmark_worker, args=(path, args, list(prompts_targets), result_queue))
+        proc.start()
+        try:
+            while True:
+                try:
+                    results.append(result_queue.get(timeout=1.0))
+                    break
+                except queue.Empty:
+                    if proc.exitcode not in (None, 0):
+                        raise RuntimeError(f"benchmark worker for {path} exited with code {proc.exitcode}")
+        finally:
+            proc.join()
+    return results
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Evaluate fine-tuned causal LM")
     parser.add_argument("--model-path", required=True, help="本地模型路径或 HF Hub 名称")
@@ -145,69 +876,244 @@ def parse_args() -> argparse.Namespace:
         "--report-file",
         type=str,
         default=None,
-        help="可选，输出逐条预测的 JSON 报告",
+        help="可选，逐条预测报告（JSONL，每条完成即追加一行）",
     )
     parser.add_argument("--device", type=str, default=None, help="强制指定设备 (cpu/cuda/mps)")
+    parser.add_argument(
+        "--ppl-mode",
+        choices=["truncate", "sliding"],
+        default="truncate",
+        help="truncate: 截断到 model_max_length；sliding: 带步长的滑动窗口",
+    )
+    parser.add_argument(
+        "--max-length",
+        type=int,
+        default=None,
+        help="滑动窗口长度，默认取 tokenizer/模型支持的最大长度",
+    )
+    parser.add_argument("--stride", type=int, default=None, help="滑动窗口步长，默认窗口长度的一半")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="批大小；>1 时按长度分桶批量计算截断模式 PPL 并批量贪心生成",
+    )
+    parser.add_argument(
+        "--cache-file",
+        type=str,
+        default=None,
+        help="可选，逐条结果缓存 JSONL；每条完成即追加，重跑时跳过已评测记录",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=1,
+        help="评测进程数；>1 时按记录分片到多个进程（每个进程各加载一次模型），适合多核 CPU",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="每个进程的 torch 线程数，默认 CPU 核数 / num-workers",
+    )
+    parser.add_argument(
+        "--stop",
+        action="append",
+        default=[],
+        help="生成停止字符串，可重复指定，如 --stop '### Instruction:'",
+    )
+    parser.add_argument(
+        "--adapter",
+        action="append",
+        default=[],
+        help="多 adapter 评测：ID=PATH、adapter 目录或 {ID: PATH} JSON，可重复；此时 --model-path 为基座",
+    )
+    parser.add_argument(
+        "--max-loaded-adapters",
+        type=int,
+        default=4,
+        help="同时挂在基座上的 adapter 数上限，超出时卸载最久未用的",
+    )
+    parser.add_argument(
+        "--benchmark",
+        nargs="+",
+        default=None,
+        help="与 --model-path 对比加载耗时、常驻内存与生成吞吐的模型目录（如合并导出目录）",
+    )
+    parser.add_argument(
+        "--benchmark-samples",
+        type=int,
+        default=16,
+        help="benchmark 使用的评测样本数（取评测集前 N 条）",
+    )
     return parser.parse_args()
 
 
-def main() -> None:
-    args = parse_args()
-
-    if args.device:
-        device = torch.device(args.device)
-    else:
-        if torch.cuda.is_available():
-            device = torch.device("cuda")
-        elif getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
-            device = torch.device("mps")
-        else:
-            device = torch.device("cpu")
-
-    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
+def build_run_config(args: argparse.Namespace, tokenizer: AutoTokenizer, config) -> dict:
+    """补全滑动窗口参数，返回进入缓存 key 的配置（batch_size 不影响结果，不计入）。"""
 
-    model = AutoModelForCausalLM.from_pretrained(args.model_path)
-    model.to(device)
-    model.eval()
+    if args.ppl_mode == "sliding":
+        args.max_length = args.max_length or min(
+            tokenizer.model_max_length,
+            getattr(config, "max_position_embeddings", tokenizer.model_max_length),
+        )
+        args.stride = args.stride or max(args.max_length // 2, 1)
+    return {
+        "max_new_tokens": args.max_new_tokens,
+        "stop": list(args.stop),
+        "ppl_mode": args.ppl_mode,
+        "max_length": args.max_length,
+        "stride": args.stride,
+    }
 
-    records = read_jsonl(args.eval_file)
-    prompts_targets = [format_prompt(r) for r in records]
 
-    ppl = perplexity(model, tokenizer, prompts_targets, device=device)
+def summarize_results(
+    results: Sequence[dict],
+    prompts_targets: Sequence[Tuple[str, str]],
+    fresh: dict,
+    args: argparse.Namespace,
+) -> dict:
+    """token 加权 PPL + Exact Match（忽略首尾空白）。"""
 
-    prompts_only = [p for p, _ in prompts_targets]
-    predictions = generate_and_score(
-        model,
-        tokenizer,
-        prompts_only,
-        device=device,
-        max_new_tokens=args.max_new_tokens,
-    )
+    total_log_likelihood = sum(r["nll"] for r in results)
+    ppl_tokens = sum(r["ppl_tokens"] for r in results)
+    if ppl_tokens == 0:
+        raise ValueError("Evaluation set must contain at least one target token")
+    ppl = float(torch.exp(torch.tensor(total_log_likelihood / ppl_tokens)))
 
     gold_answers = [t.strip() for _, t in prompts_targets]
-    correct = sum(1 for pred, gold in zip(predictions, gold_answers) if pred.strip() == gold)
+    correct = sum(1 for r, gold in zip(results, gold_answers) if r["prediction"].strip() == gold)
     total = len(gold_answers)
-    exact_match = correct / total if total else 0.0
-
     summary = {
         "perplexity": ppl,
-        "exact_match": exact_match,
+        "exact_match": correct / total if total else 0.0,
         "total_samples": total,
     }
+    if args.ppl_mode == "sliding":
+        summary.update({
+            "ppl_mode": "sliding",
+            "ppl_max_length": args.max_length,
+            "ppl_stride": args.stride,
+            "ppl_tokens": ppl_tokens,
+            "ppl_tokens_per_sec": (
+                fresh["ppl_tokens"] / fresh["ppl_seconds"] if fresh["ppl_seconds"] > 0 else None
+            ),
+        })
+    return summary
 
-    print(json.dumps(summary, ensure_ascii=False, indent=2))
 
+def evaluate_adapters(args: argparse.Namespace) -> None:
+    """多 adapter 评测：一份基座 + LRU adapter 注册表，按 adapter 分组评测并逐 adapter 汇总。"""
+
+    if args.num_workers > 1:
+        raise ValueError("--adapter evaluation runs in a single process; drop --num-workers")
+    device = resolve_device(args.device)
+    tokenizer = load_tokenizer(args.model_path)
+    registry = AdapterRegistry(
+        args.model_path, parse_adapter_specs(args.adapter), device, max_loaded=args.max_loaded_adapters
+    )
+    records = read_jsonl(args.eval_file)
+    prompts_targets = [format_prompt(r) for r in records]
+
+    # 路由：带 adapter 字段的记录只评测该 adapter，其余记录在每个 adapter 上各评测一次
+    jobs: List[Tuple[str, int]] = []
+    for i, record in enumerate(records):
+        targets = [record["adapter"]] if record.get("adapter") else list(registry.paths)
+        jobs.extend((adapter_id, i) for adapter_id in targets)
+    unknown = {a for a, _ in jobs} - set(registry.paths)
+    if unknown:
+        raise KeyError(f"records reference unregistered adapters: {sorted(unknown)}")
+
+    base_fp = model_fingerprint(args.model_path, registry.base.config, tokenizer)
+    run_config = build_run_config(args, tokenizer, registry.base.config)
+    adapter_fps = {a: adapter_fingerprint(p) for a, p in registry.paths.items()}
+    keys = [
+        record_key({**base_fp, "adapter": adapter_fps[a]}, *prompts_targets[i], run_config) for a, i in jobs
+    ]
+    cache = ResultCache(args.cache_file)
+    if args.report_file:
+        cache.report = ReportWriter(
+            args.report_file,
+            (
+                (key, {**records[i], "adapter": adapter_id, "record_index": i}, prompts_targets[i][1])
+                for (adapter_id, i), key in zip(jobs, keys)
+            ),
+        )
+        cache.report.write_cached(cache)
+
+    per_adapter = {}
+    for adapter_id, idx in group_by_adapter([a for a, _ in jobs]).items():
+        group_pt = [prompts_targets[jobs[j][1]] for j in idx]
+        group_keys = [keys[j] for j in idx]
+        fresh = {"samples": 0, "ppl_tokens": 0, "ppl_seconds": 0.0}
+        if any(k not in cache for k in group_keys):  # 全部命中缓存时不必加载该 adapter
+            model = registry.activate(adapter_id)
+            fresh = evaluate_pending(model, tokenizer, group_pt, group_keys, cache, device, args)
+        per_adapter[adapter_id] = summarize_results([cache[k] for k in group_keys], group_pt, fresh, args)
+        per_adapter[adapter_id]["evaluated_samples"] = fresh["samples"]
+
+    print(json.dumps({"adapters": per_adapter, "registry": registry.summary()}, ensure_ascii=False, indent=2))
+
+
+def main() -> None:
+    args = parse_args()
+
+    if args.adapter:
+        evaluate_adapters(args)
+        return
+
+    if args.benchmark:
+        if args.benchmark_samples < 1:
+            raise ValueError("--benchmark-samples must be >= 1")
+        samples = [format_prompt(r) for r in read_jsonl(args.eval_file)[: args.benchmark_samples]]
+        results = benchmark_models([args.model_path, *args.benchmark], samples, args)
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        if args.report_file:
+            Path(args.report_file).parent.mkdir(parents=True, exist_ok=True)
+            Path(args.report_file).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+        return
+
+    if args.num_workers > 1:
+        # 主进程只需分词器与配置来计算缓存 key，模型只在工作进程中加载
+        tokenizer = load_tokenizer(args.model_path)
+        config = AutoConfig.from_pretrained(args.model_path)
+        model = device = None
+        if args.threads_per_worker is None:
+            args.threads_per_worker = max(1, (os.cpu_count() or 1) // args.num_workers)
+    else:
+        device = resolve_device(args.device)
+        tokenizer, model = load_model(args.model_path, device)
+        config = model.config
+
+    records = read_jsonl(args.eval_file)
+    prompts_targets = [format_prompt(r) for r in records]
+
+    fingerprint = model_fingerprint(args.model_path, config, tokenizer)
+    run_config = build_run_config(args, tokenizer, config)
+    keys = [record_key(fingerprint, p, t, run_config) for p, t in prompts_targets]
+    cache = ResultCache(args.cache_file)
+    cached_samples = sum(1 for k in keys if k in cache)
     if args.report_file:
-        report_path = Path(args.report_file)
-        report_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(report_path, "w", encoding="utf-8") as f:
-            for record, prediction in zip(records, predictions):
-                payload = dict(record)
-                payload["prediction"] = prediction
-                payload["correct"] = prediction.strip() == record.get("expected", record.get("output", "")).strip()
-                f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        cache.report = ReportWriter(
+            args.report_file,
+            (
+                (key, {**record, "record_index": i}, record.get("expected", record.get("output", "")))
+                for i, (record, key) in enumerate(zip(records, keys))
+            ),
+        )
+        cache.report.write_cached(cache)
+
+    if args.num_workers > 1:
+        fresh = evaluate_sharded(prompts_targets, keys, cache, args)
+    else:
+        fresh = evaluate_pending(model, tokenizer, prompts_targets, keys, cache, device, args)
+    results = [cache[k] for k in keys]
+
+    summary = summarize_results(results, prompts_targets, fresh, args)
+    if args.cache_file:
+        summary["cached_samples"] = cached_samples
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
 
 
 if __name__ == "__main__":
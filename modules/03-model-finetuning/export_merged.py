@@ -0,0 +1,186 @@
+"""把 LoRA adapter 合并进基座模型并导出为 safetensors，推理时直接加载、无需 PEFT 间接层。
+
+- 合并：`merge_and_unload` 把 B·A·(alpha/r) 加回每个被注入的 Linear，去掉 lora_A/lora_B 分支，
+  推理时每层少两次小矩阵乘；
+- `--dtype bf16|fp16`：合并后整体转换精度再保存（加载体积减半）；
+- `--quantize int8`：decoder 层内 Linear 权重按输出通道对称量化为 int8 + fp32 scale 存储，
+  加载时反量化到 `--dtype`（磁盘与读取量约为 fp32 的 1/4，计算精度不变）；
+- `--quantize dynamic`：仍保存浮点权重，加载时用 `torch.ao.quantization.quantize_dynamic`
+  把 Linear 换成 int8 动态量化实现（仅 CPU，激活按批动态量化）。
+
+导出目录包含 config.json、分词器、model.safetensors（可 mmap 加载）与 `export_config.json`；
+`load_exported` 按后者还原，`evaluate_model.py` 遇到该文件时自动改用它加载。
+
+示例：
+```
+python export_merged.py --adapter outputs/lora-tinyllama --output outputs/merged-tinyllama
+python export_merged.py --adapter outputs/lora-tinyllama --output outputs/merged-int8 --quantize int8
+```
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Dict, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+EXPORT_CONFIG = "export_config.json"
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+SCALE_SUFFIX = ".int8_scale"
+
+
+def adapter_base(adapter_dir: str | Path) -> str:
+    cfg = json.loads((Path(adapter_dir) / "adapter_config.json").read_text(encoding="utf-8"))
+    return cfg["base_model_name_or_path"]
+
+
+def merge_adapter(adapter_dir: str | Path, base: str | None = None):
+    """加载 fp32 基座 + adapter 并合并；在 fp32 下合并，避免低精度累加误差。"""
+    from peft import PeftModel
+
+    base = base or adapter_base(adapter_dir)
+    model = AutoModelForCausalLM.from_pretrained(base, dtype=torch.float32)
+    model = PeftModel.from_pretrained(model, str(adapter_dir))
+    return model.merge_and_unload(), base
+
+
+def _int8_targets(model) -> Dict[str, torch.nn.Linear]:
+    """decoder 层内的 Linear；embedding 与 lm_head 对量化误差更敏感，保持浮点。"""
+    return {
+        f"{name}.weight": module
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and ".layers." in f".{name}"
+    }
+
+
+def quantize_int8(weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """按输出通道（行）对称量化：w ≈ q * scale，q ∈ [-127, 127]。"""
+    w = weight.detach().float()
+    scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    q = torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scale
+
+
+def int8_state_dict(model, dtype: torch.dtype) -> Dict[str, torch.Tensor]:
+    """量化目标权重存为 int8 + scale，其余张量转为 dtype；共享存储（tied）的张量只保留一份。"""
+    targets = _int8_targets(model)
+    out: Dict[str, torch.Tensor] = {}
+    seen = set()
+    for name, tensor in model.state_dict().items():
+        ptr = tensor.data_ptr()
+        if ptr in seen:
+            continue
+        seen.add(ptr)
+        if name in targets:
+            q, scale = quantize_int8(tensor)
+            out[name] = q
+            out[name + SCALE_SUFFIX] = scale
+        else:
+            out[name] = tensor.detach().to(dtype) if tensor.is_floating_point() else tensor.detach()
+        out[name] = out[name].contiguous()
+    return out
+
+
+def export_merged(
+    adapter_dir: str | Path,
+    output_dir: str | Path,
+    *,
+    base: str | None = None,
+    dtype: str = "fp32",
+    quantize: str = "none",
+) -> dict:
+    if quantize == "dynamic" and dtype != "fp32":
+        raise ValueError("dynamic quantization works on fp32 weights, use --dtype fp32")
+    t0 = time.perf_counter()
+    model, base = merge_adapter(adapter_dir, base)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if quantize == "int8":
+        model.config.save_pretrained(output_dir)
+        state = int8_state_dict(model, DTYPES[dtype])
+        save_file(state, str(output_dir / "model.safetensors"), metadata={"format": "pt"})
+    else:
+        model.to(DTYPES[dtype]).save_pretrained(output_dir, safe_serialization=True)
+
+    tok_source = adapter_dir if (Path(adapter_dir) / "tokenizer_config.json").exists() else base
+    AutoTokenizer.from_pretrained(tok_source).save_pretrained(output_dir)
+
+    meta = {"base": base, "adapter": str(adapter_dir), "dtype": dtype, "quantize": quantize}
+    (output_dir / EXPORT_CONFIG).write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    size = sum(f.stat().st_size for f in output_dir.glob("*.safetensors"))
+    return {**meta, "output": str(output_dir), "safetensors_mb": round(size / 2**20, 2),
+            "seconds": round(time.perf_counter() - t0, 2)}
+
+
+def read_export_config(model_dir: str | Path) -> dict | None:
+    path = Path(model_dir) / EXPORT_CONFIG
+    return json.loads(path.read_text(encoding="utf-8")) if path.exists() else None
+
+
+def _load_int8(model_dir: Path, dtype: torch.dtype):
+    config = AutoConfig.from_pretrained(model_dir)
+    model = AutoModelForCausalLM.from_config(config, dtype=dtype)
+    state: Dict[str, torch.Tensor] = {}
+    with safe_open(str(model_dir / "model.safetensors"), framework="pt") as f:  # mmap，逐张量读取
+        keys = set(f.keys())
+        for name in keys:
+            if name.endswith(SCALE_SUFFIX):
+                continue
+            tensor = f.get_tensor(name)
+            if name + SCALE_SUFFIX in keys:
+                tensor = tensor.float() * f.get_tensor(name + SCALE_SUFFIX)[:, None]
+            state[name] = tensor.to(dtype) if tensor.is_floating_point() else tensor
+    missing, unexpected = model.load_state_dict(state, strict=False)
+    model.tie_weights()
+    # 导出时共享存储的 lm_head 只存了一份（见 int8_state_dict），tie_weights 会补上；其余缺失说明文件不完整
+    tied = {"lm_head.weight"} if getattr(config, "tie_word_embeddings", False) else set()
+    missing = [name for name in missing if name not in tied]
+    if missing:
+        raise ValueError(f"missing tensors in {model_dir}: {missing[:5]}")
+    if unexpected:
+        raise ValueError(f"unexpected tensors in {model_dir}: {unexpected[:5]}")
+    return model
+
+
+def load_exported(model_dir: str | Path, device: torch.device | str = "cpu"):
+    """按 export_config.json 加载导出目录，返回 eval 模式的模型。"""
+    model_dir = Path(model_dir)
+    meta = read_export_config(model_dir) or {"dtype": "fp32", "quantize": "none"}
+    dtype = DTYPES[meta["dtype"]]
+    if meta["quantize"] == "int8":
+        model = _load_int8(model_dir, dtype)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_dir, dtype=dtype)
+    if meta["quantize"] == "dynamic":
+        if torch.device(device).type != "cpu":
+            raise ValueError("dynamic int8 quantization only runs on CPU")
+        from torch.ao.quantization import quantize_dynamic
+
+        model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Merge a LoRA adapter into its base model and export safetensors")
+    ap.add_argument("--adapter", required=True, help="finetune_lora.py 的输出目录")
+    ap.add_argument("--output", required=True)
+    ap.add_argument("--base", default=None, help="基座模型，默认取 adapter_config.json 中的路径")
+    ap.add_argument("--dtype", choices=list(DTYPES), default="fp32")
+    ap.add_argument("--quantize", choices=["none", "int8", "dynamic"], default="none")
+    args = ap.parse_args()
+
+    stats = export_merged(args.adapter, args.output, base=args.base, dtype=args.dtype, quantize=args.quantize)
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
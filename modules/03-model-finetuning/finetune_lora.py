@@ -2,22 +2,64 @@
 
 Requirements: transformers, peft, datasets, accelerate, bitsandbytes (optional)
 This is a teaching-oriented script; tune hyperparameters and add eval as needed.
+
+吞吐相关选项：
+- `--packing`：样本截断到 `--max-length` 后按 First-Fit-Decreasing 拼成定长块，
+  每段的 position_ids 从 0 重新计数（transformers 据此构造块对角因果 mask，段间互不可见），
+  段首 token 不计 loss，避免跨样本预测；
+- `--group-by-length`：不打包时按长度分组采样，批内长度接近，减少 padding；
+- 日志额外输出 `tokens_per_sec`（有效 token）与 `padding_ratio`，便于同一硬件上对比。
+
+`--response-only`：只在回答部分计算 loss。分词时（批量、`--num-proc` 多进程 map）
+一次性算出每条样本的 prompt 长度 `prompt_len`（packing 时为每段的 `prompt_lens`），
+collator 据此把 prompt 位置的 label 置为 -100；口径与 `evaluate_model.sample_nll` 相同
+（prompt 单独分词、不加 special tokens 计长度）。
+
+`--token-cache DIR`：分词结果按 (训练文件内容哈希, 分词器名称与指纹, 模板, max_length,
+response_only) 缓存到磁盘：扁平 token id 数组 + offsets 索引（+ prompt 长度、packing 方案），
+以 np.memmap 只读打开。数据与分词器不变时再次训练跳过 load_dataset/map，几秒内开始训练，
+token 数据按需从页缓存读取，几乎不占额外内存。
+
+训练速度相关开关（逐项打开、用 `--profile-trace` 对比，由数据决定哪些值得开）：
+- `--precision bf16|fp16`：混合精度；bf16 在 CPU 上需要 oneDNN bf16 支持（AVX512-BF16/AMX），
+  不支持时退回 fp32 并提示；fp16 只用于 CUDA；
+- `--gradient-checkpointing`：以重算换显存/内存，单步更慢但可开更大 batch；
+- `--dataloader-workers N`：collate 放到子进程，与计算重叠；
+- `--torch-compile`：首步编译较慢（trace 汇总默认跳过第 1 步）；批内长度变化会触发重新编译，
+  建议配合 `--packing` 并调大 `--profile-warmup`；
+- `--num-threads N`：CPU 上 intra-op 线程数。
+
+`--profile-trace PATH`：每个优化步写一行 JSONL（step_time 拆分为 data_wait / forward /
+backward / optimizer / other，有效 token 吞吐与峰值内存），首行为本次配置，末行为汇总。
 """
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import resource
+import shutil
+import time
 from dataclasses import dataclass
-from typing import Dict
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Tuple
 
+import numpy as np
+import torch
 from datasets import load_dataset
 from peft import LoraConfig, get_peft_model
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     Trainer,
+    TrainerCallback,
     TrainingArguments,
-    DataCollatorForLanguageModeling,
 )
+from transformers.trainer_pt_utils import LengthGroupedSampler
+
+IGNORE_INDEX = -100
 
 
 @dataclass
@@ -31,9 +73,24 @@ class Args:
     lora_r: int = 8
     lora_alpha: int = 16
     lora_dropout: float = 0.05
+    max_length: int = 1024
+    packing: bool = False
+    response_only: bool = False
+    num_proc: int | None = None
+    group_by_length: bool = False
+    logging_steps: int = 10
+    token_cache: str | None = None
+    precision: str = "fp32"
+    gradient_checkpointing: bool = False
+    dataloader_workers: int = 0
+    torch_compile: bool = False
+    num_threads: int | None = None
+    profile_trace: str | None = None
+    profile_warmup: int = 1
 
 
-def format_sample(rec: Dict[str, str]) -> str:
+def split_sample(rec: Dict[str, str]) -> Tuple[str, str]:
+    """训练模板拆成 (prompt, response)。"""
     inst = rec.get("instruction", "")
     inp = rec.get("input", "")
     out = rec.get("output", "")
@@ -41,9 +98,577 @@ def format_sample(rec: Dict[str, str]) -> str:
         prompt = f"指令：{inst}\n输入：{inp}\n回答："
     else:
         prompt = f"指令：{inst}\n回答："
+    return prompt, out
+
+
+def format_sample(rec: Dict[str, str]) -> str:
+    prompt, out = split_sample(rec)
     return prompt + out
 
 
+def tokenize_batch(batch: Dict[str, list], tok, max_length: int, response_only: bool = False) -> Dict[str, list]:
+    """batched map：按训练模板分词并截断到 max_length。
+
+    response_only 时额外返回 prompt_len，并丢弃截断后已没有回答 token 的样本。
+    """
+    n = len(next(iter(batch.values())))
+    records = [{k: batch[k][i] for k in batch} for i in range(n)]
+    pairs = [split_sample(rec) for rec in records]
+    ids = tok([p + r for p, r in pairs], truncation=True, max_length=max_length).input_ids
+    if not response_only:
+        return {"input_ids": ids, "length": [len(x) for x in ids]}
+    prompt_lens = [len(x) for x in tok([p for p, _ in pairs], add_special_tokens=False).input_ids]
+    keep = [i for i in range(n) if prompt_lens[i] < len(ids[i])]
+    return {
+        "input_ids": [ids[i] for i in keep],
+        "length": [len(ids[i]) for i in keep],
+        "prompt_len": [prompt_lens[i] for i in keep],
+    }
+
+
+def plan_packing(lengths: Sequence[int], max_length: int) -> List[List[int]]:
+    """First-Fit-Decreasing：返回每个块包含的样本下标（长度 0 的样本跳过，超长按 max_length 计）。"""
+    blocks: List[List[int]] = []
+    free: List[int] = []
+    order = sorted((i for i, n in enumerate(lengths) if n), key=lambda i: lengths[i], reverse=True)
+    for i in order:
+        n = min(lengths[i], max_length)
+        for b, room in enumerate(free):
+            if room >= n:
+                blocks[b].append(i)
+                free[b] -= n
+                break
+        else:
+            blocks.append([i])
+            free.append(max_length - n)
+    return blocks
+
+
+def pack_sequences(batch: Dict[str, list], max_length: int) -> Dict[str, list]:
+    """batched map：把一批样本按 First-Fit-Decreasing 装进长度 ≤ max_length 的块。
+
+    返回每块拼接后的 input_ids、各段长度 seq_lens 与块长 length；
+    输入带 prompt_len 时同时返回每段的 prompt_lens。
+    """
+    seqs = [ids[:max_length] for ids in batch["input_ids"]]
+    blocks = plan_packing([len(x) for x in seqs], max_length)
+    out = {
+        "input_ids": [[t for i in block for t in seqs[i]] for block in blocks],
+        "seq_lens": [[len(seqs[i]) for i in block] for block in blocks],
+        "length": [sum(len(seqs[i]) for i in block) for block in blocks],
+    }
+    if "prompt_len" in batch:
+        out["prompt_lens"] = [[batch["prompt_len"][i] for i in block] for block in blocks]
+    return out
+
+
+PACK_BATCH = 1000  # 与 datasets map 的默认 batch_size 一致：packing 只在每 1000 条内进行
+
+
+def file_digest(path: str | Path, chunk_bytes: int = 8 << 20) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tokenizer_fingerprint(tok) -> str:
+    """分词器指纹：类名 + 词表大小 + 序列化后的 tokenizer.json 摘要。"""
+    h = hashlib.sha256()
+    h.update(f"{type(tok).__name__}|{len(tok)}".encode("utf-8"))
+    backend = getattr(tok, "backend_tokenizer", None)
+    h.update((backend.to_str() if backend is not None else tok.name_or_path).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def template_fingerprint() -> str:
+    """用占位符渲染模板的两个分支，模板文字一改指纹即变。"""
+    probe = [
+        split_sample({"instruction": "{i}", "input": "{x}", "output": "{o}"}),
+        split_sample({"instruction": "{i}", "input": "", "output": "{o}"}),
+    ]
+    return hashlib.sha256(json.dumps(probe, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+def token_cache_key(train_file: str, tok, max_length: int, response_only: bool) -> Tuple[str, dict]:
+    fields = {
+        "train_file": file_digest(train_file),
+        "tokenizer": tok.name_or_path,
+        "tokenizer_fp": tokenizer_fingerprint(tok),
+        "template": template_fingerprint(),
+        "max_length": max_length,
+        "response_only": response_only,
+    }
+    key = hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+    return key, fields
+
+
+def _iter_record_batches(path: str, batch_size: int) -> Iterator[Dict[str, list]]:
+    """逐批读取 JSONL，转成与 datasets batched map 相同的列式 dict。"""
+    keys = ("instruction", "input", "output")
+    rows: List[dict] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rows.append(json.loads(line))
+            if len(rows) >= batch_size:
+                yield {k: [r.get(k) for r in rows] for k in keys}
+                rows = []
+    if rows:
+        yield {k: [r.get(k) for r in rows] for k in keys}
+
+
+_WORKER_ENCODE: dict = {}
+
+
+def _init_encode_worker(tok, max_length: int, response_only: bool) -> None:
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _WORKER_ENCODE.update(tok=tok, max_length=max_length, response_only=response_only)
+
+
+def _encode_worker(batch: Dict[str, list]) -> Dict[str, list]:
+    return tokenize_batch(batch, **_WORKER_ENCODE)
+
+
+class TokenizedStore(torch.utils.data.Dataset):
+    """磁盘上的分词结果，全部以 np.memmap 只读打开。
+
+    - tokens.bin：所有样本的 token id 首尾相接（uint16/uint32）；
+    - offsets.bin：int64，共 n+1 个，第 i 条样本为 tokens[offsets[i]:offsets[i+1]]；
+    - prompt_lens.bin：int32，仅 response_only；
+    - meta.json：最后写入，存在即表示缓存完整。
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.meta = json.loads((self.path / "meta.json").read_text(encoding="utf-8"))
+        self.tokens = np.memmap(self.path / "tokens.bin", dtype=self.meta["dtype"], mode="r")
+        self.offsets = np.memmap(self.path / "offsets.bin", dtype=np.int64, mode="r")
+        self.prompt_lens = None
+        if self.meta["response_only"]:
+            self.prompt_lens = np.memmap(self.path / "prompt_lens.bin", dtype=np.int32, mode="r")
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> dict:
+        ids = np.asarray(self.tokens[self.offsets[i] : self.offsets[i + 1]], dtype=np.int64)
+        item = {"input_ids": ids}
+        if self.prompt_lens is not None:
+            item["prompt_len"] = int(self.prompt_lens[i])
+        return item
+
+    @classmethod
+    def build(
+        cls,
+        path: str | Path,
+        train_file: str,
+        tok,
+        max_length: int,
+        response_only: bool,
+        fields: dict,
+        num_proc: int | None = None,
+    ) -> "TokenizedStore":
+        """流式分词并追加写入临时目录，完成后原子改名为缓存目录。"""
+        path = Path(path)
+        tmp = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        dtype = np.uint16 if len(tok) <= np.iinfo(np.uint16).max else np.uint32
+        batches = _iter_record_batches(train_file, PACK_BATCH)
+        pool = None
+        if num_proc and num_proc > 1:
+            pool = mp.Pool(num_proc, initializer=_init_encode_worker, initargs=(tok, max_length, response_only))
+            encoded = pool.imap(_encode_worker, batches)  # imap 保持样本顺序
+        else:
+            encoded = (tokenize_batch(b, tok, max_length, response_only) for b in batches)
+
+        n_samples = n_tokens = 0
+        try:
+            with open(tmp / "tokens.bin", "wb") as f_tok, open(tmp / "offsets.bin", "wb") as f_off, \
+                    open(tmp / "prompt_lens.bin", "wb") as f_pl:
+                f_off.write(np.zeros(1, dtype=np.int64).tobytes())
+                for enc in encoded:
+                    ids = enc["input_ids"]
+                    lens = np.fromiter((len(x) for x in ids), dtype=np.int64, count=len(ids))
+                    if lens.sum():
+                        f_tok.write(np.concatenate([np.asarray(x, dtype=dtype) for x in ids]).tobytes())
+                    f_off.write((n_tokens + np.cumsum(lens)).tobytes())
+                    if response_only:
+                        f_pl.write(np.asarray(enc["prompt_len"], dtype=np.int32).tobytes())
+                    n_samples += len(ids)
+                    n_tokens += int(lens.sum())
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if not response_only:
+            (tmp / "prompt_lens.bin").unlink()
+        meta = {**fields, "dtype": np.dtype(dtype).name, "num_samples": n_samples, "num_tokens": n_tokens}
+        (tmp / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+        if path.exists():  # 并发构建时以先完成者为准
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            os.replace(tmp, path)
+        return cls(path)
+
+    @classmethod
+    def open_or_build(
+        cls,
+        cache_dir: str | Path,
+        train_file: str,
+        tok,
+        max_length: int,
+        response_only: bool,
+        num_proc: int | None = None,
+    ) -> "TokenizedStore":
+        key, fields = token_cache_key(train_file, tok, max_length, response_only)
+        path = Path(cache_dir) / key
+        if (path / "meta.json").exists():
+            print(f"token cache hit: {path}")
+            return cls(path)
+        print(f"token cache miss, building {path}")
+        return cls.build(path, train_file, tok, max_length, response_only, fields, num_proc)
+
+    def packed(self, max_length: int) -> "PackedStore":
+        return PackedStore(self, max_length)
+
+
+class PackedStore(torch.utils.data.Dataset):
+    """TokenizedStore 之上的 packing 视图；packing 方案（每块的样本下标）同样缓存为 memmap。"""
+
+    def __init__(self, store: TokenizedStore, max_length: int):
+        self.store = store
+        members_path = store.path / f"pack{max_length}_members.bin"
+        offsets_path = store.path / f"pack{max_length}_offsets.bin"
+        if not offsets_path.exists():
+            lengths = store.lengths.tolist()
+            members: List[int] = []
+            offsets = [0]
+            for start in range(0, len(lengths), PACK_BATCH):
+                for block in plan_packing(lengths[start : start + PACK_BATCH], max_length):
+                    members.extend(start + i for i in block)
+                    offsets.append(len(members))
+            np.asarray(members, dtype=np.int64).tofile(members_path)
+            np.asarray(offsets, dtype=np.int64).tofile(offsets_path)  # 最后写 offsets，作为完成标记
+        self.members = np.memmap(members_path, dtype=np.int64, mode="r") if len(store) else np.zeros(0, np.int64)
+        self.block_offsets = np.memmap(offsets_path, dtype=np.int64, mode="r")
+        seg = np.minimum(store.lengths[self.members], max_length)
+        self.lengths = np.add.reduceat(seg, self.block_offsets[:-1]) if len(seg) else seg
+
+    def __len__(self) -> int:
+        return len(self.block_offsets) - 1
+
+    def __getitem__(self, b: int) -> dict:
+        items = [self.store[int(i)] for i in self.members[self.block_offsets[b] : self.block_offsets[b + 1]]]
+        out = {
+            "input_ids": np.concatenate([it["input_ids"] for it in items]),
+            "seq_lens": [len(it["input_ids"]) for it in items],
+        }
+        if self.store.prompt_lens is not None:
+            out["prompt_lens"] = [it["prompt_len"] for it in items]
+        return out
+
+
+class CausalLMCollator:
+    """右侧 padding 到批内最长，labels 中 padding 为 -100。
+
+    带 `seq_lens` 的 packed 样本不输出 attention_mask，而是输出按段重置的 position_ids；
+    padding 部分自成一段，段首 token 的 label 置为 -100。
+    样本带 `prompt_len`（packed 为 `prompt_lens`）时，prompt 部分的 label 也置为 -100。
+    额外返回 `num_real_tokens`（由 ThroughputTrainer 取出统计，不传给模型）。
+    """
+
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: int | None = None):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features: List[dict]) -> Dict[str, torch.Tensor]:
+        lengths = [len(f["input_ids"]) for f in features]
+        width = max(lengths)
+        if self.pad_to_multiple_of:
+            m = self.pad_to_multiple_of
+            width = (width + m - 1) // m * m
+        packed = "seq_lens" in features[0]
+
+        input_ids = torch.full((len(features), width), self.pad_token_id, dtype=torch.long)
+        labels = torch.full_like(input_ids, IGNORE_INDEX)
+        extra = torch.zeros_like(input_ids)  # packed: position_ids；否则 attention_mask
+        for i, (f, n) in enumerate(zip(features, lengths)):
+            ids = torch.as_tensor(f["input_ids"], dtype=torch.long)
+            input_ids[i, :n] = ids
+            labels[i, :n] = ids
+            if packed:
+                seg_lens = list(f["seq_lens"])
+                if width > n:
+                    seg_lens.append(width - n)
+                extra[i] = torch.cat([torch.arange(s) for s in seg_lens])
+                offsets = [0]
+                for s in f["seq_lens"][:-1]:
+                    offsets.append(offsets[-1] + s)
+                labels[i, offsets[1:]] = IGNORE_INDEX
+                for start, pl in zip(offsets, f.get("prompt_lens") or []):
+                    labels[i, start : start + pl] = IGNORE_INDEX
+            else:
+                extra[i, :n] = 1
+                if "prompt_len" in f:
+                    labels[i, : f["prompt_len"]] = IGNORE_INDEX
+
+        batch = {"input_ids": input_ids, "labels": labels}
+        batch["position_ids" if packed else "attention_mask"] = extra
+        batch["num_real_tokens"] = torch.tensor(sum(lengths))
+        return batch
+
+
+def _peak_mem_mb() -> float:
+    """CUDA 上为本步峰值显存（读后清零），CPU 上为进程峰值 RSS（Linux 下 ru_maxrss 单位为 KB）。"""
+    if torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated() / 2**20
+        torch.cuda.reset_peak_memory_stats()
+        return round(peak, 1)
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class StepProfiler(TrainerCallback):
+    """逐优化步记录耗时拆分、有效 token 吞吐与峰值内存，写入 JSONL trace。
+
+    step_time 为上一步结束到本步结束的墙钟时间，拆分为 data_wait（取 batch + collate）、
+    forward、backward（含输入搬运到设备）、optimizer，其余（日志、lr schedule、回调）记为 other。
+    forward/backward/data_wait 由 ThroughputTrainer 调用 `add` 记录；CUDA 上计时前先同步。
+    汇总跳过前 warmup_steps 步（torch.compile 编译、首次分配内存）。
+    """
+
+    PHASES = ("data_wait", "forward", "backward", "optimizer")
+
+    def __init__(self, path: str | Path, config: dict | None = None, warmup_steps: int = 1):
+        self.path = Path(path)
+        self.config = config or {}
+        self.warmup_steps = warmup_steps
+        self.records: List[dict] = []
+        self.f = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.tokens = 0
+
+    @staticmethod
+    def now() -> float:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] += seconds
+
+    def _write(self, record: dict) -> None:
+        self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(self.path, "w", encoding="utf-8")
+        device = torch.cuda.get_device_name() if torch.cuda.is_available() else "cpu"
+        self._write({
+            "event": "config", **self.config, "device": device,
+            "torch": torch.__version__, "threads": torch.get_num_threads(),
+        })
+        self.records = []
+        self._reset()
+        _peak_mem_mb()
+        self._last_end = self.now()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._opt_start = self.now()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self.add("optimizer", self.now() - self._opt_start)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        end = self.now()
+        step_time = end - self._last_end
+        record = {"event": "step", "step": state.global_step, "step_time": round(step_time, 5)}
+        record.update({k: round(v, 5) for k, v in self.phases.items()})
+        record["other"] = round(step_time - sum(self.phases.values()), 5)
+        record["tokens"] = self.tokens
+        record["tokens_per_sec"] = round(self.tokens / step_time, 1) if step_time > 0 else None
+        record["peak_mem_mb"] = _peak_mem_mb()
+        self.records.append(record)
+        self._write(record)
+        self._reset()
+        self._last_end = self.now()
+
+    def summary(self) -> dict:
+        steps = self.records[self.warmup_steps :] or self.records
+        if not steps:
+            return {"event": "summary", "steps": 0}
+        total = sum(r["step_time"] for r in steps)
+        out = {
+            "event": "summary",
+            "steps": len(steps),
+            "skipped_warmup": len(self.records) - len(steps),
+            "mean_step_time": round(total / len(steps), 5),
+            "median_step_time": round(float(np.median([r["step_time"] for r in steps])), 5),
+            "tokens_per_sec": round(sum(r["tokens"] for r in steps) / total, 1) if total > 0 else None,
+            "peak_mem_mb": max(r["peak_mem_mb"] for r in steps),
+        }
+        for k in (*self.PHASES, "other"):
+            out[f"{k}_share"] = round(sum(r[k] for r in steps) / total, 4) if total > 0 else None
+        return out
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.f is None:
+            return
+        summary = self.summary()
+        self._write(summary)
+        self.f.close()
+        self.f = None
+        print(f"profile trace: {self.path} {json.dumps(summary, ensure_ascii=False)}")
+
+
+class ThroughputTrainer(Trainer):
+    """在每次日志中附加该窗口内的有效 token 吞吐与 padding 占比；给定 profiler 时记录逐步耗时拆分。"""
+
+    def __init__(self, *args, profiler: StepProfiler | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profiler = profiler
+        if profiler is not None:
+            self.add_callback(profiler)
+        self._real_tokens = 0
+        self._total_tokens = 0
+        self._window_start: float | None = None
+
+    def _get_train_sampler(self, *args, **kwargs):
+        # memmap 数据集自带 lengths，避免 LengthGroupedSampler 逐条读样本推断长度
+        grouped = getattr(self.args, "train_sampling_strategy", None) == "group_by_length" or getattr(
+            self.args, "group_by_length", False
+        )
+        lengths = getattr(self.train_dataset, "lengths", None)
+        if grouped and lengths is not None:
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                lengths=lengths.tolist(),
+            )
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def get_batch_samples(self, *args, **kwargs):
+        if self.profiler is None:
+            return super().get_batch_samples(*args, **kwargs)
+        t0 = self.profiler.now()
+        out = super().get_batch_samples(*args, **kwargs)
+        self.profiler.add("data_wait", self.profiler.now() - t0)
+        return out
+
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        if self.profiler is None:
+            return super().compute_loss(model, inputs, *args, **kwargs)
+        t0 = self.profiler.now()
+        out = super().compute_loss(model, inputs, *args, **kwargs)
+        self.profiler.add("forward", self.profiler.now() - t0)
+        return out
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        real = inputs.pop("num_real_tokens", None)
+        total = inputs["input_ids"].numel()
+        real = int(real) if real is not None else total
+        self._real_tokens += real
+        self._total_tokens += total
+        if self._window_start is None:
+            self._window_start = time.perf_counter()
+        if self.profiler is None:
+            return super().training_step(model, inputs, *args, **kwargs)
+
+        prof = self.profiler
+        prof.tokens += real
+        t0, fwd0 = prof.now(), prof.phases["forward"]
+        loss = super().training_step(model, inputs, *args, **kwargs)
+        prof.add("backward", prof.now() - t0 - (prof.phases["forward"] - fwd0))
+        return loss
+
+    def log(self, logs: Dict[str, float], *args, **kwargs) -> None:
+        if "loss" in logs and self._total_tokens and self._window_start is not None:
+            elapsed = time.perf_counter() - self._window_start
+            logs["tokens_per_sec"] = round(self._real_tokens / elapsed, 1) if elapsed > 0 else 0.0
+            logs["padding_ratio"] = round(1 - self._real_tokens / self._total_tokens, 4)
+            self._real_tokens = self._total_tokens = 0
+            self._window_start = time.perf_counter()
+        super().log(logs, *args, **kwargs)
+
+
+def length_grouping_kwargs(enabled: bool) -> dict:
+    """按长度分组采样：新版 transformers 用 train_sampling_strategy，旧版用 group_by_length。"""
+    if not enabled:
+        return {}
+    fields = TrainingArguments.__dataclass_fields__
+    if "train_sampling_strategy" in fields:
+        return {"train_sampling_strategy": "group_by_length", "length_column_name": "length"}
+    return {"group_by_length": True, "length_column_name": "length"}
+
+
+def cpu_supports_bf16() -> bool:
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def precision_kwargs(precision: str) -> dict:
+    """fp32 / bf16 / fp16 → TrainingArguments 参数；当前硬件不支持时退回 fp32 并提示。"""
+    cuda = torch.cuda.is_available()
+    if precision == "bf16":
+        if (cuda and torch.cuda.is_bf16_supported()) or (not cuda and cpu_supports_bf16()):
+            return {"bf16": True} if cuda else {"bf16": True, "use_cpu": True}  # CPU autocast 需显式 use_cpu
+        print("[warn] bf16 is not supported on this device, falling back to fp32")
+    elif precision == "fp16":
+        if cuda:
+            return {"fp16": True}
+        print("[warn] fp16 training requires CUDA, falling back to fp32")
+    return {}
+
+
+def speed_kwargs(args: Args) -> dict:
+    """梯度检查点、DataLoader 进程与 torch.compile 对应的 TrainingArguments 参数。"""
+    kw: dict = {"dataloader_num_workers": args.dataloader_workers}
+    if args.dataloader_workers > 0:
+        kw["dataloader_persistent_workers"] = True
+    if args.gradient_checkpointing:
+        # 非 reentrant 实现不要求输入带梯度，LoRA 冻结 embedding 时也能正常回传
+        kw.update(gradient_checkpointing=True, gradient_checkpointing_kwargs={"use_reentrant": False})
+    if args.torch_compile:
+        kw["torch_compile"] = True
+    return kw
+
+
+def build_hf_dataset(args: Args, tok):
+    """load_dataset → 批量分词（→ packing），每次运行都会重新计算。"""
+    ds = load_dataset("json", data_files=args.train_file, split="train")
+    ds_tok = ds.map(
+        tokenize_batch,
+        batched=True,
+        num_proc=args.num_proc,
+        fn_kwargs={"tok": tok, "max_length": args.max_length, "response_only": args.response_only},
+        remove_columns=ds.column_names,
+    )
+    if len(ds_tok) < len(ds):
+        print(f"dropped {len(ds) - len(ds_tok)} samples with no response tokens after truncation")
+    if args.packing:
+        n_samples = len(ds_tok)
+        ds_tok = ds_tok.map(
+            pack_sequences,
+            batched=True,
+            batch_size=1000,
+            num_proc=args.num_proc,
+            fn_kwargs={"max_length": args.max_length},
+            remove_columns=ds_tok.column_names,
+        )
+        print(f"packed {n_samples} samples into {len(ds_tok)} blocks of <= {args.max_length} tokens")
+    return ds_tok
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--model", required=True)
@@ -55,26 +680,44 @@ def main():
     ap.add_argument("--lora-r", type=int, default=8)
     ap.add_argument("--lora-alpha", type=int, default=16)
     ap.add_argument("--lora-dropout", type=float, default=0.05)
+    ap.add_argument("--max-length", type=int, default=1024, help="单样本截断长度 / packing 块长")
+    ap.add_argument("--packing", action="store_true", help="把多个样本拼成定长块训练")
+    ap.add_argument("--group-by-length", action="store_true", help="不打包时按长度分组采样")
+    ap.add_argument("--logging-steps", type=int, default=10)
+    ap.add_argument("--response-only", action="store_true", help="只在回答部分计算 loss")
+    ap.add_argument("--num-proc", type=int, default=None, help="分词/打包 map 的进程数")
+    ap.add_argument("--token-cache", default=None, help="可选，分词结果缓存目录（memmap）")
+    ap.add_argument("--precision", choices=["fp32", "bf16", "fp16"], default="fp32")
+    ap.add_argument("--gradient-checkpointing", action="store_true")
+    ap.add_argument("--dataloader-workers", type=int, default=0)
+    ap.add_argument("--torch-compile", action="store_true")
+    ap.add_argument("--num-threads", type=int, default=None, help="CPU intra-op 线程数")
+    ap.add_argument("--profile-trace", default=None, help="可选，逐步耗时拆分 JSONL 输出路径")
+    ap.add_argument("--profile-warmup", type=int, default=1, help="汇总时跳过的前若干步")
     args_ns = ap.parse_args()
     args = Args(**vars(args_ns))
 
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
     tok = AutoTokenizer.from_pretrained(args.model, use_fast=True)
     if tok.pad_token is None:
         tok.pad_token = tok.eos_token
 
-    ds = load_dataset("json", data_files=args.train_file, split="train")
-    ds = ds.map(lambda x: {"text": format_sample(x)})
-
-    def tokenize(ex):
-        return tok(ex["text"], truncation=True, max_length=1024)
-
-    ds_tok = ds.map(tokenize, batched=True, remove_columns=ds.column_names)
+    if args.token_cache:
+        t0 = time.perf_counter()
+        store = TokenizedStore.open_or_build(
+            args.token_cache, args.train_file, tok, args.max_length, args.response_only, args.num_proc
+        )
+        ds_tok = store.packed(args.max_length) if args.packing else store
+        print(f"token cache ready: {len(store)} samples, {len(ds_tok)} rows, {time.perf_counter() - t0:.2f}s")
+    else:
+        ds_tok = build_hf_dataset(args, tok)
 
     model = AutoModelForCausalLM.from_pretrained(
         args.model,
-        load_in_8bit=False,
-        torch_dtype=None,
-        device_map="auto",
+        torch_dtype=None,  # 权重保持 fp32，混合精度由 Trainer autocast 负责
+        device_map="auto" if torch.cuda.is_available() else None,
     )
 
     lora = LoraConfig(
@@ -84,33 +727,47 @@ def main():
         bias="none",
         task_type="CAUSAL_LM",
     )
+    model.config.use_cache = False  # 训练不需要 KV cache；packing 时 transformers 才会按 position_ids 构造块对角 mask
     model = get_peft_model(model, lora)
     model.print_trainable_parameters()
 
-    collator = DataCollatorForLanguageModeling(tok, mlm=False)
+    collator = CausalLMCollator(tok.pad_token_id)
 
     training_args = TrainingArguments(
         output_dir=args.output_dir,
         per_device_train_batch_size=args.batch_size,
         num_train_epochs=args.epochs,
         learning_rate=args.lr,
-        logging_steps=10,
+        logging_steps=args.logging_steps,
         save_strategy="epoch",
-        fp16=False,
-        bf16=False,
+        remove_unused_columns=False,  # seq_lens / prompt_len / length 需要传给 collator 与采样器
+        **length_grouping_kwargs(args.group_by_length and not args.packing),
+        **precision_kwargs(args.precision),
+        **speed_kwargs(args),
     )
 
-    trainer = Trainer(
+    profiler = None
+    if args.profile_trace:
+        knobs = (
+            "batch_size", "max_length", "packing", "group_by_length", "precision",
+            "gradient_checkpointing", "dataloader_workers", "torch_compile", "num_threads",
+        )
+        config = {k: getattr(args, k) for k in knobs}
+        config["amp"] = "bf16" if training_args.bf16 else "fp16" if training_args.fp16 else "fp32"
+        profiler = StepProfiler(args.profile_trace, config, warmup_steps=args.profile_warmup)
+
+    trainer = ThroughputTrainer(
         model=model,
         args=training_args,
         train_dataset=ds_tok,
         data_collator=collator,
+        profiler=profiler,
     )
 
     trainer.train()
     trainer.save_model(args.output_dir)
+    tok.save_pretrained(args.output_dir)  # adapter 目录自带分词器，export_merged / evaluate_model 可直接使用
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,6 +1,35 @@
+"""指令数据清洗：长度过滤 + 精确去重（流式、可多进程）。
+
+- 去重只保存每条记录的定长哈希（blake2b 64/128 bit，基于 sort_keys 的规范 JSON），
+  内存中以 uint64 有序数组存放（每条 8/16 字节，与记录长度无关）；
+  `--hash-db` 可改用磁盘上的 SQLite 哈希集合。
+- 输入按字节区间切块，`--workers` > 1 时由进程池并行解析/校验/哈希，
+  主进程按输入顺序去重并写出，结果与单进程一致（保留首次出现）。
+- `--records-per-shard` > 0 时输出按条数切分为多个分片文件。
+
+示例：
+```
+python prepare_data.py --input raw.jsonl --output data/clean.jsonl --min-len 10 --max-len 2048 \
+  --workers 8 --records-per-shard 1000000 --hash-db outputs/seen.sqlite
+```
+"""
+from __future__ import annotations
+
 import argparse
+import hashlib
 import json
+import multiprocessing as mp
+import sqlite3
+import sys
+import time
 from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "07-data-quality"))
+
+from near_dedup import SortedKeySet  # noqa: E402
 
 
 def valid(rec: dict, min_len: int, max_len: int) -> bool:
@@ -9,37 +38,288 @@ def valid(rec: dict, min_len: int, max_len: int) -> bool:
     return min_len <= n <= max_len
 
 
+def record_hash(rec: dict, bits: int = 64) -> int:
+    """规范化 JSON（sort_keys）的定长哈希，作为去重 key。"""
+    key = json.dumps(rec, ensure_ascii=False, sort_keys=True)
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=bits // 8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def byte_ranges(path: Path, chunk_bytes: int) -> List[Tuple[int, int]]:
+    size = path.stat().st_size
+    return [(start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)]
+
+
+def iter_range_lines(path: str, start: int, end: int) -> Iterator[bytes]:
+    """读取首字节落在 [start, end) 内的所有行。"""
+    with open(path, "rb") as f:
+        if start > 0:
+            # 上一字节不是换行时，当前位置处于某行中间，该行归上一个区间
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def process_range(task: tuple) -> Tuple[List[Tuple[int, bytes]], dict]:
+    """解析 + 校验 + 哈希一个字节区间，返回 ([(hash, 原始行)], 计数)。"""
+    path, start, end, min_len, max_len, bits = task
+    kept: List[Tuple[int, bytes]] = []
+    stats = {"lines": 0, "bad_json": 0, "invalid": 0}
+    for raw in iter_range_lines(path, start, end):
+        line = raw.strip()
+        if not line:
+            continue
+        stats["lines"] += 1
+        try:
+            rec = json.loads(line)
+        except json.JSONDecodeError:
+            stats["bad_json"] += 1
+            continue
+        if not valid(rec, min_len, max_len):
+            stats["invalid"] += 1
+            continue
+        kept.append((record_hash(rec, bits), line))
+    return kept, stats
+
+
+class PairKeySet:
+    """128 bit 集合：hi/lo 两列 uint64，结构同 SortedKeySet（有序 run + 几何合并）。
+
+    run 内按 (hi, lo) 字典序排列。随机哈希的 hi 几乎不会相同，排序与查找都以 hi 为主键，
+    只有 hi 相同时才比较 lo。
+    """
+
+    def __init__(self):
+        self.runs: List[Tuple[np.ndarray, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return sum(len(hi) for hi, _ in self.runs)
+
+    def contains(self, hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+        # 与 SortedKeySet 相同，查询先按 hi 排序以提高 searchsorted 的缓存命中率
+        order = np.argsort(hi)
+        hi, lo = hi[order], lo[order]
+        found_sorted = np.zeros(hi.shape, dtype=bool)
+        for run_hi, run_lo in self.runs:
+            left = np.searchsorted(run_hi, hi, "left")
+            count = np.searchsorted(run_hi, hi, "right") - left
+            one = count == 1
+            found_sorted[one] |= run_lo[left[one]] == lo[one]
+            for i in np.flatnonzero(count > 1):
+                found_sorted[i] |= bool((run_lo[left[i] : left[i] + count[i]] == lo[i]).any())
+        found = np.empty(hi.shape, dtype=bool)
+        found[order] = found_sorted
+        return found
+
+    @staticmethod
+    def _sorted_unique(hi: np.ndarray, lo: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        order = np.argsort(hi)
+        hi, lo = hi[order], lo[order]
+        if len(hi) > 1 and (hi[1:] == hi[:-1]).any():
+            # 有 hi 相同的项才需要按 (hi, lo) 排序并去重；lexsort 比单列 argsort 慢数倍
+            order = np.lexsort((lo, hi))
+            hi, lo = hi[order], lo[order]
+            keep = np.ones(len(hi), dtype=bool)
+            keep[1:] = (hi[1:] != hi[:-1]) | (lo[1:] != lo[:-1])
+            hi, lo = hi[keep], lo[keep]
+        return hi, lo
+
+    def add(self, hi: np.ndarray, lo: np.ndarray) -> None:
+        hi, lo = self._sorted_unique(hi, lo)
+        if len(hi) == 0:
+            return
+        while self.runs and len(self.runs[-1][0]) <= 2 * len(hi):
+            old_hi, old_lo = self.runs.pop()
+            hi, lo = self._sorted_unique(np.concatenate([old_hi, hi]), np.concatenate([old_lo, lo]))
+        self.runs.append((hi, lo))
+
+
+class MemoryHashSet:
+    """内存哈希集合：哈希存为 uint64 有序数组（128 bit 拆成 hi/lo 两列），每条 8/16 字节。
+
+    Python int 放进 set 每条约 70 字节，千万级记录即数百 MB；数组存储只需其 1/4～1/8。
+    """
+
+    def __init__(self, bits: int = 64):
+        self.bits = bits
+        self.keys = SortedKeySet() if bits == 64 else PairKeySet()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _columns(self, hashes: List[int]) -> Tuple[np.ndarray, ...]:
+        if self.bits == 64:
+            return (np.array(hashes, dtype=np.uint64),)
+        raw = b"".join([h.to_bytes(16, "big") for h in hashes])
+        pairs = np.frombuffer(raw, dtype=">u8").reshape(-1, 2).astype(np.uint64)
+        return pairs[:, 0], pairs[:, 1]
+
+    def add_new(self, hashes: List[int]) -> List[bool]:
+        """批量加入，返回每个哈希是否首次出现（同批内重复也只算第一次）。"""
+        n = len(hashes)
+        if n == 0:
+            return []
+        cols = self._columns(hashes)
+        # 稳定排序后与前一项相同者为同批内的重复，保留最早出现的那条
+        order = np.lexsort(cols[::-1])
+        same = np.ones(n - 1, dtype=bool)
+        for col in cols:
+            sorted_col = col[order]
+            same &= sorted_col[1:] == sorted_col[:-1]
+        first = np.empty(n, dtype=bool)
+        first[order] = np.concatenate([[True], ~same])
+        new = first & ~self.keys.contains(*cols)
+        self.keys.add(*(col[new] for col in cols))
+        return new.tolist()
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteHashSet:
+    """磁盘哈希集合（SQLite 主键索引），适合内存放不下全部哈希的超大数据集。"""
+
+    def __init__(self, path: str | Path, bits: int = 64):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.bits = bits
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        if bits == 64:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS seen (h INTEGER PRIMARY KEY)")
+        else:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS seen (h BLOB PRIMARY KEY) WITHOUT ROWID")
+
+    def _encode(self, h: int):
+        if self.bits == 64:
+            # SQLite INTEGER 为有符号 64 位
+            return h - (1 << 64) if h >= (1 << 63) else h
+        return h.to_bytes(self.bits // 8, "big")
+
+    def add_new(self, hashes: List[int]) -> List[bool]:
+        keys = [self._encode(h) for h in hashes]
+        existing = set()
+        uniq = list(dict.fromkeys(keys))
+        for i in range(0, len(uniq), 900):  # SQLite 默认最多 999 个参数
+            part = uniq[i : i + 900]
+            rows = self.conn.execute(
+                f"SELECT h FROM seen WHERE h IN ({','.join('?' * len(part))})", part
+            )
+            existing.update(r[0] for r in rows)
+        flags = []
+        fresh = []
+        for k in keys:
+            new = k not in existing
+            if new:
+                existing.add(k)
+                fresh.append((k,))
+            flags.append(new)
+        self.conn.executemany("INSERT INTO seen (h) VALUES (?)", fresh)
+        self.conn.commit()
+        return flags
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class ShardWriter:
+    """按条数滚动输出分片：out.jsonl → out-00000.jsonl, out-00001.jsonl, ..."""
+
+    def __init__(self, output: Path, records_per_shard: int = 0):
+        self.output = output
+        self.records_per_shard = records_per_shard
+        self.shard = 0
+        self.count = 0
+        self.paths: List[Path] = []
+        self.f = None
+
+    def _open(self):
+        if self.records_per_shard > 0:
+            path = self.output.with_name(f"{self.output.stem}-{self.shard:05d}{self.output.suffix}")
+        else:
+            path = self.output
+        self.paths.append(path)
+        self.f = path.open("wb")
+
+    def write(self, line: bytes) -> None:
+        if self.f is None:
+            self._open()
+        elif self.records_per_shard > 0 and self.count and self.count % self.records_per_shard == 0:
+            self.f.close()
+            self.shard += 1
+            self._open()
+        self.f.write(line + b"\n")
+        self.count += 1
+
+    def close(self) -> None:
+        if self.f is None:  # 没有任何保留记录时也产出（空）输出文件
+            self._open()
+        self.f.close()
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--input", required=True)
     ap.add_argument("--output", required=True)
     ap.add_argument("--min-len", type=int, default=10)
     ap.add_argument("--max-len", type=int, default=2048)
+    ap.add_argument("--workers", type=int, default=1, help="解析/校验进程数")
+    ap.add_argument("--chunk-bytes", type=int, default=8 << 20, help="每个任务的输入字节数")
+    ap.add_argument("--hash-bits", type=int, choices=[64, 128], default=64)
+    ap.add_argument("--hash-db", default=None, help="可选，磁盘哈希集合（SQLite）路径")
+    ap.add_argument("--records-per-shard", type=int, default=0, help=">0 时按条数切分输出")
     args = ap.parse_args()
 
     inp = Path(args.input)
     outp = Path(args.output)
     outp.parent.mkdir(parents=True, exist_ok=True)
 
-    kept = 0
-    with inp.open("r", encoding="utf-8") as f, outp.open("w", encoding="utf-8") as w:
-        seen = set()
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            rec = json.loads(line)
-            key = json.dumps(rec, ensure_ascii=False, sort_keys=True)
-            if key in seen:
-                continue
-            if not valid(rec, args.min_len, args.max_len):
-                continue
-            w.write(json.dumps(rec, ensure_ascii=False) + "\n")
-            seen.add(key)
-            kept += 1
-    print(f"kept records: {kept}")
+    tasks = [
+        (str(inp), start, end, args.min_len, args.max_len, args.hash_bits)
+        for start, end in byte_ranges(inp, args.chunk_bytes)
+    ]
+    seen = SqliteHashSet(args.hash_db, args.hash_bits) if args.hash_db else MemoryHashSet(args.hash_bits)
+    writer = ShardWriter(outp, args.records_per_shard)
+    totals = {"lines": 0, "bad_json": 0, "invalid": 0, "duplicates": 0}
+
+    start_time = time.perf_counter()
+    pool = mp.Pool(args.workers) if args.workers > 1 else None
+    try:
+        # imap 保持任务顺序，去重结果与顺序处理一致
+        results = pool.imap(process_range, tasks) if pool else map(process_range, tasks)
+        for kept, stats in results:
+            for k, v in stats.items():
+                totals[k] += v
+            flags = seen.add_new([h for h, _ in kept])
+            for (_, line), new in zip(kept, flags):
+                if new:
+                    writer.write(line)
+                else:
+                    totals["duplicates"] += 1
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        writer.close()
+        seen.close()
+    elapsed = time.perf_counter() - start_time
+
+    print(f"kept records: {writer.count}")
+    print(json.dumps({
+        **totals,
+        "kept": writer.count,
+        "shards": [str(p) for p in writer.paths],
+        "seconds": round(elapsed, 3),
+        "records_per_sec": round(totals["lines"] / elapsed, 1) if elapsed > 0 else None,
+        "workers": args.workers,
+    }, ensure_ascii=False))
 
 
 if __name__ == "__main__":
     main()
-
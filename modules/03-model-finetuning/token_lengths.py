@@ -0,0 +1,279 @@
+"""按真实 token 长度过滤指令数据，并统计长度分布与 packing 效率。
+
+- 样本按 `finetune_lora.format_sample` 拼成训练文本，用 fast tokenizer 的批量接口分词；
+  `--workers` > 1 时各进程各自加载一次分词器，按批并行。
+- token 数按 (分词器指纹 + 训练模板指纹, 记录哈希) 缓存到 SQLite（`--cache`），数据追加或规则
+  调整后重跑，只对新记录分词；改了分词器或模板文字时旧计数自动失效。
+- 输出长度直方图、分位数、超过 `--max-length` 会被截断的比例，以及两种估算：
+  padding 到 max_length 的有效 token 占比、按 Best-Fit-Decreasing 打包成 max_length
+  序列后的 packing 效率与序列数，用于在训练前确定 batch 与序列长度。
+
+示例：
+```
+python token_lengths.py --tokenizer TinyLlama/TinyLlama-1.1B-Chat-v1.0 --input data/clean.jsonl \
+  --output data/clean.tok.jsonl --min-tokens 16 --max-tokens 1024 --max-length 1024 \
+  --workers 4 --cache outputs/token_counts.sqlite --report outputs/token_lengths.json
+```
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+BASE = Path(__file__).resolve().parent
+sys.path.append(str(BASE))
+
+from finetune_lora import format_sample, template_fingerprint, tokenizer_fingerprint  # noqa: E402
+from prepare_data import record_hash  # noqa: E402
+
+
+def load_fast_tokenizer(name: str):
+    from transformers import AutoTokenizer
+
+    tok = AutoTokenizer.from_pretrained(name, use_fast=True)
+    if not tok.is_fast:
+        print(f"[warn] {name} 没有 fast tokenizer，批量分词会明显变慢")
+    return tok
+
+
+def count_tokens(tok, texts: Sequence[str]) -> List[int]:
+    """批量分词，只取长度（与训练时 `tok(text)` 一致，包含特殊 token）。"""
+    enc = tok(list(texts), return_attention_mask=False, return_token_type_ids=False, verbose=False)
+    return [len(ids) for ids in enc["input_ids"]]
+
+
+class TokenCountCache:
+    """SQLite 缓存：(分词器与模板指纹, 64 bit 记录哈希) → token 数。"""
+
+    def __init__(self, path: str | Path, fingerprint: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.fp = fingerprint
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_counts "
+            "(fp TEXT, h INTEGER, n INTEGER, PRIMARY KEY (fp, h)) WITHOUT ROWID"
+        )
+
+    @staticmethod
+    def _encode(h: int) -> int:
+        return h - (1 << 64) if h >= (1 << 63) else h  # SQLite INTEGER 为有符号 64 位
+
+    def get_many(self, hashes: Sequence[int]) -> Dict[int, int]:
+        found: Dict[int, int] = {}
+        keys = {self._encode(h): h for h in hashes}
+        uniq = list(keys)
+        for i in range(0, len(uniq), 900):  # SQLite 默认最多 999 个参数
+            part = uniq[i : i + 900]
+            rows = self.conn.execute(
+                f"SELECT h, n FROM token_counts WHERE fp = ? AND h IN ({','.join('?' * len(part))})",
+                [self.fp, *part],
+            )
+            found.update((keys[h], n) for h, n in rows)
+        return found
+
+    def put_many(self, items: Sequence[Tuple[int, int]]) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO token_counts (fp, h, n) VALUES (?, ?, ?)",
+            [(self.fp, self._encode(h), n) for h, n in items],
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+_WORKER_TOK = None
+
+
+def _init_worker(name: str) -> None:
+    global _WORKER_TOK
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"  # 进程级并行，避免与 Rust 线程池争抢
+    _WORKER_TOK = load_fast_tokenizer(name)
+
+
+def _count_worker(texts: List[str]) -> List[int]:
+    return count_tokens(_WORKER_TOK, texts)
+
+
+def iter_batches(path: str | Path, batch_size: int) -> Iterator[List[Tuple[bytes, dict]]]:
+    batch: List[Tuple[bytes, dict]] = []
+    with open(path, "rb") as f:
+        for raw in f:
+            line = raw.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            batch.append((line, rec))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def length_histogram(lengths: np.ndarray, bin_size: int) -> List[dict]:
+    if len(lengths) == 0:
+        return []
+    counts = np.bincount(lengths // bin_size)
+    return [
+        {"range": f"{i * bin_size}-{(i + 1) * bin_size - 1}", "count": int(c)}
+        for i, c in enumerate(counts)
+        if c
+    ]
+
+
+def pack_bfd(lengths: np.ndarray, max_length: int) -> int:
+    """Best-Fit-Decreasing 打包所需的序列数（超长样本先截断到 max_length）。
+
+    按剩余容量计数（而不是逐个序列）模拟：同一长度的样本一次性放入剩余容量最小的可用序列，
+    复杂度只与不同长度的个数和 max_length 有关，千万级样本也能秒级估算。
+    """
+    lengths = np.minimum(lengths, max_length)
+    lengths = lengths[lengths > 0]
+    free = np.zeros(max_length + 1, dtype=np.int64)  # free[r] = 剩余容量为 r 的序列数
+    bins = 0
+    values, counts = np.unique(lengths, return_counts=True)
+    for length, count in zip(values[::-1].tolist(), counts[::-1].tolist()):
+        while count:
+            avail = np.flatnonzero(free[length:])
+            if len(avail) == 0:
+                # 没有放得下的序列：新开序列，每个可容纳 per 个该长度样本
+                per = max_length // length
+                full, rest = divmod(count, per)
+                bins += full + (1 if rest else 0)
+                free[max_length - per * length] += full
+                if rest:
+                    free[max_length - rest * length] += 1
+                break
+            r = length + int(avail[0])
+            k = min(count, int(free[r]))
+            free[r] -= k
+            free[r - length] += k
+            count -= k
+    return bins
+
+
+def length_report(lengths: np.ndarray, max_length: int, bin_size: int) -> dict:
+    if len(lengths) == 0:
+        return {"records": 0}
+    clipped = np.minimum(lengths, max_length)
+    tokens = int(clipped.sum())
+    sequences = pack_bfd(lengths, max_length)
+    return {
+        "records": int(len(lengths)),
+        "tokens": int(lengths.sum()),
+        "mean": round(float(lengths.mean()), 1),
+        "p50": int(np.percentile(lengths, 50)),
+        "p90": int(np.percentile(lengths, 90)),
+        "p99": int(np.percentile(lengths, 99)),
+        "max": int(lengths.max()),
+        "max_length": max_length,
+        "truncated": int((lengths > max_length).sum()),
+        "padding_efficiency": round(tokens / (len(lengths) * max_length), 4),
+        "packed_sequences": sequences,
+        "packing_efficiency": round(tokens / (sequences * max_length), 4) if sequences else None,
+        "histogram": length_histogram(lengths, bin_size),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Token-length filtering and packing statistics")
+    ap.add_argument("--tokenizer", required=True)
+    ap.add_argument("--input", required=True)
+    ap.add_argument("--output", default=None, help="可选，按 token 长度过滤后的 JSONL")
+    ap.add_argument("--min-tokens", type=int, default=0)
+    ap.add_argument("--max-tokens", type=int, default=None, help="默认不过滤上限")
+    ap.add_argument("--max-length", type=int, default=1024, help="训练序列长度（截断/packing 估算）")
+    ap.add_argument("--batch-size", type=int, default=1000, help="每次批量分词的样本数")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--cache", default=None, help="可选，token 数缓存（SQLite）路径")
+    ap.add_argument("--bin-size", type=int, default=64, help="直方图桶宽（token）")
+    ap.add_argument("--report", default=None, help="可选，统计报告 JSON 路径")
+    args = ap.parse_args()
+
+    tok = load_fast_tokenizer(args.tokenizer)
+    # 计数的是 format_sample 渲染后的文本：指纹须同时覆盖分词器与训练模板
+    cache_fp = f"{tokenizer_fingerprint(tok)}|{template_fingerprint()}"
+    cache = TokenCountCache(args.cache, cache_fp) if args.cache else None
+    pool = mp.Pool(args.workers, initializer=_init_worker, initargs=(args.tokenizer,)) if args.workers > 1 else None
+    out = None
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        out = open(args.output, "wb")
+
+    kept_lengths: List[int] = []
+    totals = {"records": 0, "cached": 0, "tokenized": 0, "too_short": 0, "too_long": 0}
+    start_time = time.perf_counter()
+    try:
+        for batch in iter_batches(args.input, args.batch_size):
+            hashes = [record_hash(rec) for _, rec in batch]
+            known = cache.get_many(hashes) if cache else {}
+            todo = [i for i, h in enumerate(hashes) if h not in known]
+            if todo:
+                texts = [format_sample(batch[i][1]) for i in todo]
+                if pool:
+                    # 批内按进程数切片并行分词，map 保持顺序
+                    step = -(-len(texts) // args.workers)
+                    parts = pool.map(_count_worker, [texts[i : i + step] for i in range(0, len(texts), step)])
+                    counts = [n for part in parts for n in part]
+                else:
+                    counts = count_tokens(tok, texts)
+                fresh = {hashes[i]: n for i, n in zip(todo, counts)}
+                if cache:
+                    cache.put_many(list(fresh.items()))
+                known.update(fresh)
+
+            totals["records"] += len(batch)
+            totals["tokenized"] += len(todo)
+            totals["cached"] += len(batch) - len(todo)
+            for (line, _), h in zip(batch, hashes):
+                n = known[h]
+                if n < args.min_tokens:
+                    totals["too_short"] += 1
+                elif args.max_tokens is not None and n > args.max_tokens:
+                    totals["too_long"] += 1
+                else:
+                    kept_lengths.append(n)
+                    if out:
+                        out.write(line + b"\n")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if out:
+            out.close()
+        if cache:
+            cache.close()
+    elapsed = time.perf_counter() - start_time
+
+    report = {
+        **totals,
+        "kept": len(kept_lengths),
+        "seconds": round(elapsed, 3),
+        "records_per_sec": round(totals["records"] / elapsed, 1) if elapsed > 0 else None,
+        "workers": args.workers,
+        "lengths": length_report(np.asarray(kept_lengths, dtype=np.int64), args.max_length, args.bin_size),
+    }
+    if args.report:
+        Path(args.report).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.report).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    summary = {k: v for k, v in report.items() if k != "lengths"}
+    summary.update({k: v for k, v in report["lengths"].items() if k not in ("records", "histogram")})
+    print(json.dumps(summary, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,50 @@
+"""Offline evaluation of N prompt templates on one test set.
+
+Templates are passed as `--template NAME=PATH` (repeatable; `--template-a/--template-b` still
+work and are named A and B). Examples are shuffled once (`--seed`) and streamed in batches of
+`--batch-size`: each batch updates per-template confusion matrices, then `significance.
+SequentialStopper` drops every template that is significantly worse than the current leader
+(exact McNemar test, Bonferroni-corrected over planned looks), so no more provider calls are
+spent on it. The final report gives per-template accuracy / per-label F1 / confusion matrix and,
+for each template vs the best one, the paired accuracy difference with McNemar p-value and
+bootstrap CI. `--no-early-stop` evaluates every template on every example.
+
+`--judge local|openai` adds an LLM-as-judge stage after exact matching (see judge.py): outputs
+are packed `--judge-batch-size` per judge request, verdicts are cached per candidate, and each
+template reports judge pass rate, agreement with exact match, request latency and estimated cost.
+
+Labels are extracted with `label_stream` (incremental JSON/text parser); each template reports
+its parse-failure taxonomy under `parse`. With `--stream`, answers are streamed and reading stops
+as soon as the label is determined (`providers.EarlyStopProvider`).
+
+By default prompts are sent one request at a time. With `--concurrency N`
+all prompts go through `providers.run_prompts` instead: N requests in flight, optional token-bucket
+`--rate` limit, and retries with jittered backoff on transient errors. Use `--provider fake
+--fake-latency-ms 300` to measure throughput without network access.
+
+Templates are compiled once per run (`prompt_cache.PromptTemplate`: label list and optional
+`--few-shot` block resolved up front, per-example rendering is a join around `{text}`).
+Identical prompts are sent once; with `--cache FILE` raw outputs are kept across runs, keyed by
+(provider, model, prompt hash).
+"""
 import argparse
 import json
+import math
 import os
-from dataclasses import dataclass
+import random
+import sys
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Callable, Iterable
+from typing import Callable, Iterable, Optional, Union
+
+BASE = Path(__file__).resolve().parent
+sys.path.append(str(BASE))
+
+from judge import BatchJudge, LocalJudge  # noqa: E402
+from label_stream import extract  # noqa: E402
+from prompt_cache import PromptTemplate, ResponseCache, load_few_shot, load_template, response_key  # noqa: E402
+from providers import EarlyStopProvider, Provider, RetryPolicy, TokenBucket, complete_many, get_provider  # noqa: E402
+from significance import ConfusionMatrix, SequentialStopper, bootstrap_diff_ci, mcnemar  # noqa: E402
 
 
 @dataclass
@@ -22,77 +63,322 @@ def load_testset(path: str) -> list[Example]:
     return items
 
 
+def parse_templates(specs: Iterable[str]) -> dict[str, str]:
+    """`NAME=PATH` or `PATH` (name = file stem) -> {name: path}, in the given order."""
+    out: dict[str, str] = {}
+    for spec in specs:
+        name, path = spec.split("=", 1) if "=" in spec else (Path(spec).stem, spec)
+        if name in out:
+            raise ValueError(f"duplicate template name: {name}")
+        out[name] = path
+    return out
+
+
 def render_template(tpl_path: str, text: str, labels: list[str]) -> str:
-    tpl = Path(tpl_path).read_text(encoding="utf-8")
-    return tpl.format(text=text, labels=labels)
+    # 模板按 (文件版本, labels) 只编译一次，见 prompt_cache.load_template
+    return load_template(tpl_path, labels).render(text)
 
 
-def call_model(prompt: str, provider: str) -> str:
+def call_model(prompt: str, provider: Union[str, Provider]) -> str:
     """Return raw model output.
 
     - provider == "dummy": echo a trivial rule-based label for demo
-    - otherwise: extend with real provider (e.g., OpenAI) by reading API keys from env
+    - "fake" / "openai" or a `providers.Provider` instance: see providers.py
     """
-    if provider == "dummy":
-        # 简单规则模拟：包含“好/开心”→积极；“烦/差/糟糕/堵车”→消极；否则中性
-        text = prompt
-        if any(k in text for k in ["开心", "棒", "很好", "真好", "不错"]):
-            return "积极"
-        if any(k in text for k in ["烦", "差", "糟糕", "堵车", "生气"]):
-            return "消极"
-        return "中性"
-    raise NotImplementedError("Implement provider integration (e.g., OpenAI)")
+    if isinstance(provider, str):
+        provider = get_provider(provider)
+    return provider.complete(prompt)
 
 
 def extract_label(output: str, json_mode: bool) -> str:
-    if json_mode:
-        try:
-            obj = json.loads(output)
-            return str(obj["label"])  # type: ignore
-        except Exception:
-            return output.strip()
-    return output.strip()
+    # 解析失败时回退为去空白的原始输出；失败类型见 label_stream.extract(...).status
+    return extract(output, json_mode).label
+
+
+def complete_all(
+    provider: Provider,
+    prompts: list[str],
+    concurrency: int = 1,
+    bucket: Optional[TokenBucket] = None,
+    retry: Optional[RetryPolicy] = None,
+    cache: Optional[ResponseCache] = None,
+) -> tuple[list[Optional[str]], dict]:
+    """Outputs for all prompts in order. Cached and repeated prompts are not sent again.
+
+    Only the unique uncached prompts reach the provider: through `run_prompts` when
+    concurrency > 1, otherwise one at a time. A prompt that still fails after retries
+    yields None and is not cached.
+    """
+    retry = retry or RetryPolicy()
+    cache = cache if cache is not None else ResponseCache()
+    keys = [response_key(provider.name, provider.model, p) for p in prompts]
+    todo: dict[str, str] = {}
+    cache_hits = 0
+    for key, prompt in zip(keys, prompts):
+        if key in todo:
+            continue  # 本次运行内的重复 prompt，随首次出现的那条一起发送
+        if cache.get(key) is None:
+            todo[key] = prompt
+        else:
+            cache_hits += 1
+    pending = list(todo.values())
+
+    fresh, stats = complete_many(provider, pending, concurrency, bucket, retry)
+    for key, out in zip(todo, fresh):
+        if out is not None:
+            cache.put(key, out)
+
+    outputs = [cache.entries.get(k) for k in keys]
+    return outputs, {**stats.to_dict(), "prompts": len(prompts), "sent": len(pending),
+                     "cache_hits": cache_hits, "deduped": len(prompts) - len(pending) - cache_hits}
+
+
+def merge_stats(total: Optional[dict], part: dict) -> dict:
+    """Sum the per-batch `complete_all` stats into one run-level dict."""
+    if total is None:
+        return dict(part, errors=dict(part["errors"]))
+    for key in ("calls", "retries", "failures", "prompts", "sent", "cache_hits", "deduped"):
+        total[key] += part[key]
+    total["seconds"] = round(total["seconds"] + part["seconds"], 3)
+    total["calls_per_sec"] = round(total["calls"] / total["seconds"], 1) if total["seconds"] > 0 else None
+    for kind, n in part["errors"].items():
+        total["errors"][kind] = total["errors"].get(kind, 0) + n
+    return total
+
+
+@dataclass
+class TemplateRun:
+    name: str
+    template: PromptTemplate
+    matrix: ConfusionMatrix
+    correct: list[bool] = field(default_factory=list)
+    outputs: list[Optional[str]] = field(default_factory=list)
+    parse: dict = field(default_factory=dict)  # 解析状态 -> 条数（ok / no_json / truncated ...）
+    dropped: Optional[dict] = None  # 提前停止时的 McNemar 结果
+
+    def update(self, examples: list[Example], outputs: list[Optional[str]]) -> None:
+        for ex, out in zip(examples, outputs):
+            # 重试后仍失败的调用（None）按答错计，混淆矩阵中记为 <error>
+            pred = None
+            if out is not None:
+                res = extract(out, self.template.json_mode, self.matrix.labels)
+                pred = res.label
+                self.parse[res.status] = self.parse.get(res.status, 0) + 1
+            self.matrix.update(ex.label, pred)
+            self.correct.append(pred == ex.label)
+            self.outputs.append(out)
+
+
+def evaluate_templates(
+    examples: Iterable[Example],
+    provider: Union[str, Provider],
+    templates: dict[str, str],
+    labels: list[str],
+    concurrency: int = 1,
+    rate: Optional[float] = None,
+    max_retries: int = 3,
+    cache: Optional[ResponseCache] = None,
+    few_shot: Optional[str] = None,
+    batch_size: int = 100,
+    early_stop: bool = True,
+    alpha: float = 0.05,
+    min_samples: int = 50,
+    n_boot: int = 1000,
+    seed: int = 0,
+    judge: Optional[BatchJudge] = None,
+) -> dict:
+    if isinstance(provider, str):
+        provider = get_provider(provider)
+    if len(templates) < 1:
+        raise ValueError("need at least one template")
+    examples = list(examples)
+    # 打乱一次：测试集常按标签排序，前缀不能代表全体，提前停止依赖每批样本同分布
+    random.Random(seed).shuffle(examples)
+    total = len(examples)
+    cache = cache if cache is not None else ResponseCache()
+    retry = RetryPolicy(max_retries=max_retries)
+    # 整个运行共用一个令牌桶：每批新建的桶是满的，会让 --rate 在批与批之间失效
+    bucket = TokenBucket(rate, burst=max(concurrency, 1)) if rate else None
+    # 每个模板只编译一次；few-shot 示例块按各模板的输出格式（纯文本 / JSON）预先拼好
+    shots = load_few_shot(few_shot) if few_shot else ()
+    runs = {
+        name: TemplateRun(name, load_template(path, labels, shots), ConfusionMatrix(list(labels)))
+        for name, path in templates.items()
+    }
+    looks = max(math.ceil(total / batch_size), 1)
+    stopper = SequentialStopper(len(runs), looks, alpha, min_samples) if early_stop else None
+
+    stats = None
+    for start in range(0, total, batch_size):
+        batch = examples[start:start + batch_size]
+        active = [r for r in runs.values() if r.dropped is None]
+        # 所有未淘汰模板的本批 prompt 一起提交；concurrency > 1 时最多 concurrency 个请求同时在途
+        prompts = [r.template.render(ex.text) for r in active for ex in batch]
+        outputs, part = complete_all(provider, prompts, concurrency, bucket, retry, cache)
+        stats = merge_stats(stats, part)
+        for k, run in enumerate(active):
+            run.update(batch, outputs[k * len(batch):(k + 1) * len(batch)])
+        if stopper is not None:
+            for name, res in stopper.check({r.name: r.correct for r in active}).items():
+                runs[name].dropped = res
+        print(json.dumps({
+            "evaluated": start + len(batch),
+            "acc": {r.name: round(r.matrix.accuracy, 4) for r in active},
+            "dropped": [r.name for r in active if r.dropped is not None],
+        }, ensure_ascii=False), file=sys.stderr, flush=True)
+
+    finished = [r for r in runs.values() if r.dropped is None]
+    best = max(finished, key=lambda r: r.matrix.correct)
+    report = {}
+    for run in runs.values():
+        entry = {
+            "accuracy": run.matrix.accuracy,
+            "evaluated": run.matrix.total,
+            "parse": run.parse,
+            "per_label": run.matrix.per_label(),
+            "confusion": run.matrix.to_dict(),
+        }
+        if run.dropped is not None:
+            entry["dropped"] = {"at": run.dropped["n"], "leader": run.dropped["leader"],
+                                "p_value": run.dropped["p_value"]}
+        if run is not best:
+            # 与最佳模板在共同评估过的样本上配对比较
+            res = mcnemar(best.correct, run.correct, alpha)
+            entry["vs_best"] = {
+                "n": res["n"],
+                "diff": res["diff"],
+                "p_value": res["p_value"],
+                "ci_wald": res["ci"],
+                "ci_bootstrap": bootstrap_diff_ci(best.correct, run.correct, n_boot, alpha, seed),
+            }
+        if judge is not None:
+            entry["judge"] = judge_run(judge, examples, run)
+        report[run.name] = entry
+    skipped = sum(total - r.matrix.total for r in runs.values())
+    if isinstance(provider, EarlyStopProvider):
+        stats["stopped_early"] = provider.stopped_early
+    return {
+        "best": best.name,
+        "templates": report,
+        "examples": total,
+        "prompts_skipped": skipped,
+        "provider_stats": stats,
+    }
+
+
+def judge_run(judge: BatchJudge, examples: list[Example], run: TemplateRun) -> dict:
+    """Judge every successful output of one template; compare verdicts with exact match."""
+    done = [(ex, out, ok) for ex, out, ok in zip(examples, run.outputs, run.correct) if out is not None]
+    verdicts, stats = judge.judge([(ex.text, out) for ex, out, _ in done])
+    judged = [(v, ok) for v, (_, _, ok) in zip(verdicts, done) if v is not None]
+    return {
+        "pass_rate": sum(v for v, _ in judged) / max(len(judged), 1),
+        "agreement_with_exact": sum(v == ok for v, ok in judged) / max(len(judged), 1),
+        **stats,
+    }
+
+
+def ab_summary(result: dict, name_a: str = "A", name_b: str = "B") -> dict:
+    """The original A/B keys (acc_a, acc_b, delta) in front of the N-way report."""
+    acc_a = result["templates"][name_a]["accuracy"]
+    acc_b = result["templates"][name_b]["accuracy"]
+    return {"acc_a": acc_a, "acc_b": acc_b, "delta": acc_b - acc_a, **result}
 
 
 def evaluate(
     examples: Iterable[Example],
-    provider: str,
+    provider: Union[str, Provider],
     tpl_a: str,
     tpl_b: str,
     labels: list[str],
-) -> None:
-    total = 0
-    correct_a = 0
-    correct_b = 0
-    for ex in examples:
-        total += 1
-        pa = render_template(tpl_a, ex.text, labels)
-        pb = render_template(tpl_b, ex.text, labels)
-        ra = call_model(pa, provider)
-        rb = call_model(pb, provider)
-        la = extract_label(ra, json_mode=False)
-        lb = extract_label(rb, json_mode=True)
-        if la == ex.label:
-            correct_a += 1
-        if lb == ex.label:
-            correct_b += 1
-    acc_a = correct_a / max(total, 1)
-    acc_b = correct_b / max(total, 1)
-    print(json.dumps({"acc_a": acc_a, "acc_b": acc_b, "delta": acc_b - acc_a}, ensure_ascii=False))
+    **kwargs,
+) -> dict:
+    """A/B special case of `evaluate_templates`; prints and returns the result."""
+    result = ab_summary(evaluate_templates(examples, provider, {"A": tpl_a, "B": tpl_b}, labels, **kwargs))
+    print(json.dumps(result, ensure_ascii=False))
+    return result
 
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--provider", default="dummy")
-    ap.add_argument("--template-a", required=True)
-    ap.add_argument("--template-b", required=True)
+    ap.add_argument("--template", action="append", default=[], help="NAME=PATH or PATH, repeatable")
+    ap.add_argument("--template-a", default=None, help="same as --template A=PATH")
+    ap.add_argument("--template-b", default=None, help="same as --template B=PATH")
     ap.add_argument("--testset", required=True)
     ap.add_argument("--labels", default="积极,中性,消极")
+    ap.add_argument("--concurrency", type=int, default=1, help=">1: asyncio mode with N requests in flight")
+    ap.add_argument("--rate", type=float, default=None, help="max requests/second (token bucket)")
+    ap.add_argument("--max-retries", type=int, default=3, help="retries on 429/5xx/timeouts")
+    ap.add_argument("--model", default=None, help="model name for the openai provider")
+    ap.add_argument("--fake-latency-ms", type=float, default=200.0)
+    ap.add_argument("--fake-jitter-ms", type=float, default=50.0)
+    ap.add_argument("--fake-failure-rate", type=float, default=0.0)
+    ap.add_argument("--fake-token-ms", type=float, default=0.0, help="fake streaming delay per output char")
+    ap.add_argument("--fake-reason-chars", type=int, default=0, help="fake JSON answers carry a reason this long")
+    ap.add_argument("--stream", action="store_true", help="stream answers, stop reading once the label is known")
+    ap.add_argument("--few-shot", default=None, help='JSONL of {"text", "label"} filling {examples} in templates')
+    ap.add_argument("--cache", default=None, help="response cache JSONL, reused across runs")
+    ap.add_argument("--batch-size", type=int, default=100, help="examples per streaming batch / early-stop look")
+    ap.add_argument("--no-early-stop", action="store_true", help="evaluate every template on every example")
+    ap.add_argument("--alpha", type=float, default=0.05, help="family-wise error rate for dropping templates")
+    ap.add_argument("--min-samples", type=int, default=50, help="no early stop before this many examples")
+    ap.add_argument("--bootstrap", type=int, default=1000, help="bootstrap resamples for the final CIs")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--judge", choices=["none", "local", "openai"], default="none", help="LLM-as-judge stage")
+    ap.add_argument("--judge-model", default=None, help="judge model for --judge openai")
+    ap.add_argument("--judge-batch-size", type=int, default=8, help="candidates packed into one judge request")
+    ap.add_argument("--judge-concurrency", type=int, default=4)
+    ap.add_argument("--judge-price-per-1k", type=float, default=0.0, help="USD per 1K judge tokens")
     args = ap.parse_args()
 
+    specs = [f"A={args.template_a}"] * bool(args.template_a) + [f"B={args.template_b}"] * bool(args.template_b)
+    templates = parse_templates(specs + args.template)
+    if len(templates) < 2:
+        ap.error("need at least two templates (--template-a/--template-b or --template NAME=PATH)")
+
     labels = [x.strip() for x in args.labels.split(",") if x.strip()]
     examples = load_testset(args.testset)
-    evaluate(examples, args.provider, args.template_a, args.template_b, labels)
+    if args.provider == "fake":
+        provider = get_provider(
+            "fake",
+            latency_ms=args.fake_latency_ms,
+            jitter_ms=args.fake_jitter_ms,
+            failure_rate=args.fake_failure_rate,
+            token_ms=args.fake_token_ms,
+            reason_chars=args.fake_reason_chars,
+        )
+    elif args.provider == "openai":
+        provider = get_provider("openai", model=args.model, max_connections=max(args.concurrency, 1))
+    else:
+        provider = get_provider(args.provider)
+    if args.stream:
+        provider = EarlyStopProvider(provider, labels)
+    cache = ResponseCache(args.cache)
+    judge = None
+    if args.judge != "none":
+        # 裁判判决与被评模型输出共用同一个缓存文件，键前缀不同
+        judge_provider = (
+            LocalJudge() if args.judge == "local"
+            else get_provider("openai", model=args.judge_model, max_connections=max(args.judge_concurrency, 1))
+        )
+        judge = BatchJudge(
+            judge_provider, labels, batch_size=args.judge_batch_size, concurrency=args.judge_concurrency,
+            rate=args.rate, max_retries=args.max_retries, price_per_1k=args.judge_price_per_1k, cache=cache,
+        )
+    try:
+        result = evaluate_templates(
+            examples, provider, templates, labels,
+            concurrency=args.concurrency, rate=args.rate, max_retries=args.max_retries,
+            cache=cache, few_shot=args.few_shot, batch_size=args.batch_size,
+            early_stop=not args.no_early_stop, alpha=args.alpha, min_samples=args.min_samples,
+            n_boot=args.bootstrap, seed=args.seed, judge=judge,
+        )
+    finally:
+        cache.close()
+    if {"A", "B"} <= set(templates):
+        result = ab_summary(result)
+    print(json.dumps(result, ensure_ascii=False))
 
 
 if __name__ == "__main__":
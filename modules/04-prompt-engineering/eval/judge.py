@@ -0,0 +1,158 @@
+"""Batched LLM-as-judge stage for prompt evaluation.
+
+`BatchJudge` packs up to `batch_size` (input, output) candidates into one judge request
+(`templates/judge_batch.md`), so the judge instructions are paid once per batch instead of once
+per candidate. Requests run with bounded concurrency through `providers.complete_many`.
+Verdicts are cached per candidate, keyed by (judge provider, judge model, judge prompt hash,
+candidate hash). A re-run, or another template that produced the same output for the same input,
+costs nothing, and batches can be re-packed freely.
+
+`LocalJudge` is a deterministic offline judge: it reads the packed candidates back from the
+prompt and passes an output iff its label equals the rule-based label of the input. It accepts
+the same latency / failure knobs as `FakeProvider`.
+
+Token counts are estimates (one token per CJK character, four characters per token otherwise);
+cost = estimated tokens / 1000 * `price_per_1k`, as in modules/08-business-ops/cost_model.py.
+"""
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Sequence
+
+from label_stream import extract
+from prompt_cache import ResponseCache, load_template
+from providers import FakeProvider, Provider, RetryPolicy, TokenBucket, complete_many, rule_label
+
+JUDGE_TEMPLATE = Path(__file__).resolve().parent.parent / "templates" / "judge_batch.md"
+CANDIDATES = re.compile(r"<candidates>\s*(.*?)\s*</candidates>", re.S)
+CJK = re.compile(r"[\u3000-\u9fff\uff00-\uffef]")
+
+
+def candidate_hash(text: str, output: str) -> str:
+    return hashlib.sha256(json.dumps([text, output], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def pack_candidates(items: Sequence[tuple[str, str]]) -> str:
+    """One JSON object per line, ids starting at 1."""
+    return "\n".join(
+        json.dumps({"id": i, "input": text, "output": output}, ensure_ascii=False)
+        for i, (text, output) in enumerate(items, start=1)
+    )
+
+
+def parse_verdicts(output: str, n: int) -> list[Optional[bool]]:
+    """Verdict per id 1..n from `{"verdicts": [{"id", "pass"}]}`; ids the judge skipped are None."""
+    verdicts: list[Optional[bool]] = [None] * n
+    try:
+        obj = json.loads(output[output.index("{"):output.rindex("}") + 1])
+    except ValueError:  # 没有 JSON 对象或 JSON 不合法（JSONDecodeError 是 ValueError 子类）
+        return verdicts
+    for v in obj.get("verdicts", []) if isinstance(obj, dict) else []:
+        i = v.get("id") if isinstance(v, dict) else None
+        if isinstance(i, int) and 1 <= i <= n and isinstance(v.get("pass"), bool):
+            verdicts[i - 1] = v["pass"]
+    return verdicts
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = len(CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _percentile(values: Sequence[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+@dataclass
+class LocalJudge(FakeProvider):
+    """Deterministic offline judge: pass iff the output's label equals `rule_label(input)`."""
+
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    name: str = "local-judge"
+
+    def respond(self, prompt: str) -> str:
+        m = CANDIDATES.search(prompt)
+        verdicts = []
+        for line in (m.group(1).splitlines() if m else []):
+            item = json.loads(line)
+            # 与被评估方一致：增量抽取，早停截断的 JSON 输出也能读出标签
+            label = extract(item["output"], json_mode=None).label
+            verdicts.append({"id": item["id"], "pass": label == rule_label(item["input"])})
+        return json.dumps({"verdicts": verdicts}, ensure_ascii=False)
+
+
+class BatchJudge:
+    def __init__(
+        self,
+        provider: Provider,
+        labels: Sequence[str],
+        batch_size: int = 8,
+        concurrency: int = 4,
+        rate: Optional[float] = None,
+        max_retries: int = 3,
+        price_per_1k: float = 0.0,
+        cache: Optional[ResponseCache] = None,
+        template: str = str(JUDGE_TEMPLATE),
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be >= 1")
+        self.provider = provider
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        # 一个裁判实例共用一个令牌桶：各模板的 judge 调用之间同样受 rate 限制
+        self.bucket = TokenBucket(rate, burst=max(concurrency, 1)) if rate else None
+        self.retry = RetryPolicy(max_retries=max_retries)
+        self.price_per_1k = price_per_1k
+        self.cache = cache if cache is not None else ResponseCache()
+        self.template = load_template(template, labels)
+        # 判决缓存绑定裁判 prompt 的内容：改了评审标准，旧判决自动失效
+        self.prompt_hash = hashlib.sha256("\0".join(self.template.segments).encode("utf-8")).hexdigest()[:16]
+
+    def key(self, text: str, output: str) -> str:
+        return f"judge|{self.provider.name}|{self.provider.model}|{self.prompt_hash}|{candidate_hash(text, output)}"
+
+    def judge(self, items: Sequence[tuple[str, str]]) -> tuple[list[Optional[bool]], dict]:
+        """Verdict per (input, output) item, in order; None when the judge gave no usable verdict."""
+        keys = [self.key(text, output) for text, output in items]
+        todo: dict[str, tuple[str, str]] = {}
+        cache_hits = 0
+        for key, item in zip(keys, items):
+            if key in todo:
+                continue  # 同一候选重复出现，只判一次
+            if self.cache.get(key) is None:
+                todo[key] = item
+            else:
+                cache_hits += 1
+        pending = list(todo.items())
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        prompts = [self.template.render(pack_candidates([item for _, item in b])) for b in batches]
+
+        outputs, stats = complete_many(self.provider, prompts, self.concurrency, self.bucket, self.retry)
+        for batch, out in zip(batches, outputs):
+            for (key, _), verdict in zip(batch, parse_verdicts(out or "", len(batch))):
+                if verdict is not None:
+                    self.cache.put(key, json.dumps(verdict))
+
+        verdicts = [json.loads(self.cache.entries[k]) if k in self.cache.entries else None for k in keys]
+        prompt_tokens = sum(estimate_tokens(p) for p in prompts)
+        completion_tokens = sum(estimate_tokens(o) for o in outputs if o is not None)
+        p50, p95 = _percentile(stats.latencies, 0.5), _percentile(stats.latencies, 0.95)
+        return verdicts, {
+            "candidates": len(items),
+            "judged": sum(v is not None for v in verdicts),
+            "requests": len(prompts),
+            "cache_hits": cache_hits,
+            "deduped": len(items) - len(pending) - cache_hits,
+            "failures": stats.failures,
+            "seconds": round(stats.seconds, 3),
+            "latency_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "latency_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "est_tokens": prompt_tokens + completion_tokens,
+            "est_cost": round((prompt_tokens + completion_tokens) / 1000 * self.price_per_1k, 6),
+        }
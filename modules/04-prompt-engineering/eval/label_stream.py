@@ -0,0 +1,225 @@
+"""Incremental label extraction from streamed model output.
+
+`LabelStream` is fed chunks (tokens, SSE deltas, or one complete string) and returns an
+`ExtractResult` as soon as the label is determined, so the caller can stop generation:
+
+- JSON mode: a single-pass scanner over the top-level object. The label is final once the closing
+  quote of the top-level `"label"` string value arrives; the rest of the object (reasons, extra
+  keys, even a missing `}`) is never needed. Code fences or chatter before the `{` are skipped.
+- text mode: the stripped output must equal a label, which is only known at the end of the
+  stream. However, the stream fails early as soon as the text is no longer a prefix of any label.
+- auto mode (`json_mode=None`): JSON if the first non-blank character is `{` or a code fence,
+  text otherwise.
+
+Failure taxonomy (`ExtractResult.status`; `ok` means parsed and in the label set):
+`empty`, `no_json`, `truncated` (stream ended inside the object / label string),
+`invalid_json`, `missing_label`, `wrong_type` (label value is not a string), `unknown_label`.
+On failure `extract` sets `label` to the stripped raw output, as `extract_label` always did;
+a stream that failed early only has the text read so far.
+
+Stdlib only; used by evaluate_prompts.py and modules/01-fastapi-service/app/server.py.
+"""
+import json
+from dataclasses import dataclass
+from typing import Iterable, Optional, Sequence
+
+OK = "ok"
+EMPTY = "empty"
+NO_JSON = "no_json"
+TRUNCATED = "truncated"
+INVALID_JSON = "invalid_json"
+MISSING_LABEL = "missing_label"
+WRONG_TYPE = "wrong_type"
+UNKNOWN_LABEL = "unknown_label"
+FAILURES = (EMPTY, NO_JSON, TRUNCATED, INVALID_JSON, MISSING_LABEL, WRONG_TYPE, UNKNOWN_LABEL)
+
+_WS = " \t\r\n"
+_LITERAL = set("-+.0123456789eEtruefalsn")
+
+
+@dataclass
+class ExtractResult:
+    label: str
+    status: str
+    chars: int  # 判定时已消费的字符数
+    early: bool  # 在流结束前就已判定（可以提前停止生成）
+
+    @property
+    def ok(self) -> bool:
+        return self.status == OK
+
+
+class LabelStream:
+    def __init__(self, labels: Sequence[str] = (), json_mode: Optional[bool] = True):
+        self.labels = list(labels)
+        self.json_mode = json_mode
+        self.buf: list[str] = []
+        self.chars = 0
+        self.result: Optional[ExtractResult] = None
+        # JSON 扫描状态
+        self.state = "start"  # start / key / colon / value / literal / after / done
+        self.in_string = False
+        self.escape = False
+        self.string: list[str] = []
+        self.key: Optional[str] = None
+        self.capture = False  # 当前字符串是顶层 "label" 的值
+        self.skip_depth = 0  # 跳过嵌套值时的深度
+
+    def feed(self, chunk: str) -> Optional[ExtractResult]:
+        """Consume one chunk; returns the result once it is determined (then ignores further input)."""
+        if self.result is not None:
+            return self.result
+        for ch in chunk:
+            self.buf.append(ch)
+            self.chars += 1
+            if self.json_mode is None and ch not in _WS:
+                self.json_mode = ch in "{`"
+            if self.json_mode:
+                self._json_char(ch)
+            elif self.json_mode is False:
+                self._text_char()
+            if self.result is not None:
+                return self.result
+        return None
+
+    def close(self) -> ExtractResult:
+        """End of stream: the final result (already-determined results are returned unchanged)."""
+        if self.result is not None:
+            return self.result
+        raw = "".join(self.buf).strip()
+        if not raw:
+            status = EMPTY
+        elif not self.json_mode:
+            status = OK if not self.labels or raw in self.labels else UNKNOWN_LABEL
+        elif self.state == "start":
+            status = NO_JSON
+        elif self.state == "done":
+            status = MISSING_LABEL
+        else:
+            status = TRUNCATED
+        self.result = ExtractResult(raw, status, self.chars, early=False)
+        return self.result
+
+    # --- text mode -------------------------------------------------------------------------
+    def _text_char(self) -> None:
+        if not self.labels:
+            return
+        text = "".join(self.buf).strip()
+        if text and not any(label.startswith(text) for label in self.labels):
+            self._fail(UNKNOWN_LABEL)  # 已不可能等于任何标签，不必再等
+
+    # --- JSON mode -------------------------------------------------------------------------
+    def _fail(self, status: str) -> None:
+        self.result = ExtractResult("".join(self.buf).strip(), status, self.chars, early=True)
+
+    def _found(self, value: str) -> None:
+        status = OK if not self.labels or value in self.labels else UNKNOWN_LABEL
+        self.result = ExtractResult(value, status, self.chars, early=True)
+
+    def _json_char(self, ch: str) -> None:
+        if self.in_string:
+            self._string_char(ch)
+            return
+        if self.state == "start":
+            if ch == "{":
+                self.state = "key"
+            return  # 跳过 ``` 代码块标记与前置说明
+        if self.skip_depth:
+            # 跳过顶层非 label 的对象 / 数组值
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.skip_depth += 1
+            elif ch in "}]":
+                self.skip_depth -= 1
+                if not self.skip_depth:
+                    self.state = "after"
+            return
+        if ch in _WS:
+            return
+        if self.state == "key":
+            if ch == '"':
+                self.in_string, self.string = True, []
+            elif ch == "}":
+                self.state = "done"
+                self._fail(MISSING_LABEL)
+            else:
+                self._fail(INVALID_JSON)
+        elif self.state == "colon":
+            if ch == ":":
+                self.state = "value"
+            else:
+                self._fail(INVALID_JSON)
+        elif self.state == "value":
+            if ch == '"':
+                self.in_string, self.string = True, []
+                self.capture = self.key == "label"
+            elif self.key == "label":
+                self._fail(WRONG_TYPE)
+            elif ch in "{[":
+                self.skip_depth = 1
+            elif ch in _LITERAL:
+                self.state = "literal"
+            else:
+                self._fail(INVALID_JSON)
+        elif self.state == "literal":
+            if ch in _LITERAL:
+                return
+            self._after_value(ch)
+        elif self.state == "after":
+            self._after_value(ch)
+
+    def _after_value(self, ch: str) -> None:
+        if ch == ",":
+            self.state = "key"
+        elif ch == "}":
+            self.state = "done"
+            self._fail(MISSING_LABEL)
+        else:
+            self._fail(INVALID_JSON)
+
+    def _string_char(self, ch: str) -> None:
+        if self.escape:
+            self.escape = False
+        elif ch == "\\":
+            self.escape = True
+        elif ch == '"':
+            self.in_string = False
+            if self.skip_depth:
+                return
+            try:
+                value = json.loads('"' + "".join(self.string) + '"')
+            except ValueError:
+                self._fail(INVALID_JSON)
+                return
+            if self.state == "key":
+                self.key, self.state = value, "colon"
+            elif self.capture:
+                self._found(value)
+            else:
+                self.state = "after"
+            return
+        if not self.skip_depth:
+            self.string.append(ch)
+
+
+def extract(output: str, json_mode: Optional[bool] = True, labels: Sequence[str] = ()) -> ExtractResult:
+    """One-shot extraction from a complete output."""
+    stream = LabelStream(labels, json_mode)
+    stream.feed(output)
+    result = stream.close()
+    if not result.ok:
+        # 提前判定失败时 label 只是已读部分；整段输出已知，回退为完整的去空白原文
+        result.label = output.strip()
+    return result
+
+
+def extract_stream(
+    chunks: Iterable[str], json_mode: Optional[bool] = True, labels: Sequence[str] = ()
+) -> ExtractResult:
+    """Consume chunks only until the label is determined; the remaining chunks are never pulled."""
+    stream = LabelStream(labels, json_mode)
+    for chunk in chunks:
+        if stream.feed(chunk) is not None:
+            break
+    return stream.close()
@@ -0,0 +1,129 @@
+"""Precompiled prompt templates and a persistent response cache.
+
+`PromptTemplate` reads a template file once and resolves everything that does not depend on the
+example (label list, few-shot block) at compile time; rendering an example is then a single
+`str.join` of the remaining static segments around `{text}`. Only the known placeholders
+`{text}`, `{labels}` and `{examples}` are substituted, so literal JSON such as `{"label": ...}`
+in a template needs no brace escaping.
+
+`ResponseCache` maps (provider, model, sha256(rendered prompt)) to the raw model output in an
+append-only JSONL file, so identical prompts are never sent twice, across templates and runs.
+"""
+import hashlib
+import json
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Sequence
+
+PLACEHOLDER = re.compile(r"\{(text|labels|examples)\}")
+
+
+def format_few_shot(shots: Sequence[tuple[str, str]], json_mode: bool = False) -> str:
+    """Few-shot block in the same 输入/输出 layout the templates use; JSON templates get {"label": ...}."""
+    return "\n\n".join(
+        f'输入："{text}"\n输出：' + (json.dumps({"label": label}, ensure_ascii=False) if json_mode else label)
+        for text, label in shots
+    )
+
+
+def load_few_shot(path: str) -> tuple[tuple[str, str], ...]:
+    """JSONL of {"text", "label"} as (text, label) pairs."""
+    shots = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                obj = json.loads(line)
+                shots.append((obj["text"], obj["label"]))
+    return tuple(shots)
+
+
+class PromptTemplate:
+    """A template compiled for one label set and few-shot examples.
+
+    Templates that ask for `{"label": ...}` output are in JSON mode: their few-shot block is
+    written as JSON and outputs are parsed with `json_mode=True`.
+    """
+
+    def __init__(self, source: str, labels: Sequence[str], shots: Sequence[tuple[str, str]] = (), name: str = ""):
+        self.name = name
+        self.json_mode = '"label"' in source
+        # labels 与原 str.format 一样渲染为列表
+        static = {"labels": str(list(labels)), "examples": format_few_shot(shots, self.json_mode)}
+        self.segments: list[str] = [""]
+        for i, part in enumerate(PLACEHOLDER.split(source)):
+            # split 结果交替为：静态文本、占位符名、静态文本……
+            if i % 2 == 0:
+                self.segments[-1] += part
+            elif part == "text":
+                self.segments.append("")
+            else:
+                self.segments[-1] += static[part]
+
+    @classmethod
+    def from_file(cls, path: str, labels: Sequence[str], shots: Sequence[tuple[str, str]] = ()) -> "PromptTemplate":
+        return cls(Path(path).read_text(encoding="utf-8"), labels, shots, name=str(path))
+
+    def render(self, text: str) -> str:
+        return text.join(self.segments)
+
+
+@lru_cache(maxsize=64)
+def _compiled(path: str, mtime_ns: int, labels: tuple, shots: tuple) -> PromptTemplate:
+    return PromptTemplate.from_file(path, labels, shots)
+
+
+def load_template(path: str, labels: Sequence[str], shots: Sequence[tuple[str, str]] = ()) -> PromptTemplate:
+    """Compiled template, cached per (file version, labels, few-shot examples)."""
+    return _compiled(str(path), Path(path).stat().st_mtime_ns, tuple(labels), tuple(shots))
+
+
+def response_key(provider: str, model: str, prompt: str) -> str:
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{provider}|{model}|{digest}"
+
+
+class ResponseCache:
+    """Append-only JSONL cache of raw outputs; `path=None` keeps it in memory only."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path) if path else None
+        self.entries: dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self._needs_newline = False
+        if self.path and self.path.exists():
+            text = self.path.read_text(encoding="utf-8")
+            for line in text.splitlines():
+                try:
+                    obj = json.loads(line)
+                except json.JSONDecodeError:  # 中断时可能只写了半行
+                    continue
+                self.entries[obj["key"]] = obj["output"]
+            self._needs_newline = bool(text) and not text.endswith("\n")
+        self._f = None
+
+    def get(self, key: str) -> Optional[str]:
+        out = self.entries.get(key)
+        if out is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return out
+
+    def put(self, key: str, output: str) -> None:
+        self.entries[key] = output
+        if self.path is None:
+            return
+        if self._f is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._f = open(self.path, "a", encoding="utf-8")
+            if self._needs_newline:
+                self._f.write("\n")
+        self._f.write(json.dumps({"key": key, "output": output}, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
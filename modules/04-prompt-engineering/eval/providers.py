@@ -0,0 +1,497 @@
+"""Model providers for prompt evaluation.
+
+Every provider exposes the same interface: sync `complete(prompt)` and async `acomplete(prompt)`,
+plus chunked `stream(prompt)` / `astream(prompt)` (one chunk unless the provider really streams).
+`run_prompts` drives many async calls with bounded concurrency, a token-bucket rate limit and
+retries with full-jitter exponential backoff, so a large A/B run spends its time waiting on the
+network in parallel instead of one request at a time.
+
+- dummy: rule-based labels, no latency (demo)
+- fake: the same labels behind configurable latency / jitter / transient failure rate,
+  for measuring throughput of the async runner without network access
+- openai: any OpenAI-compatible `/chat/completions` endpoint over a pooled keep-alive
+  `httpx` client (OPENAI_API_KEY / OPENAI_BASE_URL / OPENAI_MODEL from env)
+
+`EarlyStopProvider` wraps any provider: it streams the answer through `label_stream.LabelStream`
+and closes the stream as soon as the label is determined, which cancels the rest of generation.
+"""
+import asyncio
+import os
+import random
+import json
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterator, Optional, Sequence
+
+from label_stream import LabelStream
+
+
+class TransientError(Exception):
+    """Retryable provider failure: rate limited (429), server error (5xx), timeout, connection reset."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, kind: str = "transient"):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.kind = kind
+
+
+class Provider:
+    name = "base"
+    model = ""
+
+    async def acomplete(self, prompt: str) -> str:
+        raise NotImplementedError
+
+    def complete(self, prompt: str) -> str:
+        return asyncio.run(self.acomplete(prompt))
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        yield self.complete(prompt)
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        yield await self.acomplete(prompt)
+
+    async def aclose(self) -> None:
+        pass
+
+
+def rule_label(prompt: str) -> str:
+    # 简单规则模拟：包含“好/开心”→积极；“烦/差/糟糕/堵车”→消极；否则中性
+    if any(k in prompt for k in ["开心", "棒", "很好", "真好", "不错"]):
+        return "积极"
+    if any(k in prompt for k in ["烦", "差", "糟糕", "堵车", "生气"]):
+        return "消极"
+    return "中性"
+
+
+class DummyProvider(Provider):
+    name = "dummy"
+    model = "rules"
+
+    def complete(self, prompt: str) -> str:
+        return rule_label(prompt)
+
+    async def acomplete(self, prompt: str) -> str:
+        return rule_label(prompt)
+
+
+@dataclass
+class FakeProvider(Provider):
+    """Rule-based answers after a simulated network round trip.
+
+    With `reason_chars > 0`, prompts asking for `{"label": ...}` get a JSON answer with a
+    `reason` of that length; `token_ms` is the streaming delay per output character.
+    """
+
+    latency_ms: float = 200.0
+    jitter_ms: float = 50.0
+    failure_rate: float = 0.0
+    seed: int = 0
+    token_ms: float = 0.0
+    reason_chars: int = 0
+    name: str = "fake"
+    model: str = "rules"
+    in_flight: int = 0
+    peak_in_flight: int = 0
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    def _latency(self) -> float:
+        return max(0.0, self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    def respond(self, prompt: str) -> str:
+        label = rule_label(prompt)
+        if self.reason_chars and '"label"' in prompt:
+            return json.dumps({"label": label, "reason": "因" * self.reason_chars}, ensure_ascii=False)
+        return label
+
+    def _answer(self, prompt: str) -> str:
+        if self.rng.random() < self.failure_rate:
+            raise TransientError("fake provider: simulated 503", kind="http_503")
+        return self.respond(prompt)
+
+    def complete(self, prompt: str) -> str:
+        return "".join(self.stream(prompt))
+
+    async def acomplete(self, prompt: str) -> str:
+        return "".join([chunk async for chunk in self.astream(prompt)])
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        time.sleep(self._latency())
+        answer = self._answer(prompt)
+        if not self.token_ms:
+            yield answer
+            return
+        for ch in answer:
+            time.sleep(self.token_ms / 1000)
+            yield ch
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._latency())
+            answer = self._answer(prompt)
+            if not self.token_ms:
+                yield answer
+                return
+            for ch in answer:
+                await asyncio.sleep(self.token_ms / 1000)
+                yield ch
+        finally:
+            self.in_flight -= 1
+
+
+class OpenAICompatibleProvider(Provider):
+    """Chat completions over pooled HTTP connections (one client per provider, reused by all calls)."""
+
+    name = "openai"
+
+    def __init__(
+        self,
+        model: Optional[str] = None,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        max_connections: int = 16,
+        timeout: float = 60.0,
+    ):
+        try:
+            import httpx
+        except ImportError as e:  # pragma: no cover - optional dependency
+            raise ImportError("openai provider requires `pip install httpx`") from e
+        self.httpx = httpx
+        self.model = model or os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
+        api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY is not set")
+        self.base_url = (base_url or os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")).rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = timeout
+        self._client = None
+        self._sync_client = None
+
+    def _payload(self, prompt: str, stream: bool = False) -> dict:
+        payload = {"model": self.model, "messages": [{"role": "user", "content": prompt}], "temperature": 0}
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def _check(self, resp) -> None:
+        if resp.status_code == 429 or resp.status_code >= 500:
+            retry_after = resp.headers.get("retry-after")
+            raise TransientError(
+                f"HTTP {resp.status_code}",
+                float(retry_after) if retry_after and retry_after.isdigit() else None,
+                kind=f"http_{resp.status_code}",
+            )
+
+    def _parse(self, resp) -> str:
+        self._check(resp)
+        resp.raise_for_status()
+        return resp.json()["choices"][0]["message"]["content"]
+
+    @staticmethod
+    def _delta(line: str) -> Optional[str]:
+        """Content of one SSE line (`data: {...}`); None for keep-alives, `[DONE]` and role-only deltas."""
+        if not line.startswith("data:"):
+            return None
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return None
+        choices = json.loads(data).get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content")
+
+    async def acomplete(self, prompt: str) -> str:
+        if self._client is None:
+            self._client = self.httpx.AsyncClient(
+                base_url=self.base_url, headers=self.headers, limits=self.limits, timeout=self.timeout
+            )
+        try:
+            resp = await self._client.post("/chat/completions", json=self._payload(prompt))
+        except (self.httpx.TimeoutException, self.httpx.TransportError) as e:
+            raise TransientError(f"{type(e).__name__}: {e}", kind=type(e).__name__) from e
+        return self._parse(resp)
+
+    def complete(self, prompt: str) -> str:
+        if self._sync_client is None:
+            self._sync_client = self.httpx.Client(
+                base_url=self.base_url, headers=self.headers, limits=self.limits, timeout=self.timeout
+            )
+        try:
+            resp = self._sync_client.post("/chat/completions", json=self._payload(prompt))
+        except (self.httpx.TimeoutException, self.httpx.TransportError) as e:
+            raise TransientError(f"{type(e).__name__}: {e}", kind=type(e).__name__) from e
+        return self._parse(resp)
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        if self._sync_client is None:
+            self._sync_client = self.httpx.Client(
+                base_url=self.base_url, headers=self.headers, limits=self.limits, timeout=self.timeout
+            )
+        try:
+            # 提前退出 with 块会关闭连接，服务端随之停止生成
+            with self._sync_client.stream("POST", "/chat/completions", json=self._payload(prompt, True)) as resp:
+                self._check(resp)
+                resp.raise_for_status()
+                for line in resp.iter_lines():
+                    content = self._delta(line)
+                    if content:
+                        yield content
+        except (self.httpx.TimeoutException, self.httpx.TransportError) as e:
+            raise TransientError(f"{type(e).__name__}: {e}", kind=type(e).__name__) from e
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        if self._client is None:
+            self._client = self.httpx.AsyncClient(
+                base_url=self.base_url, headers=self.headers, limits=self.limits, timeout=self.timeout
+            )
+        try:
+            async with self._client.stream("POST", "/chat/completions", json=self._payload(prompt, True)) as resp:
+                self._check(resp)
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    content = self._delta(line)
+                    if content:
+                        yield content
+        except (self.httpx.TimeoutException, self.httpx.TransportError) as e:
+            raise TransientError(f"{type(e).__name__}: {e}", kind=type(e).__name__) from e
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class EarlyStopProvider(Provider):
+    """Stream from `inner` and stop reading once the label is determined (auto JSON/text mode)."""
+
+    def __init__(self, inner: Provider, labels: Sequence[str]):
+        self.inner = inner
+        self.labels = list(labels)
+        # 截断后的输出不是完整回复：单独的缓存命名空间，避免污染非流式运行的缓存
+        self.name = f"{inner.name}+earlystop"
+        self.model = inner.model
+        self.stopped_early = 0
+
+    def complete(self, prompt: str) -> str:
+        extractor, parts = LabelStream(self.labels, json_mode=None), []
+        stream = self.inner.stream(prompt)
+        try:
+            for chunk in stream:
+                parts.append(chunk)
+                if extractor.feed(chunk) is not None:
+                    self.stopped_early += 1
+                    break
+        finally:
+            stream.close()
+        return "".join(parts)
+
+    async def acomplete(self, prompt: str) -> str:
+        extractor, parts = LabelStream(self.labels, json_mode=None), []
+        stream = self.inner.astream(prompt)
+        try:
+            async for chunk in stream:
+                parts.append(chunk)
+                if extractor.feed(chunk) is not None:
+                    self.stopped_early += 1
+                    break
+        finally:
+            await stream.aclose()
+        return "".join(parts)
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+
+def get_provider(name: str, **kwargs) -> Provider:
+    if name == "dummy":
+        return DummyProvider()
+    if name == "fake":
+        return FakeProvider(**kwargs)
+    if name == "openai":
+        return OpenAICompatibleProvider(**kwargs)
+    raise NotImplementedError(f"unknown provider: {name}")
+
+
+class TokenBucket:
+    """Token bucket: `rate` requests/second on average, bursts of up to `burst` requests.
+
+    Create one bucket per run and pass it to every `complete_many` / `run_prompts` call: a fresh
+    bucket starts full, so a bucket per call would allow a new burst at every batch.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        if rate <= 0:
+            raise ValueError("rate must be > 0")
+        self.rate = rate
+        self.capacity = float(burst if burst is not None else max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock: Optional[asyncio.Lock] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _take(self) -> float:
+        """Take a token if one is available (returns 0), else the seconds until the next one."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        # 每次 complete_many 都是新的 asyncio.run：锁按事件循环重建，令牌状态跨调用保留
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.lock, self.loop = asyncio.Lock(), loop
+        async with self.lock:  # 排队取令牌，先到先得
+            while True:
+                wait = self._take()
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
+    def acquire_sync(self) -> None:
+        """Blocking `acquire` for the sequential path (one caller, no lock needed)."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+@dataclass
+class RetryPolicy:
+    max_retries: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 20.0
+
+    def delay(self, attempt: int, rng: random.Random, retry_after: Optional[float] = None) -> float:
+        """Full jitter: uniform(0, min(max_delay, base * 2^attempt)); never earlier than Retry-After."""
+        backoff = rng.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        return max(backoff, retry_after or 0.0)
+
+
+@dataclass
+class RunStats:
+    calls: int = 0
+    retries: int = 0
+    failures: int = 0
+    seconds: float = 0.0
+    errors: dict = field(default_factory=dict)
+    latencies: list = field(default_factory=list)  # 每个 prompt 从首次调用到结束（含重试）的秒数
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "seconds": round(self.seconds, 3),
+            "calls_per_sec": round(self.calls / self.seconds, 1) if self.seconds > 0 else None,
+            "errors": self.errors,
+        }
+
+
+def complete_with_retry(
+    provider: Provider,
+    prompt: str,
+    retry: RetryPolicy,
+    rng: random.Random,
+    stats: RunStats,
+    bucket: Optional[TokenBucket] = None,
+) -> Optional[str]:
+    """Sequential counterpart of `run_prompts`: same retry policy, rate limit and stats, one call at a time."""
+    t0 = time.perf_counter()
+    try:
+        for attempt in range(retry.max_retries + 1):
+            if bucket is not None:
+                bucket.acquire_sync()
+            stats.calls += 1
+            try:
+                return provider.complete(prompt)
+            except TransientError as e:
+                stats.errors[e.kind] = stats.errors.get(e.kind, 0) + 1
+                if attempt == retry.max_retries:
+                    break
+                stats.retries += 1
+                time.sleep(retry.delay(attempt, rng, e.retry_after))
+        stats.failures += 1
+        return None
+    finally:
+        stats.latencies.append(time.perf_counter() - t0)
+
+
+async def run_prompts(
+    provider: Provider,
+    prompts: Sequence[str],
+    concurrency: int = 8,
+    bucket: Optional[TokenBucket] = None,
+    retry: Optional[RetryPolicy] = None,
+    seed: int = 0,
+) -> tuple[list[Optional[str]], RunStats]:
+    """Complete all prompts concurrently; results keep input order.
+
+    Every attempt (retries included) takes a token from `bucket` when one is given.
+    A prompt that still fails after `retry.max_retries` retries yields None and counts as a failure
+    instead of aborting the whole run.
+    """
+    retry = retry or RetryPolicy()
+    sem = asyncio.Semaphore(concurrency)
+    rng = random.Random(seed)
+    stats = RunStats()
+
+    async def attempts(prompt: str) -> Optional[str]:
+        for attempt in range(retry.max_retries + 1):
+            if bucket is not None:
+                await bucket.acquire()
+            stats.calls += 1
+            try:
+                return await provider.acomplete(prompt)
+            except TransientError as e:
+                stats.errors[e.kind] = stats.errors.get(e.kind, 0) + 1
+                if attempt == retry.max_retries:
+                    break
+                stats.retries += 1
+                await asyncio.sleep(retry.delay(attempt, rng, e.retry_after))
+        stats.failures += 1
+        return None
+
+    async def one(prompt: str) -> Optional[str]:
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                return await attempts(prompt)
+            finally:
+                stats.latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(one(p) for p in prompts))
+    finally:
+        await provider.aclose()
+    stats.seconds = time.perf_counter() - t0
+    return list(results), stats
+
+
+def complete_many(
+    provider: Provider,
+    prompts: Sequence[str],
+    concurrency: int = 1,
+    bucket: Optional[TokenBucket] = None,
+    retry: Optional[RetryPolicy] = None,
+) -> tuple[list[Optional[str]], RunStats]:
+    """Sync entry point: `run_prompts` when concurrency > 1, otherwise `complete_with_retry` in a loop.
+
+    `bucket` rate-limits both paths; pass the same bucket to every call of a run.
+    """
+    retry = retry or RetryPolicy()
+    if concurrency > 1:
+        return asyncio.run(run_prompts(provider, prompts, concurrency, bucket, retry))
+    stats, rng = RunStats(), random.Random(0)
+    t0 = time.perf_counter()
+    outputs = [complete_with_retry(provider, p, retry, rng, stats, bucket) for p in prompts]
+    stats.seconds = time.perf_counter() - t0
+    return outputs, stats
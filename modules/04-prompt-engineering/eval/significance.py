@@ -0,0 +1,176 @@
+"""Streaming statistics for comparing prompt templates on the same examples.
+
+- `ConfusionMatrix`: gold × predicted counts updated one example at a time, plus per-label
+  precision / recall / F1. Predictions outside the label set count as `<other>`, failed calls
+  as `<error>`.
+- `mcnemar`: exact McNemar test on paired correctness (both templates saw the same examples;
+  normal approximation beyond 1000 discordant pairs), with a Wald CI for the accuracy difference.
+- `bootstrap_diff_ci`: paired bootstrap CI for the accuracy difference, for the final report.
+- `SequentialStopper`: after each batch, drops templates that are significantly worse than the
+  current leader. The per-test alpha is Bonferroni-corrected over planned looks and comparisons,
+  so peeking after every batch does not inflate the false-drop rate above `alpha`.
+
+Pure Python (stdlib only), no numpy/scipy needed.
+"""
+import math
+import random
+from dataclasses import dataclass, field
+from statistics import NormalDist
+from typing import Optional, Sequence
+
+OTHER = "<other>"
+ERROR = "<error>"
+
+
+@dataclass
+class ConfusionMatrix:
+    labels: list[str]
+    counts: dict = field(default_factory=dict)  # (gold, pred) -> n
+
+    def update(self, gold: str, pred: Optional[str]) -> None:
+        if pred is None:
+            pred = ERROR
+        elif pred not in self.labels:
+            pred = OTHER
+        self.counts[(gold, pred)] = self.counts.get((gold, pred), 0) + 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def correct(self) -> int:
+        return sum(n for (gold, pred), n in self.counts.items() if gold == pred)
+
+    @property
+    def accuracy(self) -> float:
+        return self.correct / max(self.total, 1)
+
+    def per_label(self) -> dict:
+        out = {}
+        for label in self.labels:
+            tp = self.counts.get((label, label), 0)
+            predicted = sum(n for (_, pred), n in self.counts.items() if pred == label)
+            support = sum(n for (gold, _), n in self.counts.items() if gold == label)
+            precision = tp / predicted if predicted else 0.0
+            recall = tp / support if support else 0.0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+            out[label] = {"precision": round(precision, 4), "recall": round(recall, 4),
+                          "f1": round(f1, 4), "support": support}
+        return out
+
+    def to_dict(self) -> dict:
+        """Rows are gold labels, columns the label set plus `<other>` / `<error>` when they occur."""
+        preds = list(self.labels) + [p for p in (OTHER, ERROR) if any(k[1] == p for k in self.counts)]
+        golds = list(self.labels) + sorted({g for g, _ in self.counts} - set(self.labels))
+        return {
+            "columns": preds,
+            "rows": golds,
+            "matrix": [[self.counts.get((g, p), 0) for p in preds] for g in golds],
+        }
+
+
+EXACT_MAX_N = 1000
+
+
+def _binom_two_sided(k: int, n: int) -> float:
+    """Two-sided p-value of k successes out of n under p = 0.5.
+
+    Exact for n <= `EXACT_MAX_N`: the tail is summed in floats from the largest term down
+    (log-space start, ratio recurrence), O(k). Above that, the normal approximation with
+    continuity correction, which is accurate to well below any alpha used here.
+    """
+    if n == 0:
+        return 1.0
+    k = min(k, n - k)
+    if n > EXACT_MAX_N:
+        z = (n / 2 - k - 0.5) / math.sqrt(n / 4)
+        return min(1.0, 2 * (1 - NormalDist().cdf(z)))
+    # P(X = k) 在对数空间计算，避免 2**n 与大整数组合数；再按 P(i-1) = P(i) * i / (n - i + 1) 向下累加
+    term = math.exp(math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1) - n * math.log(2))
+    tail = 0.0
+    for i in range(k, -1, -1):
+        tail += term
+        term *= i / (n - i + 1)
+        if term < tail * 1e-17:
+            break
+    return min(1.0, 2 * tail)
+
+
+def mcnemar(correct_a: Sequence[bool], correct_b: Sequence[bool], alpha: float = 0.05) -> dict:
+    """Paired comparison of B against A on the same examples.
+
+    b = A right & B wrong, c = A wrong & B right. The p-value is the exact binomial test on the
+    b + c discordant pairs (continuity-corrected normal approximation when b + c > 1000);
+    `ci` is the Wald interval for acc_b - acc_a = (c - b) / n.
+    """
+    n = min(len(correct_a), len(correct_b))
+    b = sum(1 for x, y in zip(correct_a[:n], correct_b[:n]) if x and not y)
+    c = sum(1 for x, y in zip(correct_a[:n], correct_b[:n]) if y and not x)
+    diff = (c - b) / n if n else 0.0
+    se = math.sqrt(max(b + c - (c - b) ** 2 / n, 0.0)) / n if n else 0.0
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    return {
+        "n": n,
+        "a_only": b,
+        "b_only": c,
+        "diff": diff,
+        "ci": (diff - z * se, diff + z * se),
+        "p_value": _binom_two_sided(c, b + c),
+    }
+
+
+def bootstrap_diff_ci(
+    correct_a: Sequence[bool],
+    correct_b: Sequence[bool],
+    n_boot: int = 1000,
+    alpha: float = 0.05,
+    seed: int = 0,
+) -> tuple[float, float]:
+    """Paired percentile bootstrap CI for acc_b - acc_a (examples resampled jointly)."""
+    n = min(len(correct_a), len(correct_b))
+    if n == 0:
+        return (0.0, 0.0)
+    d = [int(y) - int(x) for x, y in zip(correct_a[:n], correct_b[:n])]
+    rng = random.Random(seed)
+    diffs = sorted(sum(rng.choices(d, k=n)) / n for _ in range(n_boot))
+    lo = diffs[int(alpha / 2 * (n_boot - 1))]
+    hi = diffs[int(math.ceil((1 - alpha / 2) * (n_boot - 1)))]
+    return (lo, hi)
+
+
+@dataclass
+class SequentialStopper:
+    """Drop templates that are significantly worse than the current leader, batch by batch.
+
+    `looks` is the planned number of checks (batches); each check runs one McNemar test per
+    non-leader template at alpha / (looks * (n_templates - 1)). No decision is made before
+    `min_samples` examples.
+    """
+
+    n_templates: int
+    looks: int
+    alpha: float = 0.05
+    min_samples: int = 50
+
+    @property
+    def alpha_per_test(self) -> float:
+        return self.alpha / max(self.looks * (self.n_templates - 1), 1)
+
+    def check(self, correct: dict) -> dict:
+        """`correct`: name -> per-example correctness of the active templates (equal length).
+
+        Returns name -> McNemar result vs the leader for every template that should be dropped.
+        """
+        n = min((len(v) for v in correct.values()), default=0)
+        if len(correct) < 2 or n < self.min_samples:
+            return {}
+        leader = max(correct, key=lambda name: sum(correct[name][:n]))
+        dropped = {}
+        for name, values in correct.items():
+            if name == leader:
+                continue
+            res = mcnemar(correct[leader][:n], values[:n], self.alpha_per_test)
+            if res["diff"] < 0 and res["p_value"] < self.alpha_per_test:
+                dropped[name] = {**res, "leader": leader}
+        return dropped
@@ -0,0 +1,92 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+BASE = Path(__file__).resolve().parents[1] / "eval"
+spec = importlib.util.spec_from_file_location("label_stream", str(BASE / "label_stream.py"))
+ls = importlib.util.module_from_spec(spec)  # type: ignore
+assert spec and spec.loader
+spec.loader.exec_module(ls)  # type: ignore
+
+LABELS = ["积极", "中性", "消极"]
+
+
+@pytest.mark.parametrize(
+    "output, json_mode, status",
+    [
+        ("  \n", True, ls.EMPTY),
+        ("我觉得是积极", True, ls.NO_JSON),
+        ('{"label": "积', True, ls.TRUNCATED),
+        ('{"reason": "很好"', True, ls.TRUNCATED),
+        ("{label: 积极}", True, ls.INVALID_JSON),
+        ('{"label" "积极"}', True, ls.INVALID_JSON),
+        ('{"reason": "很好"}', True, ls.MISSING_LABEL),
+        ('{"label": 1}', True, ls.WRONG_TYPE),
+        ('{"label": ["积极"]}', True, ls.WRONG_TYPE),
+        ('{"label": "其他"}', True, ls.UNKNOWN_LABEL),
+        ("其他", False, ls.UNKNOWN_LABEL),
+        ("积极\n", False, ls.OK),
+        ('{"label": "积极"}', True, ls.OK),
+    ],
+)
+def test_failure_taxonomy(output, json_mode, status):
+    res = ls.extract(output, json_mode, LABELS)
+    assert res.status == status
+    # 失败时 label 回退为完整的去空白原文，而不是判定时已读到的前缀
+    assert res.label == ("积极" if status == ls.OK else output.strip())
+
+
+def test_label_found_before_rest_of_object():
+    out = '```json\n{"reason": {"a": [1, "}\\"]"]}, "n": -1.5e3, "label": "消\\u6781", "x": 1}\n```'
+    res = ls.extract(out, True, LABELS)
+    assert res.ok and res.label == "消极" and res.early
+    assert res.chars == out.index('"label": "') + len('"label": "消\\u6781"')
+
+
+def test_auto_mode_detects_json_or_text():
+    assert ls.extract('  {"label": "中性"}', None, LABELS).label == "中性"
+    assert ls.extract("```\n{\"label\": \"中性\"}\n```", None, LABELS).label == "中性"
+    res = ls.extract(" 中性 ", None, LABELS)
+    assert res.ok and res.label == "中性" and not res.early
+
+
+@pytest.mark.parametrize(
+    "output, json_mode",
+    [
+        ('{"reason": "因为\\"很好\\"", "label": "积极", "more": "ignored"}', True),
+        ('{"label": 1}', True),
+        ('{"label": "其他"}', True),
+        ('{"reason": "x"', True),
+        ("消极", False),
+        ("消息", False),
+    ],
+)
+def test_chunk_boundaries_do_not_change_result(output, json_mode):
+    whole = ls.extract(output, json_mode, LABELS)
+    for cut in range(len(output) + 1):
+        res = ls.extract_stream([output[:cut], output[cut:]], json_mode, LABELS)
+        assert (res.status, res.chars, res.early) == (whole.status, whole.chars, whole.early)
+        if whole.ok:
+            assert res.label == whole.label
+    chars = ls.extract_stream(iter(output), json_mode, LABELS)
+    assert (chars.status, chars.chars) == (whole.status, whole.chars)
+
+
+def test_stream_stops_pulling_once_determined():
+    pulled = []
+
+    def chunks():
+        for part in ['{"la', 'bel": "积', '极"', ', "reason": "', "never read"]:
+            pulled.append(part)
+            yield part
+
+    res = ls.extract_stream(chunks(), True, LABELS)
+    assert res.ok and res.label == "积极" and res.early
+    assert pulled[-1] == '极"'
+
+    # 文本模式：已不可能是任何标签时立即失败
+    rest = iter(["好", "的", "，我来分析"])
+    res = ls.extract_stream(rest, False, LABELS)
+    assert res.status == ls.UNKNOWN_LABEL and res.chars == 1
+    assert list(rest) == ["的", "，我来分析"]
@@ -0,0 +1,65 @@
+import importlib.util
+import math
+from pathlib import Path
+
+BASE = Path(__file__).resolve().parents[1] / "eval"
+spec = importlib.util.spec_from_file_location("significance", str(BASE / "significance.py"))
+sig = importlib.util.module_from_spec(spec)  # type: ignore
+assert spec and spec.loader
+spec.loader.exec_module(sig)  # type: ignore
+
+
+def _exact(k: int, n: int) -> float:
+    k = min(k, n - k)
+    return min(1.0, 2 * sum(math.comb(n, i) for i in range(k + 1)) / 2**n)
+
+
+def test_binom_matches_exact_sum():
+    assert sig._binom_two_sided(0, 0) == 1.0
+    for n in (1, 2, 7, 30, 200, 1000):
+        for k in range(0, n + 1, max(n // 13, 1)):
+            assert math.isclose(sig._binom_two_sided(k, n), _exact(k, n), rel_tol=1e-9, abs_tol=1e-300)
+
+
+def test_binom_normal_approximation_for_large_n():
+    for n, k in [(1001, 470), (3000, 1430), (5000, 2420)]:
+        assert math.isclose(sig._binom_two_sided(k, n), _exact(k, n), rel_tol=0.02)
+    # 十万级不一致对也是常数时间
+    assert sig._binom_two_sided(40_000, 100_000) < 1e-300
+
+
+def test_mcnemar_counts_discordant_pairs():
+    a = [True] * 40 + [False] * 10 + [True] * 50
+    b = [False] * 40 + [True] * 10 + [True] * 50
+    res = sig.mcnemar(a, b)
+    assert (res["n"], res["a_only"], res["b_only"]) == (100, 40, 10)
+    assert math.isclose(res["diff"], -0.3)
+    assert res["ci"][0] < -0.3 < res["ci"][1] < 0
+    assert math.isclose(res["p_value"], _exact(10, 50))
+    assert sig.mcnemar(a, a)["p_value"] == 1.0
+
+
+def test_bootstrap_ci_brackets_difference():
+    a = [i % 4 != 0 for i in range(400)]  # 0.75
+    b = [i % 2 == 0 for i in range(400)]  # 0.5
+    lo, hi = sig.bootstrap_diff_ci(a, b, n_boot=500)
+    assert lo < -0.25 < hi < 0
+
+
+def test_confusion_matrix_other_and_error():
+    cm = sig.ConfusionMatrix(["积极", "消极"])
+    for gold, pred in [("积极", "积极"), ("积极", "消极"), ("消极", "消极"), ("消极", "其他"), ("积极", None)]:
+        cm.update(gold, pred)
+    assert cm.total == 5 and cm.correct == 2
+    assert cm.to_dict()["columns"] == ["积极", "消极", sig.OTHER, sig.ERROR]
+    assert cm.per_label()["消极"] == {"precision": 0.5, "recall": 0.5, "f1": 0.5, "support": 2}
+
+
+def test_sequential_stopper_drops_clearly_worse_template():
+    stopper = sig.SequentialStopper(n_templates=3, looks=5, min_samples=50)
+    good = [True] * 200
+    close = [i % 50 != 0 for i in range(200)]  # 仅 4 个不一致对，不显著
+    bad = [i % 2 == 0 for i in range(200)]
+    assert stopper.check({"good": good[:40], "bad": bad[:40]}) == {}  # 未到 min_samples
+    dropped = stopper.check({"good": good, "close": close, "bad": bad})
+    assert set(dropped) == {"bad"} and dropped["bad"]["leader"] == "good"
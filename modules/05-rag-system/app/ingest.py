@@ -11,7 +11,7 @@ from retrievers import Document, LocalTfidfRetriever
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--docs", required=True, help="Plaintext file, one document per line")
-    ap.add_argument("--index", required=True, help="Path to save local index (pickle)")
+    ap.add_argument("--index", required=True, help="Index directory (mmap format); a *.pkl path writes the legacy pickle")
     args = ap.parse_args()
 
     docs = []
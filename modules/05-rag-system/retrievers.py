@@ -1,13 +1,20 @@
 from __future__ import annotations
 
+import bisect
 import json
+import math
+import mmap
+import os
 import pickle
+import re
+import shutil
+import tempfile
+from collections import Counter
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
+import numpy as np
 
 try:  # optional dependency – only required when using Milvus
     from pymilvus import (
@@ -34,43 +41,257 @@ class Document:
     meta: dict
 
 
+INDEX_FORMAT = "tfidf-mmap-v1"
+MANIFEST = "index.json"
+CURRENT = "CURRENT"  # 指向当前一代索引子目录的指针文件
+# 查询向量化所需的 TfidfVectorizer 参数（均可 JSON 序列化）
+ANALYZER_PARAMS = (
+    "analyzer", "lowercase", "token_pattern", "ngram_range", "stop_words", "strip_accents",
+    "binary", "sublinear_tf", "norm", "use_idf",
+)
+DEFAULT_ANALYZER = {
+    "analyzer": "word", "ngram_range": [1, 1], "stop_words": None, "strip_accents": None,
+}
+
+
+def _readonly_mmap(path: Path):
+    """整个文件的只读 mmap；空文件无法 mmap，返回 b""。"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class JsonlColumn:
+    """meta.jsonl 的只读视图：按行偏移定位第 i 行，只解析被访问的行。"""
+
+    def __init__(self, blob, offsets: np.ndarray, field: str):
+        self.blob = blob
+        self.offsets = offsets
+        self.field = field
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return json.loads(self.blob[start:end])[self.field]
+
+
+class TermIndex:
+    """按 UTF-8 字节序排序的词表（拼接存储 + 偏移），二分查找词 → 列号，加载时无需建 dict。"""
+
+    def __init__(self, blob, offsets: np.ndarray, cols: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+        self.cols = cols
+
+    def __len__(self) -> int:
+        return len(self.cols)
+
+    def _term(self, i: int) -> bytes:
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def get(self, term: str) -> Optional[int]:
+        key = term.encode("utf-8")
+        i = bisect.bisect_left(range(len(self)), key, key=self._term)
+        if i < len(self) and self._term(i) == key:
+            return int(self.cols[i])
+        return None
+
+
 class LocalTfidfRetriever:
+    """本地 TF-IDF 检索。
+
+    索引有两种落盘格式：
+    - 目录（默认）：`CURRENT` 指向当前一代子目录，其中 CSR 矩阵 data/indices/indptr、idf 与
+      排序词表存为 .npy，按 `mmap_mode="r"` 打开；doc_id 与 meta 存为 meta.jsonl + 行偏移，检索时只解析 top_k 行。加载只读取
+      index.json，耗时与语料规模无关，也不需要导入 scikit-learn；
+    - `*.pkl`：旧版 pickle（整个 TfidfVectorizer + 稀疏矩阵 + meta 列表），仍可读写。
+    """
+
     def __init__(self):
-        self.vectorizer = TfidfVectorizer(max_features=20000)
+        self.vectorizer = None  # ingest 时创建；目录格式加载的索引不需要它
+        self.max_features = 20000
         self.doc_ids: list[str] = []
         self.meta: list[dict] = []
         self.matrix = None
+        # 目录格式（mmap）加载后的只读数据
+        self.csr: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        self.idf: Optional[np.ndarray] = None
+        self.terms: Optional[TermIndex] = None
+        self.params: dict = {}
+        self._analyzer = None
 
     def ingest(self, docs: List[Document]):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        if self.vectorizer is None:
+            self.vectorizer = TfidfVectorizer(max_features=self.max_features)
         self.doc_ids = [d.doc_id for d in docs]
         self.meta = [d.meta for d in docs]
         texts = [d.text for d in docs]
         self.matrix = self.vectorizer.fit_transform(texts)
+        self.csr = None
 
     def search(self, query: str, top_k: int = 5) -> List[Tuple[str, float, dict]]:
-        if self.matrix is None:
+        if self.csr is not None:
+            sims = self._scores_mmap(query)
+        elif self.matrix is not None:
+            from sklearn.metrics.pairwise import linear_kernel
+
+            q = self.vectorizer.transform([query])
+            sims = linear_kernel(q, self.matrix).ravel()
+        else:
             raise RuntimeError("index not built")
-        q = self.vectorizer.transform([query])
-        sims = linear_kernel(q, self.matrix).ravel()
-        idx = sims.argsort()[::-1][:top_k]
+        if top_k < len(sims):
+            top = np.argpartition(-sims, top_k)[:top_k]
+            idx = top[np.argsort(-sims[top], kind="stable")]
+        else:
+            idx = sims.argsort()[::-1]
         return [(
             self.doc_ids[i],
             float(sims[i]),
             self.meta[i],
         ) for i in idx]
 
+    # --- mmap 检索 -------------------------------------------------------------------------
+    def _analyze(self, text: str) -> List[str]:
+        if self._analyzer is None:
+            p = self.params
+            if all(p.get(k) == v for k, v in DEFAULT_ANALYZER.items()):
+                pattern = re.compile(p["token_pattern"])
+                lowercase = p["lowercase"]
+                self._analyzer = lambda doc: pattern.findall(doc.lower() if lowercase else doc)
+            else:  # 非默认分词配置交给 sklearn 复现
+                from sklearn.feature_extraction.text import TfidfVectorizer
+
+                kwargs = {k: p[k] for k in ANALYZER_PARAMS}
+                kwargs["ngram_range"] = tuple(kwargs["ngram_range"])
+                self._analyzer = TfidfVectorizer(**kwargs).build_analyzer()
+        return self._analyzer(text)
+
+    def _query_weights(self, query: str) -> Dict[int, float]:
+        """与 TfidfVectorizer.transform 相同的 tf → (sublinear) → ×idf → 归一化。"""
+        p = self.params
+        counts = Counter(c for c in map(self.terms.get, self._analyze(query)) if c is not None)
+        weights = {}
+        for col, tf in counts.items():
+            w = 1.0 if p["binary"] else float(tf)
+            if p["sublinear_tf"]:
+                w = 1.0 + math.log(w)
+            if p["use_idf"]:
+                w *= float(self.idf[col])
+            weights[col] = w
+        if p["norm"] == "l2":
+            norm = math.sqrt(sum(w * w for w in weights.values()))
+        elif p["norm"] == "l1":
+            norm = sum(abs(w) for w in weights.values())
+        else:
+            norm = 1.0
+        return {c: w / norm for c, w in weights.items()} if norm else weights
+
+    def _scores_mmap(self, query: str) -> np.ndarray:
+        data, indices, indptr = self.csr
+        n_docs = len(indptr) - 1
+        weights = self._query_weights(query)
+        if not weights:
+            return np.zeros(n_docs)
+        q = np.zeros(len(self.terms))
+        for col, w in weights.items():
+            q[col] = w
+        # 只取命中查询词的非零元；bincount 按位置顺序累加，与逐行点积的求和顺序一致
+        pos = np.flatnonzero(q[indices])
+        rows = np.searchsorted(indptr, pos, side="right") - 1
+        return np.bincount(rows, weights=data[pos] * q[indices[pos]], minlength=n_docs)
+
+    # --- 持久化 ----------------------------------------------------------------------------
     def save(self, path: str):
+        """`*.pkl` 写旧版 pickle，其余路径写 mmap 目录格式。"""
+        if Path(path).suffix == ".pkl":
+            self._save_pickle(path)
+        else:
+            self._save_dir(path)
+
+    def _save_pickle(self, path: str):
+        if self.vectorizer is None:
+            raise ValueError("pickle format needs the fitted vectorizer; re-ingest or save as a directory")
         Path(path).parent.mkdir(parents=True, exist_ok=True)
         with open(path, "wb") as f:
             pickle.dump({
                 "vectorizer": self.vectorizer,
-                "doc_ids": self.doc_ids,
-                "meta": self.meta,
+                "doc_ids": list(self.doc_ids),
+                "meta": list(self.meta),
                 "matrix": self.matrix,
             }, f)
 
+    def _export_arrays(self) -> tuple:
+        """(params, (data, indices, indptr), idf, [(term_bytes, col)] 按字节序排序)。"""
+        if self.csr is not None:
+            terms = [(self.terms._term(i), int(self.terms.cols[i])) for i in range(len(self.terms))]
+            return self.params, self.csr, self.idf, terms
+        if self.matrix is None:
+            raise RuntimeError("index not built")
+        vec = self.vectorizer
+        params = vec.get_params()
+        if callable(params["analyzer"]) or params["preprocessor"] or params["tokenizer"]:
+            raise ValueError("custom analyzer callables cannot be stored in the mmap format, use *.pkl")
+        params = {k: params[k] for k in ANALYZER_PARAMS}
+        params["ngram_range"] = list(params["ngram_range"])
+        idf = vec.idf_ if params["use_idf"] else np.ones(len(vec.vocabulary_))
+        terms = sorted((t.encode("utf-8"), int(c)) for t, c in vec.vocabulary_.items())
+        m = self.matrix.tocsr()
+        return params, (m.data, m.indices, m.indptr), idf, terms
+
+    def _save_dir(self, path: str):
+        """写入 `path/gen-*/` 新的一代索引，再原子替换指针文件 `path/CURRENT`。
+
+        `os.replace` 只能原子替换文件，替换非空目录需要两步、中间会有一段时间没有索引；
+        因此各代索引放在子目录中，读者通过 CURRENT 定位，切换只是一次文件 rename。
+        已打开旧索引的进程继续读它的 mmap，不受删除影响。
+        """
+        params, (data, indices, indptr), idf, terms = self._export_arrays()
+        out = Path(path)
+        out.mkdir(parents=True, exist_ok=True)
+        gen = Path(tempfile.mkdtemp(prefix="gen-", dir=out))
+
+        np.save(gen / "data.npy", np.asarray(data, dtype=np.float64))
+        np.save(gen / "indices.npy", np.asarray(indices))
+        np.save(gen / "indptr.npy", np.asarray(indptr))
+        np.save(gen / "idf.npy", np.asarray(idf, dtype=np.float64))
+        blob = b"".join(t for t, _ in terms)
+        (gen / "vocab.bin").write_bytes(blob)
+        np.save(gen / "vocab_offsets.npy", np.concatenate([[0], np.cumsum([len(t) for t, _ in terms])]).astype(np.int64))
+        np.save(gen / "vocab_cols.npy", np.asarray([c for _, c in terms], dtype=np.int32))
+
+        offsets = [0]
+        with open(gen / "meta.jsonl", "wb") as f:
+            for doc_id, meta in zip(self.doc_ids, self.meta):
+                line = (json.dumps({"doc_id": doc_id, "meta": meta}, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.save(gen / "meta_offsets.npy", np.asarray(offsets, dtype=np.int64))
+
+        manifest = {
+            "format": INDEX_FORMAT,
+            "n_docs": len(indptr) - 1,
+            "n_features": len(terms),
+            "nnz": int(len(data)),
+            "params": params,
+        }
+        (gen / MANIFEST).write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+        # 新一代写完后才切换指针：读者要么看到旧索引，要么看到完整的新索引
+        pointer_tmp = out / (CURRENT + ".tmp")
+        pointer_tmp.write_text(gen.name, encoding="utf-8")
+        os.replace(pointer_tmp, out / CURRENT)
+        for old in out.glob("gen-*"):
+            if old != gen:
+                shutil.rmtree(old, ignore_errors=True)
+
     @staticmethod
     def load(path: str) -> "LocalTfidfRetriever":
+        if Path(path).is_dir():
+            return LocalTfidfRetriever._load_dir(path)
         with open(path, "rb") as f:
             obj = pickle.load(f)
         inst = LocalTfidfRetriever()
@@ -80,6 +301,28 @@ class LocalTfidfRetriever:
         inst.matrix = obj["matrix"]
         return inst
 
+    @staticmethod
+    def _load_dir(path: str) -> "LocalTfidfRetriever":
+        root = Path(path)
+        if (root / CURRENT).exists():  # 没有指针文件时按单层目录读取（早期写法）
+            root = root / (root / CURRENT).read_text(encoding="utf-8").strip()
+        manifest = json.loads((root / MANIFEST).read_text(encoding="utf-8"))
+        if manifest.get("format") != INDEX_FORMAT:
+            raise ValueError(f"unsupported index format: {manifest.get('format')}")
+
+        def arr(name: str) -> np.ndarray:
+            return np.load(root / name, mmap_mode="r")
+
+        inst = LocalTfidfRetriever()
+        inst.params = manifest["params"]
+        inst.csr = (arr("data.npy"), arr("indices.npy"), arr("indptr.npy"))
+        inst.idf = arr("idf.npy")
+        inst.terms = TermIndex(_readonly_mmap(root / "vocab.bin"), arr("vocab_offsets.npy"), arr("vocab_cols.npy"))
+        meta_blob, meta_offsets = _readonly_mmap(root / "meta.jsonl"), arr("meta_offsets.npy")
+        inst.doc_ids = JsonlColumn(meta_blob, meta_offsets, "doc_id")  # type: ignore[assignment]
+        inst.meta = JsonlColumn(meta_blob, meta_offsets, "meta")  # type: ignore[assignment]
+        return inst
+
 
 class MilvusRetriever:
     """Milvus 检索实现，支持最小可复现的向量检索流程。
@@ -0,0 +1,103 @@
+import importlib.util
+import random
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sklearn")
+
+BASE = Path(__file__).resolve().parents[1]
+spec = importlib.util.spec_from_file_location("retrievers", str(BASE / "retrievers.py"))
+mod = importlib.util.module_from_spec(spec)  # type: ignore
+assert spec and spec.loader
+sys.modules["retrievers"] = mod  # dataclass 解析注解时需要从 sys.modules 找到模块
+spec.loader.exec_module(mod)  # type: ignore
+Document = mod.Document
+LocalTfidfRetriever = mod.LocalTfidfRetriever
+
+WORDS = ["检索增强", "向量数据库", "重排序", "café", "naïve", "LoRA", "微调", "延迟"] + [f"w{i}" for i in range(300)]
+
+
+def _docs(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        Document(f"doc-{i}", " ".join(rng.choices(WORDS, k=rng.randint(3, 30))), {"line": i, "来源": "样例"})
+        for i in range(n)
+    ]
+
+
+def _built(n: int = 400, seed: int = 0) -> LocalTfidfRetriever:
+    retr = LocalTfidfRetriever()
+    retr.ingest(_docs(n, seed))
+    return retr
+
+
+def _assert_same(a, b, query, top_k=10):
+    ra, rb = a.search(query, top_k), b.search(query, top_k)
+    assert [d for d, _, _ in ra] == [d for d, _, _ in rb], query
+    assert np.allclose([s for _, s, _ in ra], [s for _, s, _ in rb], rtol=0, atol=1e-12), query
+    assert [m for _, _, m in ra] == [m for _, _, m in rb]
+
+
+def test_dir_format_matches_pickle(tmp_path):
+    retr = _built()
+    retr.save(str(tmp_path / "idx.pkl"))
+    retr.save(str(tmp_path / "idx"))
+    pkl = LocalTfidfRetriever.load(str(tmp_path / "idx.pkl"))
+    mm = LocalTfidfRetriever.load(str(tmp_path / "idx"))
+    assert mm.vectorizer is None and mm.csr is not None
+
+    rng = random.Random(1)
+    queries = ["检索增强 向量数据库", "CAFÉ naïve", "LoRA 微调 LoRA", "完全不在词表里 zzz", ""]
+    queries += [" ".join(rng.choices(WORDS, k=rng.randint(1, 5))) + " 未登录词" for _ in range(50)]
+    for q in queries:
+        _assert_same(pkl, mm, q)
+    # top_k 大于文档数时返回全部
+    _assert_same(pkl, mm, "重排序", top_k=1000)
+
+
+def test_term_index_lookup(tmp_path):
+    retr = _built()
+    retr.save(str(tmp_path / "idx"))
+    terms = LocalTfidfRetriever.load(str(tmp_path / "idx")).terms
+    vocab = retr.vectorizer.vocabulary_
+    for term in ["检索增强", "café", "w17", "lora"]:
+        assert terms.get(term) == vocab[term]
+    assert terms.get("lor") is None and terms.get("不存在") is None and terms.get("") is None
+
+
+def test_save_twice_to_same_path(tmp_path):
+    path = str(tmp_path / "idx")
+    first = _built(200, seed=0)
+    first.save(path)
+    opened = LocalTfidfRetriever.load(path)
+    before = opened.search("重排序 延迟", 5)
+
+    second = _built(50, seed=2)
+    second.save(path)
+    reloaded = LocalTfidfRetriever.load(path)
+    _assert_same(second, reloaded, "重排序 延迟")
+    assert len(reloaded.doc_ids) == 50
+    # 旧的一代已删除，只剩指针文件与当前一代
+    assert sorted(p.name for p in Path(path).iterdir())[0] == mod.CURRENT
+    assert len(list(Path(path).glob("gen-*"))) == 1
+    # 切换前已加载的索引仍可检索（mmap 持有旧文件）
+    assert opened.search("重排序 延迟", 5) == before
+
+    # mmap 加载的索引可直接另存（不经 scikit-learn）
+    reloaded.save(path)
+    _assert_same(second, LocalTfidfRetriever.load(path), "向量数据库")
+
+
+def test_pickle_path_still_loads(tmp_path):
+    retr = _built()
+    path = str(tmp_path / "legacy.pkl")
+    retr.save(path)
+    loaded = LocalTfidfRetriever.load(path)
+    assert loaded.vectorizer is not None and loaded.csr is None
+    _assert_same(retr, loaded, "检索增强 w3")
+    # pickle 加载后转换为目录格式
+    loaded.save(str(tmp_path / "converted"))
+    _assert_same(retr, LocalTfidfRetriever.load(str(tmp_path / "converted")), "检索增强 w3")
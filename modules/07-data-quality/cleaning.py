@@ -1,11 +1,50 @@
+"""清洗规则与质量门控。
+
+- `apply_rules` / `quality_gate`：内存版，输入一个完整 DataFrame。
+- `clean_stream`：流式版，按固定行数分块读取 JSONL/Parquet，峰值内存只与块大小有关：
+  - 三列拼接文本每块只计算一次（Arrow 字符串），规则与门控共用；
+  - 精确去重跨块进行，状态只保存每条记录的 64 bit 哈希（有序 NumPy 数组）；
+  - 通过与拦截的样本分别写入两个输出（拦截样本附带 `reject_reason` 列）。
+- 传入 `gate_rules.RuleSet`（`--rules`）时门控改用多模式规则引擎，并输出逐规则命中数与耗时；
+  `--gate-workers` > 1 时门控在多进程间并行。
+
+示例：
+```
+python modules/07-data-quality/cleaning.py --input raw.jsonl --passed clean.jsonl \
+  --rejected rejected.jsonl --chunk-size 100000 --rules blocklist.json --gate-workers 8
+```
+"""
 from __future__ import annotations
 
-import re
+import argparse
+import json
+import sys
+import time
 from dataclasses import dataclass
-from typing import Iterable, List, Tuple
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
 
+import numpy as np
 import pandas as pd
 
+BASE = Path(__file__).resolve().parent
+sys.path.append(str(BASE))
+
+from gate_rules import RuleSet, RuleStats, load_rules, open_pool  # noqa: E402
+from near_dedup import SortedKeySet  # noqa: E402
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    STRING_DTYPE = pd.StringDtype("pyarrow")
+except ImportError:  # 无 pyarrow 时退回 pandas 自带字符串类型（不支持 Parquet）
+    pa = pq = None
+    STRING_DTYPE = pd.StringDtype("python")
+
+TEXT_COLUMNS = ["instruction", "input", "output"]
+GATE_PATTERN = r"(?:http[s]?://\S+|<script|select\s+\*|drop\s+table)"
+
 
 @dataclass
 class Rules:
@@ -14,26 +53,240 @@ class Rules:
     drop_na: bool = True
 
 
-def apply_rules(df: pd.DataFrame, rules: Rules) -> pd.DataFrame:
-    df2 = df.copy()
+def combined_text(df: pd.DataFrame) -> pd.Series:
+    """instruction + input + output 拼接文本（Arrow 字符串），规则与门控共用。"""
+    parts = [df[c].astype(STRING_DTYPE).fillna("") for c in TEXT_COLUMNS]
+    return parts[0] + parts[1] + parts[2]
+
+
+def rule_reasons(
+    df: pd.DataFrame,
+    text: pd.Series,
+    rules: Rules,
+    seen: SortedKeySet | None = None,
+) -> np.ndarray:
+    """逐行给出规则拦截原因（"" 表示通过）：na / length / duplicate。
+
+    `seen` 为跨块去重状态：命中即判重复，本块首次出现的记录哈希会加入其中。
+    """
+    reasons = np.full(len(df), "", dtype=object)
     if rules.drop_na:
-        df2 = df2.dropna(subset=["instruction", "output"])  # 必要字段
-    # 计算合并文本长度
-    text = (df2["instruction"].astype(str) + df2["input"].fillna("").astype(str) + df2["output"].astype(str))
-    mask = text.str.len().between(rules.min_len, rules.max_len)
-    df2 = df2[mask]
-    # 去重
-    df2 = df2.drop_duplicates(subset=["instruction", "input", "output"], keep="first")
-    return df2.reset_index(drop=True)
+        na = (df["instruction"].isna() | df["output"].isna()).to_numpy()  # 必要字段
+        reasons[na] = "na"
+    bad_len = ~text.str.len().between(rules.min_len, rules.max_len).to_numpy(dtype=bool, na_value=False)
+    reasons[(reasons == "") & bad_len] = "length"
 
+    cand = np.flatnonzero(reasons == "")
+    if len(cand):
+        hashes = pd.util.hash_pandas_object(df.iloc[cand][TEXT_COLUMNS], index=False).to_numpy()
+        dup = pd.Series(hashes).duplicated(keep="first").to_numpy(copy=True)
+        if seen is not None:
+            dup |= seen.contains(hashes)
+            seen.add(hashes[~dup])
+        reasons[cand[dup]] = "duplicate"
+    return reasons
 
-def quality_gate(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    """简单门控：拦截包含明显噪声模式的样本。
+
+def gate_mask(text: pd.Series) -> np.ndarray:
+    """噪声模式命中掩码（True 表示拦截）。"""
+    return text.str.contains(GATE_PATTERN, case=False, regex=True).to_numpy(dtype=bool, na_value=False)
+
+
+def apply_rules(df: pd.DataFrame, rules: Rules) -> pd.DataFrame:
+    reasons = rule_reasons(df, combined_text(df), rules)
+    return df[reasons == ""].reset_index(drop=True)
+
+
+def quality_gate(df: pd.DataFrame, ruleset: RuleSet | None = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """简单门控：拦截包含明显噪声模式的样本；给定 ruleset 时改用规则引擎。
 
     返回：(passed, rejected)
     """
-    pattern = re.compile(r"(http[s]?://\S+|<script|select\s+\*|drop\s+table)", re.I)
-    text = (df["instruction"].astype(str) + df["input"].fillna("").astype(str) + df["output"].astype(str))
-    bad = text.str.contains(pattern)
+    text = combined_text(df)
+    bad = ruleset.evaluate(text.tolist())[0] if ruleset is not None else gate_mask(text)
     return df[~bad].reset_index(drop=True), df[bad].reset_index(drop=True)
 
+
+def _to_arrow_strings(df: pd.DataFrame) -> pd.DataFrame:
+    for c in TEXT_COLUMNS:
+        if c not in df:
+            df[c] = pd.Series([None] * len(df), index=df.index)
+        df[c] = df[c].astype(STRING_DTYPE)
+    return df
+
+
+def iter_chunks(path: str | Path, chunk_size: int = 100_000) -> Iterator[pd.DataFrame]:
+    """按 chunk_size 行分块读取 JSONL 或 Parquet，三列文本转为 Arrow 字符串。"""
+    path = Path(path)
+    if path.suffix == ".parquet":
+        if pq is None:
+            raise ImportError("Parquet 输入需要安装 pyarrow")
+        mapper = {pa.string(): STRING_DTYPE, pa.large_string(): STRING_DTYPE}.get
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield _to_arrow_strings(batch.to_pandas(types_mapper=mapper))
+    else:
+        reader = pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False, convert_dates=False)
+        with reader:
+            for chunk in reader:
+                yield _to_arrow_strings(chunk)
+
+
+class JsonlSink:
+    def __init__(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(path, "w", encoding="utf-8")
+
+    def write(self, df: pd.DataFrame) -> None:
+        if not len(df):
+            return
+        text = df.to_json(orient="records", lines=True, force_ascii=False)
+        self.f.write(text if text.endswith("\n") else text + "\n")  # 旧版 pandas 末行不带换行
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class ParquetSink:
+    """首个非空块确定 schema，后续块按同一 schema 追加为 row group。"""
+
+    def __init__(self, path: str | Path):
+        if pq is None:
+            raise ImportError("Parquet 输出需要安装 pyarrow")
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.writer = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        if not len(df):
+            return
+        if self.writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False)
+        self.writer.write_table(table)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_sink(path: str | Path):
+    return ParquetSink(path) if Path(path).suffix == ".parquet" else JsonlSink(path)
+
+
+def _peak_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)  # Linux 单位为 KB
+
+
+def clean_chunk(
+    df: pd.DataFrame,
+    rules: Rules,
+    seen: SortedKeySet | None = None,
+    ruleset: RuleSet | None = None,
+    gate_stats: RuleStats | None = None,
+    pool=None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """对一个块依次执行规则与门控（拼接文本只算一次），返回 (passed, rejected)。
+
+    ruleset 只评估通过规则的行，逐规则统计累加到 gate_stats。
+    """
+    text = combined_text(df)
+    reasons = rule_reasons(df, text, rules, seen)
+    ok = reasons == ""
+    if ruleset is None:
+        reasons[ok & gate_mask(text)] = "gate"
+    else:
+        idx = np.flatnonzero(ok)
+        bad, stats = ruleset.evaluate(text.iloc[idx].tolist(), pool=pool)
+        reasons[idx[bad]] = "gate"
+        if gate_stats is not None:
+            gate_stats.merge(stats)
+    ok = reasons == ""
+    rejected = df[~ok].assign(reject_reason=reasons[~ok])
+    return df[ok], rejected
+
+
+def clean_stream(
+    input_path: str | Path,
+    passed_path: str | Path,
+    rejected_path: str | Path | None = None,
+    rules: Rules | None = None,
+    chunk_size: int = 100_000,
+    ruleset: RuleSet | None = None,
+    gate_workers: int = 1,
+) -> dict:
+    """流式清洗：分块读入 → 规则（跨块去重）→ 门控 → 分别写出通过/拦截样本。"""
+    rules = rules or Rules()
+    seen = SortedKeySet()
+    gate_stats = RuleStats() if ruleset is not None else None
+    counts: Dict[str, int] = {"na": 0, "length": 0, "duplicate": 0, "gate": 0}
+    rows = passed = chunks = 0
+
+    start = time.perf_counter()
+    passed_sink = open_sink(passed_path)
+    rejected_sink = open_sink(rejected_path) if rejected_path else None
+    pool = open_pool(ruleset, gate_workers) if ruleset is not None and gate_workers > 1 else None
+    try:
+        for chunk in iter_chunks(input_path, chunk_size):
+            ok, bad = clean_chunk(chunk, rules, seen, ruleset, gate_stats, pool)
+            passed_sink.write(ok)
+            if rejected_sink:
+                rejected_sink.write(bad)
+            for reason, n in bad["reject_reason"].value_counts().items():
+                counts[reason] += int(n)
+            rows += len(chunk)
+            passed += len(ok)
+            chunks += 1
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        passed_sink.close()
+        if rejected_sink:
+            rejected_sink.close()
+    elapsed = time.perf_counter() - start
+
+    out = {
+        "rows": rows,
+        "passed": passed,
+        "rejected": counts,
+        "chunks": chunks,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed > 0 else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+    if gate_stats is not None:
+        out["gate_rules"] = gate_stats.to_dict()
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Chunked rule-based cleaning and quality gate")
+    ap.add_argument("--input", required=True, help="JSONL 或 .parquet")
+    ap.add_argument("--passed", required=True, help="通过样本输出（按后缀选择 JSONL/Parquet）")
+    ap.add_argument("--rejected", default=None, help="可选，拦截样本输出")
+    ap.add_argument("--chunk-size", type=int, default=100_000, help="每块行数")
+    ap.add_argument("--min-len", type=int, default=10)
+    ap.add_argument("--max-len", type=int, default=2048)
+    ap.add_argument("--keep-na", action="store_true", help="不丢弃必要字段为空的样本")
+    ap.add_argument("--rules", default=None, help="可选，门控规则 JSON（见 gate_rules.py）")
+    ap.add_argument("--profile-rules", action="store_true", help="每条正则单独扫描全部文本（跳过合并预筛），统计全量耗时")
+    ap.add_argument("--gate-workers", type=int, default=1, help="门控并行进程数（需 --rules）")
+    args = ap.parse_args()
+
+    rules = Rules(min_len=args.min_len, max_len=args.max_len, drop_na=not args.keep_na)
+    ruleset = RuleSet(load_rules(args.rules), profile=args.profile_rules) if args.rules else None
+    stats = clean_stream(
+        args.input, args.passed, args.rejected, rules, args.chunk_size,
+        ruleset=ruleset, gate_workers=args.gate_workers,
+    )
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""多模式质量门控：字面量走 Aho-Corasick 自动机，正则合并为一个扫描器。
+
+- 字面量规则（kind="literal"）全部编译进一个 Aho-Corasick 自动机，每条文本只扫描一遍，
+  与规则数量无关；安装了 `pyahocorasick` 时使用其 C 实现，否则用内置纯 Python 版本。
+- 正则规则（kind="regex"）合并为一个带命名分组的交替正则 `(?P<r0>...)|(?P<r1>...)`，
+  作为预筛：每条文本一次 search，绝大多数干净文本到此为止；命中的少数文本再逐条规则用
+  各自的正则判定，因此同一文本命中多条正则时每条都计数，逐规则耗时也在默认模式下统计
+  （预筛耗时记为 `engine:regex`）。
+- `profile=True` 时跳过预筛，每条规则单独扫描全部文本，得到该规则在全量数据上的耗时，
+  用于定位慢规则；命中数与默认模式一致。
+- 传入 `open_pool` 创建的进程池时，文本按块分发到多个进程并行评估，统计在主进程合并。
+
+规则文件为 JSON 列表：
+```
+[{"name": "url", "pattern": "https?://\\\\S+", "kind": "regex"},
+ {"name": "script_tag", "pattern": "<script", "kind": "literal"}]
+```
+注意：合并扫描器会给每条正则外包一层分组，正则内部不要使用编号反向引用（\\1）。
+"""
+from __future__ import annotations
+
+import json
+import multiprocessing as mp
+import re
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Sequence, Set, Tuple
+
+import numpy as np
+
+try:
+    import ahocorasick  # pyahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+@dataclass
+class Rule:
+    name: str
+    pattern: str
+    kind: str = "regex"  # regex | literal
+    ignore_case: bool = True
+
+
+# 与 cleaning.GATE_PATTERN 等价的默认规则
+DEFAULT_RULES = [
+    Rule("url", r"http[s]?://\S+"),
+    Rule("script_tag", "<script", kind="literal"),
+    Rule("sql_select_star", r"select\s+\*"),
+    Rule("sql_drop_table", r"drop\s+table"),
+]
+
+
+def load_rules(path: str | Path) -> List[Rule]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [Rule(**item) for item in json.load(f)]
+
+
+@dataclass
+class RuleStats:
+    records: int = 0
+    rejected: int = 0
+    hits: Dict[str, int] = field(default_factory=dict)
+    seconds: Dict[str, float] = field(default_factory=dict)  # 规则名或引擎名 → 秒
+
+    def merge(self, other: "RuleStats") -> None:
+        self.records += other.records
+        self.rejected += other.rejected
+        for k, v in other.hits.items():
+            self.hits[k] = self.hits.get(k, 0) + v
+        for k, v in other.seconds.items():
+            self.seconds[k] = self.seconds.get(k, 0.0) + v
+
+    def to_dict(self) -> dict:
+        d = asdict(self)
+        d["seconds"] = {k: round(v, 4) for k, v in self.seconds.items()}
+        return d
+
+
+class AhoCorasick:
+    """纯 Python Aho-Corasick：goto 表为 dict 列表，输出集合沿 fail 链预先合并。"""
+
+    def __init__(self, words: Sequence[Tuple[str, int]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.out: List[Tuple[int, ...]] = [()]
+        for word, value in words:
+            state = 0
+            for ch in word:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.out.append(())
+                state = nxt
+            self.out[state] += (value,)
+
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] += self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    def find(self, text: str) -> Set[int]:
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        found: Set[int] = set()
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class _LiteralMatcher:
+    """大小写不敏感的字面量在小写文本上匹配，敏感的在原文上匹配。"""
+
+    def __init__(self, rules: List[Tuple[int, Rule]]):
+        self.groups = []
+        for ignore_case in (True, False):
+            words = [
+                (r.pattern.lower() if ignore_case else r.pattern, i)
+                for i, r in rules
+                if r.ignore_case == ignore_case
+            ]
+            if words:
+                self.groups.append((ignore_case, self._build(words)))
+
+    @staticmethod
+    def _build(words):
+        if ahocorasick is None:
+            return AhoCorasick(words)
+        auto = ahocorasick.Automaton()
+        merged: Dict[str, Tuple[int, ...]] = {}
+        for w, i in words:
+            merged[w] = merged.get(w, ()) + (i,)
+        for w, ids in merged.items():
+            auto.add_word(w, ids)
+        auto.make_automaton()
+        return auto
+
+    def find(self, text: str) -> Set[int]:
+        found: Set[int] = set()
+        lower = None
+        for ignore_case, auto in self.groups:
+            if ignore_case:
+                lower = text.lower() if lower is None else lower
+                s = lower
+            else:
+                s = text
+            if isinstance(auto, AhoCorasick):
+                found |= auto.find(s)
+            else:
+                for _, ids in auto.iter(s):
+                    found.update(ids)
+        return found
+
+
+def _compile(rule: Rule) -> re.Pattern:
+    return re.compile(rule.pattern, re.I if rule.ignore_case else 0)
+
+
+class RuleSet:
+    """编译后的门控规则集；`evaluate` 返回 (拦截掩码, RuleStats)。"""
+
+    def __init__(self, rules: Sequence[Rule] = DEFAULT_RULES, profile: bool = False):
+        names = [r.name for r in rules]
+        if len(set(names)) != len(names):
+            raise ValueError("rule names must be unique")
+        for r in rules:
+            if r.kind not in ("regex", "literal"):
+                raise ValueError(f"unknown rule kind: {r.kind}")
+        self.rules = list(rules)
+        self.profile = profile
+        literal = [(i, r) for i, r in enumerate(self.rules) if r.kind == "literal"]
+        regex = [(i, r) for i, r in enumerate(self.rules) if r.kind == "regex"]
+        self.literals = _LiteralMatcher(literal) if literal else None
+        self.literal_ids = [i for i, _ in literal]
+        self.regex_ids = [i for i, _ in regex]
+        self.singles = {i: _compile(r) for i, r in regex}
+        if regex:
+            parts = [
+                f"(?P<r{i}>(?i:{r.pattern}))" if r.ignore_case else f"(?P<r{i}>{r.pattern})"
+                for i, r in regex
+            ]
+            self.combined = re.compile("|".join(parts))
+        else:
+            self.combined = None
+
+    def _match_literals(self, texts: Sequence[str], hits: List[Set[int]], stats: RuleStats) -> None:
+        if self.literals is None:
+            return
+        t0 = time.perf_counter()
+        for h, text in zip(hits, texts):
+            h |= self.literals.find(text)
+        stats.seconds["engine:literal"] = stats.seconds.get("engine:literal", 0.0) + time.perf_counter() - t0
+
+    def _match_regex(self, texts: Sequence[str], hits: List[Set[int]], stats: RuleStats) -> None:
+        if self.combined is None:
+            return
+        if self.profile:
+            # 逐条规则单独扫描：精确的命中与耗时
+            for i in self.regex_ids:
+                pat = self.singles[i]
+                t0 = time.perf_counter()
+                for h, text in zip(hits, texts):
+                    if pat.search(text):
+                        h.add(i)
+                name = self.rules[i].name
+                stats.seconds[name] = stats.seconds.get(name, 0.0) + time.perf_counter() - t0
+            return
+        # 合并正则只作预筛：一次 search 找出可能命中的文本
+        t0 = time.perf_counter()
+        matched = [k for k, text in enumerate(texts) if self.combined.search(text)]
+        stats.seconds["engine:regex"] = stats.seconds.get("engine:regex", 0.0) + time.perf_counter() - t0
+        # 预筛命中的文本逐条规则判定：同一文本命中多条规则时每条都计数
+        for i in self.regex_ids:
+            pat = self.singles[i]
+            t0 = time.perf_counter()
+            for k in matched:
+                if pat.search(texts[k]):
+                    hits[k].add(i)
+            name = self.rules[i].name
+            stats.seconds[name] = stats.seconds.get(name, 0.0) + time.perf_counter() - t0
+
+    def evaluate(self, texts: Sequence[str], pool=None, chunk_size: int = 2000) -> Tuple[np.ndarray, RuleStats]:
+        """评估一批文本；`pool` 为 `open_pool` 返回的进程池时按块并行。"""
+        if pool is not None and len(texts) > chunk_size:
+            parts = [texts[i : i + chunk_size] for i in range(0, len(texts), chunk_size)]
+            stats = RuleStats()
+            masks = []
+            for mask, part_stats in pool.imap(_evaluate_worker, parts):
+                masks.append(mask)
+                stats.merge(part_stats)
+            return np.concatenate(masks), stats
+
+        texts = list(texts)
+        stats = RuleStats(records=len(texts))
+        hits: List[Set[int]] = [set() for _ in texts]
+        self._match_literals(texts, hits, stats)
+        self._match_regex(texts, hits, stats)
+
+        mask = np.fromiter((bool(h) for h in hits), dtype=bool, count=len(hits))
+        counts = np.bincount([i for h in hits for i in h], minlength=len(self.rules))
+        stats.hits = {r.name: int(n) for r, n in zip(self.rules, counts)}
+        stats.rejected = int(mask.sum())
+        return mask, stats
+
+
+_WORKER_RULESET: RuleSet | None = None
+
+
+def _init_worker(ruleset: RuleSet) -> None:
+    global _WORKER_RULESET
+    _WORKER_RULESET = ruleset
+
+
+def _evaluate_worker(texts: Sequence[str]) -> Tuple[np.ndarray, RuleStats]:
+    assert _WORKER_RULESET is not None
+    return _WORKER_RULESET.evaluate(texts)
+
+
+def open_pool(ruleset: RuleSet, workers: int):
+    """进程池，每个进程启动时收到一份规则集（只序列化一次）。"""
+    return mp.Pool(workers, initializer=_init_worker, initargs=(ruleset,))
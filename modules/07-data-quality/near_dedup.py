@@ -0,0 +1,351 @@
+"""近似去重：MinHash + LSH 分桶（NumPy 向量化，流式处理 JSONL）。
+
+流程：
+1. 规范化文本（小写、合并空白），按字符 k-gram 切 shingle（中文无需分词）；
+2. 整批记录拼接后用 NumPy 向量化计算 rolling hash 与 num_perm 组 MinHash 签名；
+3. 签名切成 b 个 band（每个 r 行），任一 band 与此前记录相同即判为近似重复，
+   避免两两比较；(b, r) 按 Jaccard 阈值最小化误判/漏判面积自动选择。
+
+LSH 索引只保存每条记录的 b 个 64 bit band key（若干有序 NumPy run，见 SortedKeySet），
+千万级记录约数百 MB，可在单机上流式处理。
+
+示例：
+```
+python modules/07-data-quality/near_dedup.py --input clean.jsonl --output dedup.jsonl \
+  --rejected near_dups.jsonl --threshold 0.8 --shingle-size 5 --num-perm 128
+```
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_ROLL_BASE = np.uint64(1000003)
+_BAND_MIX = np.uint64(0x9E3779B97F4A7C15)
+_WS = re.compile(r"\s+")
+
+
+@dataclass
+class NearDupConfig:
+    shingle_size: int = 5
+    num_perm: int = 128
+    threshold: float = 0.8
+    seed: int = 1
+    batch_size: int = 2000
+
+
+def normalize_text(text: str) -> str:
+    return _WS.sub(" ", text.lower()).strip()
+
+
+def record_text(rec: dict) -> str:
+    return " ".join(str(rec.get(k) or "") for k in ("instruction", "input", "output"))
+
+
+def optimal_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """选择 (bands, rows)，使 S 曲线在阈值两侧的误判 + 漏判面积最小。"""
+    xs = np.linspace(0.0, 1.0, 1001)
+    dx = xs[1] - xs[0]
+    below = xs < threshold
+    best = (1, num_perm)
+    best_err = float("inf")
+    for b in range(1, num_perm + 1):
+        for r in range(1, num_perm // b + 1):
+            p = 1.0 - (1.0 - xs ** r) ** b  # 成为候选的概率
+            err = (p[below].sum() + (1.0 - p[~below]).sum()) * dx
+            if err < best_err:
+                best, best_err = (b, r), err
+    return best
+
+
+class MinHasher:
+    """字符 k-gram MinHash，对整批文本一次性向量化计算。"""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        if shingle_size < 1:
+            raise ValueError("shingle_size must be >= 1")
+        rng = np.random.default_rng(seed)
+        # a, b < 2^32 且 shingle 哈希为 32 bit，a*x+b 不会溢出 uint64
+        self.a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+    def shingle_hashes(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """返回 (所有 shingle 的 32 bit 哈希, 每条记录的起始偏移)。"""
+        k = self.shingle_size
+        codes_list = []
+        for text in texts:
+            text = normalize_text(text)
+            if len(text) < k:  # 过短文本整体作为一个 shingle
+                text = text + "\0" * (k - len(text))
+            codes_list.append(np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32))
+        lengths = np.array([len(c) for c in codes_list], dtype=np.int64)
+        codes = np.concatenate(codes_list).astype(np.uint64)
+
+        n_windows = len(codes) - k + 1
+        h = np.zeros(n_windows, dtype=np.uint64)
+        for j in range(k):
+            h = h * _ROLL_BASE + codes[j : j + n_windows]
+
+        # 只保留不跨记录边界的窗口
+        starts = np.cumsum(lengths) - lengths
+        n_shingles = lengths - k + 1
+        seg_offsets = np.cumsum(n_shingles) - n_shingles
+        local = np.arange(n_shingles.sum()) - np.repeat(seg_offsets, n_shingles)
+        h = h[np.repeat(starts, n_shingles) + local]
+        return (h ^ (h >> np.uint64(32))) & np.uint64(0xFFFFFFFF), seg_offsets
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """MinHash 签名，shape [n, num_perm]，dtype uint64。"""
+        if not texts:
+            return np.empty((0, self.num_perm), dtype=np.uint64)
+        sh, offsets = self.shingle_hashes(texts)
+        sig = np.empty((len(texts), self.num_perm), dtype=np.uint64)
+        # 按置换分块，限制 [block, n_shingles] 临时矩阵的大小
+        block = max(1, min(self.num_perm, (1 << 22) // max(len(sh), 1)))
+        for start in range(0, self.num_perm, block):
+            a = self.a[start : start + block, None]
+            b = self.b[start : start + block, None]
+            perm = (a * sh[None, :] + b) % MERSENNE_PRIME
+            sig[:, start : start + block] = np.minimum.reduceat(perm, offsets, axis=1).T
+        return sig
+
+
+def estimate_jaccard(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    return float(np.mean(sig_a == sig_b))
+
+
+class SortedKeySet:
+    """uint64 集合：若干有序 run（LSM 式）。
+
+    每批新 key 排序去重后作为一个新 run 追加；末尾 run 不大于新 run 的 2 倍时两者合并，
+    因此 run 从旧到新大小至少减半，共 O(log(n / batch)) 个。判重对每个 run 做一次
+    searchsorted，每个 key 一生中只参与 O(log n) 次合并：单批成本只与批大小（及 log n）
+    相关，不随已插入总量线性增长。
+    """
+
+    def __init__(self):
+        self.runs: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self.runs)
+
+    @staticmethod
+    def _isin(sorted_arr: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        if len(sorted_arr) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        pos = np.searchsorted(sorted_arr, keys)
+        pos[pos == len(sorted_arr)] = 0
+        return sorted_arr[pos] == keys
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        # 查询 key 先排序：searchsorted 对有序查询逐个缩小搜索区间，缓存命中率高得多
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        found_sorted = np.zeros(keys.shape, dtype=bool)
+        for run in self.runs:
+            found_sorted |= self._isin(run, sorted_keys)
+        found = np.empty(keys.shape, dtype=bool)
+        found[order] = found_sorted
+        return found
+
+    @staticmethod
+    def _sorted_unique(keys: np.ndarray) -> np.ndarray:
+        # 不用 np.unique / np.union1d：新版 NumPy 对大整数数组走哈希实现，比排序慢一个数量级
+        keys = np.sort(keys)
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = keys[1:] != keys[:-1]
+        return keys[keep]
+
+    def add(self, keys: np.ndarray) -> None:
+        """加入 keys；调用方应只传尚不在集合中的 key（重复也正确，只是多占空间）。"""
+        run = self._sorted_unique(np.asarray(keys, dtype=np.uint64))
+        if len(run) == 0:
+            return
+        while self.runs and len(self.runs[-1]) <= 2 * len(run):
+            run = self._sorted_unique(np.concatenate([self.runs.pop(), run]))
+        self.runs.append(run)
+
+
+class LSHIndex:
+    """MinHash LSH 索引：签名按 band 折叠成 64 bit key，判重即查 key 是否出现过。"""
+
+    def __init__(self, bands: int, rows: int):
+        self.bands = bands
+        self.rows = rows
+        self.keys = SortedKeySet()
+        self._band_ids = np.arange(bands, dtype=np.uint64) * _BAND_MIX
+
+    def band_keys(self, sigs: np.ndarray) -> np.ndarray:
+        """[n, num_perm] → [n, bands]，不同 band 的 key 通过 band 编号混合区分。"""
+        x = sigs[:, : self.bands * self.rows].reshape(len(sigs), self.bands, self.rows)
+        h = np.zeros((len(sigs), self.bands), dtype=np.uint64)
+        for j in range(self.rows):
+            h = h * _ROLL_BASE + x[:, :, j]
+        return h ^ self._band_ids
+
+    def insert(self, sigs: np.ndarray) -> np.ndarray:
+        """插入一批签名，返回每条是否与此前某条保留记录（含同批更早的记录）近似重复。
+
+        只有保留下来的记录把 band key 写入索引：重复记录的 key 若也写入，
+        A≈B、B≈C 时 C 会经由已删除的 B 被误判为 A 的重复（链式传递）。
+        """
+        n = len(sigs)
+        if n == 0:
+            return np.zeros(0, dtype=bool)
+        keys = self.band_keys(sigs)
+        dup = self.keys.contains(keys.ravel()).reshape(n, self.bands).any(axis=1)
+        dup |= self._dups_within_batch(keys, ~dup)
+        self.keys.add(keys[~dup].ravel())
+        return dup
+
+    @staticmethod
+    def _dups_within_batch(keys: np.ndarray, cand: np.ndarray) -> np.ndarray:
+        """候选行（未与索引撞桶）中，与同批更早的保留行撞桶的行。
+
+        判重依赖更早的行是否保留，须按行顺序处理；但只有与其它候选行共享 key 的行
+        才可能互相影响，逐行循环只覆盖这些行，且每行只查共享的 key。
+        """
+        rows = np.flatnonzero(cand)
+        sub = keys[rows]
+        flat = sub.ravel()
+        order = np.argsort(flat, kind="stable")
+        same = flat[order][1:] == flat[order][:-1]
+        shared_sorted = np.zeros(len(flat), dtype=bool)
+        shared_sorted[1:] |= same
+        shared_sorted[:-1] |= same
+        shared = np.empty(len(flat), dtype=bool)
+        shared[order] = shared_sorted
+        shared = shared.reshape(sub.shape)
+
+        dup = np.zeros(len(keys), dtype=bool)
+        kept_keys: set = set()
+        for i in np.flatnonzero(shared.any(axis=1)):
+            row_keys = sub[i][shared[i]].tolist()
+            if kept_keys.isdisjoint(row_keys):
+                kept_keys.update(row_keys)
+            else:
+                dup[rows[i]] = True
+        return dup
+
+
+def near_duplicate_mask(texts: List[str], config: NearDupConfig | None = None) -> np.ndarray:
+    """内存版：返回每条文本是否为前文某条的近似重复（保留首次出现）。"""
+    config = config or NearDupConfig()
+    hasher = MinHasher(config.num_perm, config.shingle_size, config.seed)
+    index = LSHIndex(*optimal_bands(config.threshold, config.num_perm))
+    out = np.zeros(len(texts), dtype=bool)
+    for start in range(0, len(texts), config.batch_size):
+        batch = texts[start : start + config.batch_size]
+        out[start : start + len(batch)] = index.insert(hasher.signatures(batch))
+    return out
+
+
+def _batched_lines(lines: Iterable[str], size: int) -> Iterator[List[str]]:
+    batch: List[str] = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(line)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def dedup_jsonl(
+    input_path: str | Path,
+    output_path: str | Path,
+    config: NearDupConfig | None = None,
+    rejected_path: str | Path | None = None,
+) -> dict:
+    """流式近似去重 JSONL：逐批读入、签名、查/写 LSH 索引，内存只随索引增长。
+
+    返回统计与各阶段耗时（秒）。
+    """
+    config = config or NearDupConfig()
+    bands, rows = optimal_bands(config.threshold, config.num_perm)
+    hasher = MinHasher(config.num_perm, config.shingle_size, config.seed)
+    index = LSHIndex(bands, rows)
+    timings = {"parse": 0.0, "minhash": 0.0, "lsh": 0.0, "write": 0.0}
+    total = kept = 0
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    start_time = time.perf_counter()
+    with open(input_path, "r", encoding="utf-8") as f, open(output_path, "w", encoding="utf-8") as w:
+        rej = open(rejected_path, "w", encoding="utf-8") if rejected_path else None
+        try:
+            for lines in _batched_lines(f, config.batch_size):
+                t0 = time.perf_counter()
+                texts = [record_text(json.loads(line)) for line in lines]
+                t1 = time.perf_counter()
+                sigs = hasher.signatures(texts)
+                t2 = time.perf_counter()
+                dup = index.insert(sigs)
+                t3 = time.perf_counter()
+                for line, is_dup in zip(lines, dup):
+                    if not is_dup:
+                        w.write(line + "\n")
+                    elif rej:
+                        rej.write(line + "\n")
+                t4 = time.perf_counter()
+                timings["parse"] += t1 - t0
+                timings["minhash"] += t2 - t1
+                timings["lsh"] += t3 - t2
+                timings["write"] += t4 - t3
+                total += len(lines)
+                kept += int((~dup).sum())
+        finally:
+            if rej:
+                rej.close()
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "records": total,
+        "kept": kept,
+        "near_duplicates": total - kept,
+        "bands": bands,
+        "rows": rows,
+        "index_keys": len(index.keys),
+        "seconds": round(elapsed, 3),
+        "records_per_sec": round(total / elapsed, 1) if elapsed > 0 else None,
+        "timings": {k: round(v, 3) for k, v in timings.items()},
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="MinHash + LSH near-duplicate removal for JSONL")
+    ap.add_argument("--input", required=True)
+    ap.add_argument("--output", required=True)
+    ap.add_argument("--rejected", default=None, help="可选，近似重复样本输出路径")
+    ap.add_argument("--threshold", type=float, default=0.8, help="Jaccard 相似度阈值")
+    ap.add_argument("--shingle-size", type=int, default=5, help="字符 k-gram 长度")
+    ap.add_argument("--num-perm", type=int, default=128)
+    ap.add_argument("--batch-size", type=int, default=2000)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    config = NearDupConfig(
+        shingle_size=args.shingle_size,
+        num_perm=args.num_perm,
+        threshold=args.threshold,
+        seed=args.seed,
+        batch_size=args.batch_size,
+    )
+    stats = dedup_jsonl(args.input, args.output, config, args.rejected)
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
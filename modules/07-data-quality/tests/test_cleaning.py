@@ -1,4 +1,5 @@
 import importlib.util
+import sys
 from pathlib import Path
 import pandas as pd
 
@@ -6,6 +7,7 @@ BASE = Path(__file__).resolve().parents[1]
 spec = importlib.util.spec_from_file_location("cleaning", str(BASE / "cleaning.py"))
 mod = importlib.util.module_from_spec(spec)  # type: ignore
 assert spec and spec.loader
+sys.modules["cleaning"] = mod  # dataclass 解析注解时需要从 sys.modules 找到模块
 spec.loader.exec_module(mod)  # type: ignore
 Rules = mod.Rules
 apply_rules = mod.apply_rules
@@ -14,7 +16,7 @@ quality_gate = mod.quality_gate
 
 def test_apply_rules_length_and_dedup():
     df = pd.DataFrame([
-        {"instruction": "a" * 5, "input": "", "output": "x" * 5},  # too short
+        {"instruction": "a" * 4, "input": "", "output": "x" * 5},  # too short
         {"instruction": "hello", "input": "world", "output": "!" * 20},  # ok
         {"instruction": "hello", "input": "world", "output": "!" * 20},  # dup
     ])
@@ -29,3 +31,49 @@ def test_quality_gate():
     ])
     passed, rejected = quality_gate(df)
     assert len(passed) == 1 and len(rejected) == 1
+    # 默认规则集与内置正则等价
+    passed, rejected = quality_gate(df, mod.RuleSet())
+    assert len(passed) == 1 and len(rejected) == 1
+
+
+def test_clean_stream_matches_in_memory(tmp_path):
+    import json
+
+    rows = [
+        {"instruction": "hello", "input": "world", "output": "!" * 20},
+        {"instruction": "hello", "input": None, "output": "?" * 20},
+        {"instruction": "看看 http://spam.com", "input": "", "output": "垃圾内容需要拦截"},
+        {"instruction": "hello", "input": "world", "output": "!" * 20},  # 跨块重复
+        {"instruction": None, "input": "", "output": "缺少必要字段的样本"},
+        {"instruction": "hi", "input": "", "output": "短"},
+    ]
+    inp = tmp_path / "raw.jsonl"
+    inp.write_text("\n".join(json.dumps(r, ensure_ascii=False) for r in rows) + "\n", encoding="utf-8")
+
+    stats = mod.clean_stream(inp, tmp_path / "ok.jsonl", tmp_path / "bad.jsonl", Rules(), chunk_size=2)
+    assert stats["chunks"] == 3 and stats["passed"] == 2
+    assert stats["rejected"] == {"na": 1, "length": 1, "duplicate": 1, "gate": 1}
+
+    expected, _ = quality_gate(apply_rules(pd.DataFrame(rows), Rules()))
+    passed = pd.read_json(tmp_path / "ok.jsonl", lines=True, dtype=False)
+    assert passed["output"].tolist() == expected["output"].tolist()
+    rejected = pd.read_json(tmp_path / "bad.jsonl", lines=True, dtype=False)
+    assert sorted(rejected["reject_reason"]) == ["duplicate", "gate", "length", "na"]
+
+
+def test_clean_stream_dedup_across_many_chunks(tmp_path):
+    import json
+    import random
+
+    # 重复样本散布在整个流中，跨越多次 run 合并
+    rng = random.Random(0)
+    ids = [i if i == 0 or rng.random() > 0.3 else rng.randrange(i) for i in range(3000)]
+    rows = [{"instruction": f"问题 {j} 请回答", "input": "", "output": f"第 {j} 条答案"} for j in ids]
+    inp = tmp_path / "raw.jsonl"
+    inp.write_text("\n".join(json.dumps(r, ensure_ascii=False) for r in rows) + "\n", encoding="utf-8")
+
+    stats = mod.clean_stream(inp, tmp_path / "ok.jsonl", None, Rules(), chunk_size=37)
+    assert stats["passed"] == len(set(ids))
+    assert stats["rejected"]["duplicate"] == len(ids) - len(set(ids))
+    passed = pd.read_json(tmp_path / "ok.jsonl", lines=True, dtype=False)
+    assert passed["output"].tolist() == apply_rules(pd.DataFrame(rows), Rules())["output"].tolist()
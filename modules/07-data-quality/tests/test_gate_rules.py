@@ -0,0 +1,77 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+BASE = Path(__file__).resolve().parents[1]
+spec = importlib.util.spec_from_file_location("gate_rules", str(BASE / "gate_rules.py"))
+mod = importlib.util.module_from_spec(spec)  # type: ignore
+assert spec and spec.loader
+sys.modules["gate_rules"] = mod
+spec.loader.exec_module(mod)  # type: ignore
+Rule = mod.Rule
+RuleSet = mod.RuleSet
+
+RULES = mod.DEFAULT_RULES + [
+    Rule("invoice", "代开发票", kind="literal"),
+    Rule("she", "she", kind="literal"),
+    Rule("hers", "hers", kind="literal"),
+    Rule("wechat", r"(?:加|\+)\s*微信"),
+    Rule("Token", "TOKEN", kind="literal", ignore_case=False),
+]
+TEXTS = [
+    "正常的问题和回答",
+    "看看 http://spam.com",
+    "代开发票，请加 微信",
+    "ushers",  # 重叠字面量：she 与 hers 都命中
+    "SELECT * FROM users",
+    "token 小写不命中大小写敏感规则",
+    "<SCRIPT>alert(1)</script>",
+]
+
+
+def test_aho_corasick_matches_overlapping_literals():
+    ac = mod.AhoCorasick([("he", 0), ("she", 1), ("his", 2), ("hers", 3)])
+    assert ac.find("ushers") == {0, 1, 3}
+    assert ac.find("ahishe") == {0, 1, 2}
+    assert ac.find("xyz") == set()
+
+
+def test_ruleset_mask_and_hits(monkeypatch):
+    expected_mask = [False, True, True, True, True, False, True]
+    for backend in (mod.ahocorasick, None):  # C 实现（若已安装）与纯 Python 实现结果一致
+        monkeypatch.setattr(mod, "ahocorasick", backend)
+        for profile in (False, True):
+            mask, stats = RuleSet(RULES, profile=profile).evaluate(TEXTS)
+            assert mask.tolist() == expected_mask
+            assert stats.records == 7 and stats.rejected == 5
+            assert stats.hits["she"] == 1 and stats.hits["hers"] == 1
+            assert stats.hits["invoice"] == 1 and stats.hits["wechat"] == 1
+            assert stats.hits["Token"] == 0 and stats.hits["script_tag"] == 1
+    assert set(stats.seconds) >= {"engine:literal", "url", "wechat"}
+
+
+def test_ruleset_parallel_matches_serial():
+    texts = TEXTS * 50
+    ruleset = RuleSet(RULES)
+    mask, stats = ruleset.evaluate(texts)
+    with mod.open_pool(ruleset, 2) as pool:
+        pmask, pstats = ruleset.evaluate(texts, pool=pool, chunk_size=64)
+    assert pmask.tolist() == mask.tolist()
+    assert pstats.hits == stats.hits and pstats.records == len(texts)
+
+
+def test_ruleset_rejects_duplicate_names():
+    with pytest.raises(ValueError):
+        RuleSet([Rule("a", "x"), Rule("a", "y", kind="literal")])
+
+
+def test_overlapping_regex_rules_both_counted_by_default():
+    rules = [Rule("url", r"https?://\S+"), Rule("spam", r"http://spam")]
+    texts = ["看看 http://spam.com", "https://example.com", "正常文本"]
+    for profile in (False, True):
+        mask, stats = RuleSet(rules, profile=profile).evaluate(texts)
+        assert mask.tolist() == [True, True, False]
+        assert stats.hits == {"url": 2, "spam": 1}
+        assert {"url", "spam"} <= set(stats.seconds)